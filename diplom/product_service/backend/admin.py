@@ -1,12 +1,57 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
+from django.db import transaction
+
 from backend.models import User, Shop, Category, Product, ProductInfo, \
     Parameter, ProductParameter, Order, OrderItem, \
-    Contact, ConfirmEmailToken
+    Contact, ConfirmEmailToken, ImportJob, ExportJob, CatalogItem
 from import_export import resources
 from import_export.admin import ImportExportModelAdmin
 
+from backend.versions import bump_catalog_version
+from backend.catalog import refresh_catalog_items
+from backend.caching import catalog_cache
+from backend.tasks import task_rebuild_catalog
+
+
+class PrefetchedResource(resources.ModelResource):
+    """
+    Импорт из админки без запроса на каждую строку: записи, как и раньше,
+    ищутся по id, но все записи файла читаются одним запросом
+    в before_import
+    """
+    instances = None
+
+    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
+        super().before_import(dataset, using_transactions, dry_run, **kwargs)
+        ids = set()
+        if 'id' in dataset.headers:
+            for value in dataset['id']:
+                try:
+                    ids.add(int(value))
+                except (TypeError, ValueError):
+                    continue
+        self.instances = self._meta.model.objects.in_bulk(ids)
+
+    def get_instance(self, instance_loader, row):
+        if self.instances is None:
+            return super().get_instance(instance_loader, row)
+        try:
+            return self.instances.get(int(row['id']))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+
+class ProductResource(PrefetchedResource):
+    class Meta:
+        model = Product
+
+
+class ParameterResource(PrefetchedResource):
+    class Meta:
+        model = Parameter
+
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
@@ -55,6 +100,26 @@ class ShopAdmin(ImportExportModelAdmin, admin.ModelAdmin):
     search_fields = ['name__startswith']
     list_per_page = 5
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # название и статус магазина хранятся в витрине, ее пересобирает
+        # воркер после фиксации. Они есть и в готовых выгрузках, поэтому
+        # версия каталога меняется сразу, не дожидаясь воркера
+        if change and {'name', 'state'} & set(form.changed_data):
+            bump_catalog_version([obj.pk])
+            transaction.on_commit(
+                lambda: task_rebuild_catalog.delay(obj.pk))
+        else:
+            catalog_cache.bump([obj.pk])
+
+    def delete_queryset(self, request, queryset):
+        catalog_cache.bump(list(queryset.values_list('id', flat=True)))
+        super().delete_queryset(request, queryset)
+
+    def delete_model(self, request, obj):
+        catalog_cache.bump([obj.pk])
+        super().delete_model(request, obj)
+
 
 @admin.register(Category)
 class CategoryAdmin(ImportExportModelAdmin, admin.ModelAdmin):
@@ -66,16 +131,43 @@ class CategoryAdmin(ImportExportModelAdmin, admin.ModelAdmin):
 
 @admin.register(Product)
 class ProductAdmin(ImportExportModelAdmin, admin.ModelAdmin):
+    resource_classes = [ProductResource]
     list_display = ['id', 'name', 'category']
     list_display_links = ['id', 'name']
     search_fields = ['name', 'category__name']
     list_per_page = 5
 
 
+class CatalogVersionAdmin(admin.ModelAdmin):
+    """
+    Удаление из админки увеличивает версию каталога магазинов
+    и обновляет витрину.
+    Сигнал post_delete для товаров не используется: он отключает быстрое
+    каскадное удаление магазина со всеми товарами
+    """
+    shop_field = 'shop_id'
+    product_info_field = 'id'
+
+    def delete_model(self, request, obj):
+        self.delete_queryset(request, self.model.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        bump_catalog_version(list(queryset.values_list(
+            self.shop_field, flat=True).distinct()))
+        product_info_ids = list(queryset.values_list(
+            self.product_info_field, flat=True))
+        # фасеты категорий удаленных товаров, их строки витрины удаляются
+        # каскадом
+        pairs = set(CatalogItem.objects.filter(
+            pk__in=product_info_ids).values_list('shop_id', 'category_id'))
+        super().delete_queryset(request, queryset)
+        refresh_catalog_items(product_info_ids, pairs=pairs)
+
+
 @admin.register(ProductInfo)
-class ProductInfoAdmin(ImportExportModelAdmin, admin.ModelAdmin):
+class ProductInfoAdmin(ImportExportModelAdmin, CatalogVersionAdmin):
     list_display = ['id', 'model', 'external_id', 'quantity', 'price',
-                    'price_rrc', 'product', 'shop']
+                    'price_rrc', 'product', 'shop', 'is_active']
 
     list_display_links = ['id', 'model']
     search_fields = ['model', 'shop__name']
@@ -84,6 +176,7 @@ class ProductInfoAdmin(ImportExportModelAdmin, admin.ModelAdmin):
 
 @admin.register(Parameter)
 class ParameterAdmin(ImportExportModelAdmin, admin.ModelAdmin):
+    resource_classes = [ParameterResource]
     list_display = ['id', 'name']
     list_display_links = ['id', 'name']
     search_fields = ['name']
@@ -91,7 +184,9 @@ class ParameterAdmin(ImportExportModelAdmin, admin.ModelAdmin):
 
 
 @admin.register(ProductParameter)
-class ProductParameterAdmin(ImportExportModelAdmin, admin.ModelAdmin):
+class ProductParameterAdmin(ImportExportModelAdmin, CatalogVersionAdmin):
+    shop_field = 'product_info__shop_id'
+    product_info_field = 'product_info_id'
     list_display = ['id', 'value', 'parameter', 'product_info_id']
     list_display_links = ['id', 'value', 'parameter']
     # search_fields = ['product_info_id'] # id перевести в строку нужно
@@ -135,3 +230,21 @@ class ConfirmEmailTokenAdmin(admin.ModelAdmin):
     list_display_links = ['id', 'user']
     search_fields = ['user__last_name', 'user__first_name']
 
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'shop', 'user', 'dry_run', 'state',
+                    'goods_processed', 'rows_written', 'created_at',
+                    'finished_at']
+    list_display_links = ['id', 'shop']
+    list_filter = ['state', 'dry_run']
+    list_per_page = 5
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'shop', 'format', 'state', 'goods_exported', 'size',
+                    'created_at', 'finished_at']
+    list_display_links = ['id', 'shop']
+    list_filter = ['state', 'format']
+    list_per_page = 5
@@ -0,0 +1,233 @@
+"""
+Замеры скорости импорта и экспорта каталога на синтетических прайс-листах
+"""
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import yaml
+from django.db import connection
+from django.test import override_settings
+
+from product_service.celery import app
+from backend.models import User, Shop, Category, Product, Parameter, \
+    ImportJob
+from backend.tasks import task_product_import, task_product_export
+
+# категории синтетических прайс-листов берем из отдельного диапазона id,
+# чтобы не пересечься с настоящими
+CATEGORY_ID_START = 900000
+
+PARAMETER_NAMES = ['Цвет', 'Диагональ (дюйм)', 'Разрешение (пикс)',
+                   'Встроенная память (Гб)', 'Оперативная память (Гб)',
+                   'Процессор', 'Вес (г)', 'Гарантия (мес)', 'Материал',
+                   'Страна производства', 'Емкость аккумулятора (мА*ч)',
+                   'Количество SIM']
+
+COLORS = ['черный', 'белый', 'золотистый', 'красный', 'синий', 'серый']
+
+
+def generate_price_list(file, goods, max_parameters=8, categories=20,
+                        seed=0, shop='Тестовый магазин'):
+    """
+    Пишем в файл прайс-лист в формате поставщика.
+    Товары пишутся пачками, поэтому файл любого размера не держится в памяти
+    """
+    rnd = random.Random(seed)
+    category_ids = range(CATEGORY_ID_START, CATEGORY_ID_START + categories)
+    yaml.safe_dump({
+        'shop': shop,
+        'categories': [{'id': category_id, 'name': f'Категория {category_id}'}
+                       for category_id in category_ids],
+    }, file, allow_unicode=True, sort_keys=False)
+    file.write('goods:\n')
+    batch = []
+    for number in range(goods):
+        price = rnd.randrange(100, 200000, 10)
+        parameters = {}
+        for name in rnd.sample(PARAMETER_NAMES,
+                               rnd.randint(0, max_parameters)):
+            parameters[name] = (rnd.choice(COLORS) if name == 'Цвет'
+                                else rnd.randint(1, 512))
+        batch.append({
+            'id': number + 1,
+            'category': rnd.choice(category_ids),
+            'model': f'vendor/model-{number % 5000}',
+            'name': f'Товар {number % 5000} ({rnd.choice(COLORS)})',
+            'price': price,
+            'price_rrc': price + price // 10,
+            'quantity': rnd.randint(0, 50),
+            'parameters': parameters,
+        })
+        if len(batch) >= 1000:
+            yaml.safe_dump(batch, file, allow_unicode=True, sort_keys=False)
+            batch = []
+    if batch:
+        yaml.safe_dump(batch, file, allow_unicode=True, sort_keys=False)
+
+
+@contextmanager
+def measure(result, trace_memory=True):
+    """
+    Замеряем время, число запросов и пик памяти Python за этап.
+
+    Пик считает tracemalloc с нуля на каждом этапе, поэтому он не
+    зависит от предыдущих этапов и размеров, в отличие от ru_maxrss
+    процесса. tracemalloc замедляет выделение памяти, для чистого
+    времени его можно выключить
+    """
+    queries = [0]
+
+    def count_queries(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        with connection.execute_wrapper(count_queries):
+            yield result
+    finally:
+        result['wall_time'] = round(time.perf_counter() - started, 3)
+        if trace_memory:
+            result['peak_memory_kb'] = \
+                tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+    result['queries'] = queries[0]
+    result['rows_per_sec'] = (round(result['goods'] / result['wall_time'], 1)
+                              if result['wall_time'] else 0)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def serve_directory(path):
+    """
+    Раздаем рабочий каталог по HTTP: прайс-лист скачивается воркером
+    по ссылке, как у настоящего магазина
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                 partial(QuietHandler, directory=path))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@contextmanager
+def eager_tasks():
+    """
+    Задачи Celery выполняются в этом процессе: загрузка, chord шардов
+    и публикация идут тем же путем, что и на воркерах
+    """
+    conf = app.conf
+    saved = conf.task_always_eager, conf.task_eager_propagates
+    conf.task_always_eager = conf.task_eager_propagates = True
+    try:
+        yield
+    finally:
+        conf.task_always_eager, conf.task_eager_propagates = saved
+
+
+def run_import(shop, url):
+    """
+    Загружаем прайс-лист задачей task_product_import, возвращаем
+    результат публикации
+    """
+    job = ImportJob.objects.create(shop=shop, user_id=shop.user_id, url=url)
+    with eager_tasks():
+        task_product_import.delay(shop.id, url, job.id, 'yaml')
+    job.refresh_from_db()
+    if job.state != 'done':
+        raise RuntimeError(f'Загрузка не завершена: {job.errors}')
+    return job.result
+
+
+def existing_ids(categories=20):
+    """
+    id категорий, продуктов и параметров, которые могут совпасть
+    с синтетическими и были в базе до замера
+    """
+    category_ids = range(CATEGORY_ID_START, CATEGORY_ID_START + categories)
+    return {
+        Category: set(Category.objects.filter(
+            id__in=category_ids).values_list('id', flat=True)),
+        Product: set(Product.objects.filter(
+            category_id__in=category_ids).values_list('id', flat=True)),
+        Parameter: set(Parameter.objects.filter(
+            name__in=PARAMETER_NAMES).values_list('id', flat=True)),
+    }
+
+
+def delete_created(before, categories=20):
+    """
+    Удаляем только то, что создал замер: записи, которых не было в before
+    """
+    for model, ids in existing_ids(categories).items():
+        model.objects.filter(id__in=ids - before[model]).delete()
+
+
+def run_benchmark(goods, max_parameters=8, workdir=None, trace_memory=True):
+    """
+    Прогоняем импорт, повторный импорт без изменений и экспорт
+    для прайс-листа из goods товаров
+    """
+    temporary = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='benchmark-')
+    before = existing_ids()
+    user = None
+    results = []
+    try:
+        name = f'shop-{goods}.yaml'
+        with open(os.path.join(workdir, name), 'w',
+                  encoding='utf-8') as file:
+            generate_price_list(file, goods, max_parameters=max_parameters)
+
+        user = User.objects.create(
+            email=f'benchmark-{goods}-{time.time_ns()}@example.com',
+            type='shop', is_active=True)
+        shop = Shop.objects.create(name='Тестовый магазин', user=user)
+        with serve_directory(workdir) as base_url:
+            for phase in ('import', 'reimport'):
+                with measure({'phase': phase, 'goods': goods},
+                             trace_memory) as result:
+                    result['stats'] = run_import(shop, f'{base_url}/{name}')
+                results.append(result)
+
+        with override_settings(EXPORT_ROOT=workdir):
+            with measure({'phase': 'export', 'goods': goods},
+                         trace_memory) as result:
+                task_product_export.run(user.id)
+        results.append(result)
+    finally:
+        if user is not None:
+            user.delete()
+        delete_created(before)
+        if temporary:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
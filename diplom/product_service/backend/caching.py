@@ -0,0 +1,169 @@
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.response import Response
+
+from backend.transactions import on_commit_once
+
+
+def _incr(key, initial):
+    """
+    Увеличиваем счетчик в кэше, отсутствующий создаем со значением initial
+    """
+    if cache.add(key, initial, timeout=None):
+        return
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, initial, timeout=None)
+
+
+class ResponseCache:
+    """
+    Кэш сериализованных ответов каталога без угадывания времени жизни.
+
+    Ключ ответа содержит версию: общую версию каталога или, если выдача
+    ограничена одним магазином, версию магазина и версию общих данных
+    (названия категорий). Любое изменение каталога увеличивает общую
+    версию и версии затронутых магазинов, изменение без магазинов - еще
+    и версию общих данных. Поэтому загрузка одного магазина не сбрасывает
+    ответы других. Старые ответы перестают читаться и вытесняются из кэша
+    по CATALOG_CACHE_TIMEOUT.
+
+    Потерянная версия создается заново из текущего времени в наносекундах,
+    поэтому она больше любой прежней и не совпадет со старыми ответами.
+    """
+
+    def __init__(self, name, timeout):
+        self.name = name
+        self.timeout = timeout
+
+    def version_key(self, shop_id=None):
+        if shop_id is None:
+            return f'{self.name}:version'
+        return f'{self.name}:version:{shop_id}'
+
+    def versions(self, shop_id=None):
+        if shop_id is None:
+            keys = [self.version_key()]
+        else:
+            keys = [self.version_key(SHARED), self.version_key(shop_id)]
+        found = cache.get_many(keys)
+        for key in keys:
+            if key not in found:
+                cache.add(key, time.time_ns(), timeout=None)
+                found[key] = cache.get(key)
+        return [found[key] for key in keys]
+
+    def bump(self, shop_ids=()):
+        """
+        Увеличиваем общую версию и версии магазинов shop_ids.
+        Несколько вызовов в одной транзакции дают одно обновление
+        после ее фиксации
+        """
+        shop_ids = {shop_id for shop_id in shop_ids if shop_id is not None}
+        on_commit_once(self.bump_now, shop_ids)
+
+    def bump_now(self, shop_ids=()):
+        _incr(self.version_key(), time.time_ns())
+        if not shop_ids:
+            _incr(self.version_key(SHARED), time.time_ns())
+        for shop_id in shop_ids:
+            _incr(self.version_key(shop_id), time.time_ns())
+
+    def key(self, view_name, request, versions):
+        params = urlencode(sorted(request.query_params.lists()), doseq=True)
+        # ссылки на соседние страницы в ответе абсолютные
+        url = request.build_absolute_uri(request.path)
+        versions = ':'.join(map(str, versions))
+        digest = hashlib.md5(f'{url}?{params}'.encode('utf-8')).hexdigest()
+        return f'{self.name}:response:{view_name}:{versions}:{digest}'
+
+    def get(self, view_name, key):
+        data = cache.get(key)
+        self.count(view_name, 'hits' if data is not None else 'misses')
+        return data
+
+    def set(self, key, data):
+        cache.set(key, data, timeout=self.timeout)
+
+    def count(self, view_name, counter):
+        _incr(self.counter_key(view_name, counter), 1)
+
+    def counter_key(self, view_name, counter):
+        return f'{self.name}:{counter}:{view_name}'
+
+    def stats(self, view_names):
+        """
+        Попадания, промахи и ответы 304 по представлениям
+        """
+        keys = {(view_name, counter): self.counter_key(view_name, counter)
+                for view_name in view_names for counter in COUNTERS}
+        found = cache.get_many(list(keys.values()))
+        stats = {view_name: {} for view_name in view_names}
+        for (view_name, counter), key in keys.items():
+            stats[view_name][counter] = found.get(key, 0)
+        return stats
+
+    def reset_stats(self, view_names):
+        cache.delete_many([self.counter_key(view_name, counter)
+                           for view_name in view_names
+                           for counter in COUNTERS])
+
+
+# вместо id магазина: версия данных, общих для всех магазинов
+SHARED = 'shared'
+# ответы /products, /shops и /categories
+CACHED_VIEWS = ('products', 'shops', 'categories')
+# счетчики по представлению: ответ из кэша, собранный ответ, ответ 304
+COUNTERS = ('hits', 'misses', 'not_modified')
+catalog_cache = ResponseCache('catalog', settings.CATALOG_CACHE_TIMEOUT)
+
+
+class CachedListMixin:
+    """
+    Кэширование ответа списка в catalog_cache и условный GET.
+    cache_name - имя представления в ключах и счетчиках,
+    get_cache_shop_id() - магазин, версией которого ограничен ответ.
+
+    ETag строится из версий и параметров запроса, поэтому ответ 304
+    на совпавший If-None-Match отдается по одному чтению версий из кэша,
+    без запросов к базе и сериализации. Если версии прочитать не удалось
+    (кэш недоступен), ETag не выдается
+    """
+    cache_name = None
+
+    def get_cache_shop_id(self):
+        return None
+
+    def list(self, request, *args, **kwargs):
+        versions = catalog_cache.versions(self.get_cache_shop_id())
+        key = catalog_cache.key(self.cache_name, request, versions)
+        etag = None
+        if None not in versions:
+            # JSON и страница DRF по одному адресу различаются
+            etag = quote_etag(hashlib.md5(
+                f'{key}:{request.accepted_renderer.format}'.encode('utf-8')
+            ).hexdigest())
+            if_none_match = parse_etags(
+                request.META.get('HTTP_IF_NONE_MATCH', ''))
+            if etag in if_none_match or '*' in if_none_match:
+                catalog_cache.count(self.cache_name, 'not_modified')
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+        data = catalog_cache.get(self.cache_name, key)
+        if data is not None:
+            response = Response(data)
+        else:
+            response = super().list(request, *args, **kwargs)
+            if response.status_code == 200:
+                catalog_cache.set(key, response.data)
+        if etag and response.status_code == 200:
+            response['ETag'] = etag
+        return response
@@ -0,0 +1,189 @@
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Sum
+
+from backend.exporters import merge_parameters, iter_parameter_rows
+from backend.models import CatalogItem, CategoryFacet, ProductInfo
+from backend.search import search_text
+from backend.versions import bump_catalog_version
+
+
+def iter_catalog_items(product_infos, chunk_size):
+    """
+    Строки витрины для товаров из product_infos, собранные из двух
+    плоских потоков: товары и их параметры
+    """
+    goods = product_infos.order_by('id').values_list(
+        'id', 'shop_id', 'shop__name', 'product__category_id',
+        'product__category__name', 'product__name', 'model', 'external_id',
+        'quantity', 'price', 'price_rrc').iterator(chunk_size=chunk_size)
+    for row, parameters in merge_parameters(
+            goods, iter_parameter_rows(product_infos, chunk_size)):
+        (pk, shop_id, shop_name, category_id, category_name, product_name,
+         model, external_id, quantity, price, price_rrc) = row
+        yield CatalogItem(product_info_id=pk, shop_id=shop_id,
+                          shop_name=shop_name, category_id=category_id,
+                          category_name=category_name or '',
+                          product_name=product_name, model=model,
+                          external_id=external_id, quantity=quantity,
+                          price=price, price_rrc=price_rrc,
+                          parameters=parameters,
+                          search_text=search_text(product_name, model,
+                                                  parameters))
+
+
+def _count_facets(facets, shop_id, category_id, parameters):
+    for name, value in parameters.items():
+        facets[shop_id, category_id, name, value] += 1
+
+
+def _create_facets(facets, batch_size):
+    CategoryFacet.objects.bulk_create(
+        (CategoryFacet(shop_id=shop_id, category_id=category_id,
+                       parameter=name, value=value, count=count)
+         for (shop_id, category_id, name, value), count in facets.items()),
+        batch_size=batch_size)
+
+
+def _create_items(items, batch_size, facets=None):
+    count = 0
+    batch = []
+    for item in items:
+        batch.append(item)
+        if facets is not None:
+            _count_facets(facets, item.shop_id, item.category_id,
+                          item.parameters)
+        if len(batch) >= batch_size:
+            CatalogItem.objects.bulk_create(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        CatalogItem.objects.bulk_create(batch)
+        count += len(batch)
+    return count
+
+
+def rebuild_shop_catalog(shop, batch_size=None):
+    """
+    Пересобираем витрину и фасеты магазина целиком одной транзакцией.
+    Фасеты считаются по ходу создания строк витрины.
+    У выключенного магазина витрина пустая.
+    По фасетам выбираются колонки выгрузки CSV, поэтому вместе с ними
+    меняется версия каталога и устаревают готовые выгрузки.
+    Возвращает число строк витрины
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    with transaction.atomic():
+        bump_catalog_version([shop.id])
+        CatalogItem.objects.filter(shop_id=shop.id).delete()
+        CategoryFacet.objects.filter(shop_id=shop.id).delete()
+        if not shop.state:
+            return 0
+        facets = Counter()
+        count = _create_items(iter_catalog_items(
+            ProductInfo.objects.filter(shop_id=shop.id, is_active=True),
+            batch_size), batch_size, facets)
+        _create_facets(facets, batch_size)
+        return count
+
+
+def refresh_facets(pairs, batch_size=None):
+    """
+    Пересчитываем фасеты пар (магазин, категория) по строкам витрины
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    for shop_id, category_id in pairs:
+        CategoryFacet.objects.filter(shop_id=shop_id,
+                                     category_id=category_id).delete()
+        facets = Counter()
+        for parameters in CatalogItem.objects.filter(
+                shop_id=shop_id, category_id=category_id).values_list(
+                'parameters', flat=True).iterator(chunk_size=batch_size):
+            _count_facets(facets, shop_id, category_id, parameters)
+        _create_facets(facets, batch_size)
+
+
+def refresh_catalog_items(product_info_ids, batch_size=None, pairs=()):
+    """
+    Обновляем строки витрины отдельных товаров после правки
+    и фасеты их категорий.
+    pairs - пары (магазин, категория), фасеты которых нужно пересчитать
+    сверх найденных по витрине: строки удаленных товаров к этому времени
+    уже удалены каскадом
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    product_info_ids = sorted(set(product_info_ids))
+    pairs = set(pairs)
+    with transaction.atomic():
+        for start in range(0, len(product_info_ids), batch_size):
+            ids = product_info_ids[start:start + batch_size]
+            items = CatalogItem.objects.filter(pk__in=ids)
+            pairs.update(items.values_list('shop_id', 'category_id'))
+            items.delete()
+            _create_items(iter_catalog_items(
+                ProductInfo.objects.filter(pk__in=ids, is_active=True,
+                                           shop__state=True),
+                batch_size), batch_size)
+            pairs.update(items.values_list('shop_id', 'category_id'))
+        refresh_facets(pairs, batch_size)
+
+
+def _facets_result(rows):
+    """
+    Строки (параметр, значение, число товаров) -> параметр -> значения
+    с числом товаров, самые частые первыми
+    """
+    result = {}
+    for name, value, count in sorted(rows, key=lambda row: (
+            row[0], -row[2], row[1])):
+        result.setdefault(name, []).append({'value': value, 'count': count})
+    return result
+
+
+def category_facets(category_id=None, shop_id=None):
+    """
+    Фасеты из индекса CategoryFacet: параметр -> значения с числом
+    товаров, по категории или всему каталогу, по всем магазинам
+    или по одному
+    """
+    facets = CategoryFacet.objects.all()
+    if category_id:
+        facets = facets.filter(category_id=category_id)
+    if shop_id:
+        facets = facets.filter(shop_id=shop_id)
+    return _facets_result(facets.values_list('parameter', 'value').annotate(
+        total=Sum('count')).order_by())
+
+
+def result_facets(queryset, max_items=None, batch_size=None):
+    """
+    Фасеты произвольной выборки строк витрины: поиск, диапазоны,
+    фильтры по параметрам.
+
+    Считаются не больше чем по max_items строкам выборки, чтобы широкий
+    запрос не группировал параметры всего каталога.
+    В PostgreSQL считаются одним запросом GROUP BY по jsonb_each_text
+    над выборкой, в остальных базах - по строкам в Python
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    queryset = queryset.order_by().values('parameters')
+    if max_items is not None:
+        queryset = queryset[:max_items]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT facet.key, facet.value, COUNT(*) '
+                f'FROM ({sql}) AS items, '
+                'jsonb_each_text(items.parameters) AS facet '
+                'GROUP BY facet.key, facet.value', params)
+            return _facets_result(cursor.fetchall())
+    facets = Counter()
+    for parameters in queryset.values_list('parameters', flat=True).iterator(
+            chunk_size=batch_size):
+        facets.update((name, str(value))
+                      for name, value in parameters.items())
+    return _facets_result((name, value, count)
+                          for (name, value), count in facets.items())
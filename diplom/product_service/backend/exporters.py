@@ -0,0 +1,336 @@
+import csv
+import gzip
+import hashlib
+import io
+import os
+from contextlib import contextmanager
+
+import yaml
+from django.conf import settings
+from django.db.models import F, Sum
+from ujson import dumps as dump_json
+
+from backend.models import ProductInfo, ProductParameter, CategoryFacet, \
+    ExportJob
+from backend.readers import TABLE_COLUMNS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def merge_parameters(goods, parameters):
+    """
+    Сливаем поток строк товаров (id первым полем) с потоком строк
+    (id товара, имя параметра, значение); оба потока упорядочены по id.
+    Возвращает пары (строка товара, словарь параметров)
+    """
+    parameter = next(parameters, None)
+    for row in goods:
+        pk = row[0]
+        dict_parameter = {}
+        while parameter is not None and parameter[0] < pk:
+            parameter = next(parameters, None)
+        while parameter is not None and parameter[0] == pk:
+            dict_parameter[parameter[1]] = parameter[2]
+            parameter = next(parameters, None)
+        yield row, dict_parameter
+
+
+def iter_parameter_rows(product_infos, chunk_size):
+    return ProductParameter.objects.filter(
+        product_info__in=product_infos).order_by(
+        'product_info_id', 'id').values_list(
+        'product_info_id', 'parameter__name', 'value').iterator(
+        chunk_size=chunk_size)
+
+
+def iter_export_goods(shop, chunk_size=None):
+    """
+    Товары магазина для выгрузки, поля как в прайс-листе поставщика.
+
+    Товары и их параметры читаются двумя плоскими потоками строк,
+    упорядоченными по id товара, и сливаются за один проход без создания
+    объектов моделей. В памяти только текущие пачки курсоров.
+    У выключенного магазина товаров нет
+    """
+    if not shop.state:
+        return
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    product_infos = ProductInfo.objects.filter(shop=shop, is_active=True)
+    goods = product_infos.order_by('id').values_list(
+        'id', 'external_id', 'model', 'price', 'price_rrc', 'quantity',
+        'product__name', 'product__category_id').iterator(
+        chunk_size=chunk_size)
+    for row, dict_parameter in merge_parameters(
+            goods, iter_parameter_rows(product_infos, chunk_size)):
+        (_, external_id, model, price, price_rrc, quantity, name,
+         category_id) = row
+        yield {
+            'category': category_id,
+            'name': name,
+            'model': model,
+            'id': external_id,
+            'price': price,
+            'price_rrc': price_rrc,
+            'quantity': quantity,
+            'parameters': dict_parameter,
+        }
+
+
+def export_categories(shop):
+    # у выключенного магазина каталог пустой
+    if not shop.state:
+        return []
+    return [{'id': category_id, 'name': name}
+            for category_id, name in shop.categories.values_list(
+                'id', 'name').order_by('id')]
+
+
+def _chunks(goods, chunk_size):
+    batch = []
+    for good in goods:
+        batch.append(good)
+        if len(batch) >= chunk_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _legacy_good(good):
+    return {('parameter' if key == 'parameters' else key): value
+            for key, value in good.items()}
+
+
+def iter_yaml_export(shop, goods, chunk_size):
+    """
+    Каталог в YAML: магазин, категории, затем товары пачками.
+    Ключи category и parameter оставлены как в прежней выгрузке
+    """
+    yield yaml.safe_dump({
+        'shop': shop.name,
+        'category': export_categories(shop),
+    }, allow_unicode=True, sort_keys=False)
+    yield 'goods:\n'
+    for batch in _chunks(goods, chunk_size):
+        yield yaml.safe_dump([_legacy_good(good) for good in batch],
+                             allow_unicode=True, sort_keys=False)
+
+
+def iter_ndjson_export(shop, goods, chunk_size):
+    """
+    Каталог в JSON Lines, по записи на строку, как при загрузке
+    """
+    lines = [dump_json({'shop': shop.name}, ensure_ascii=False)]
+    lines += [dump_json({'category': category}, ensure_ascii=False)
+              for category in export_categories(shop)]
+    yield '\n'.join(lines) + '\n'
+    for batch in _chunks(goods, chunk_size):
+        yield ''.join(dump_json({'good': good}, ensure_ascii=False) + '\n'
+                      for good in batch)
+
+
+def iter_csv_export(shop, goods, chunk_size):
+    """
+    Каталог в CSV с колонками табличного прайс-листа.
+    Колонки параметров нужны до первой строки, их берем из индекса
+    фасетов магазина: он меньше таблицы параметров товаров и обновляется
+    в одной транзакции с каталогом
+    """
+    categories = {category['id']: category['name']
+                  for category in export_categories(shop)}
+    parameters = list(CategoryFacet.objects.filter(
+        shop_id=shop.id).values_list(
+        'parameter', flat=True).distinct().order_by('parameter'))
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(TABLE_COLUMNS + tuple(parameters))
+    yield buffer.getvalue()
+    for batch in _chunks(goods, chunk_size):
+        buffer.seek(0)
+        buffer.truncate()
+        for good in batch:
+            writer.writerow(
+                [good['id'], good['category'],
+                 categories.get(good['category'], ''), shop.name,
+                 good['name'], good['model'], good['price'],
+                 good['price_rrc'], good['quantity']]
+                + [good['parameters'].get(name, '') for name in parameters])
+        yield buffer.getvalue()
+
+
+# формат -> (Content-Type, генератор текста выгрузки)
+EXPORT_FORMATS = {
+    'yaml': ('application/yaml', iter_yaml_export),
+    'ndjson': ('application/x-ndjson', iter_ndjson_export),
+    'csv': ('text/csv', iter_csv_export),
+}
+
+
+def iter_export(shop, export_format, goods=None, chunk_size=None):
+    """
+    Выгрузка каталога кусками текста, годится и для файла,
+    и для потокового ответа
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    if goods is None:
+        goods = iter_export_goods(shop, chunk_size)
+    _, iter_text = EXPORT_FORMATS[export_format]
+    return iter_text(shop, goods, chunk_size)
+
+
+# сжатие -> (расширение файла, Content-Type)
+EXPORT_COMPRESSIONS = {
+    '': ('', None),
+    'gzip': ('.gz', 'application/gzip'),
+}
+if zstandard is not None:
+    EXPORT_COMPRESSIONS['zstd'] = ('.zst', 'application/zstd')
+
+
+def export_file_path(file):
+    return os.path.join(settings.EXPORT_ROOT, file)
+
+
+def export_content_type(job):
+    content_type = EXPORT_COMPRESSIONS[job.compression][1]
+    if content_type:
+        return content_type
+    return f'{EXPORT_FORMATS[job.format][0]}; charset=utf-8'
+
+
+def export_download_name(job):
+    return (f'catalog-{job.id}.{job.format}'
+            f'{EXPORT_COMPRESSIONS[job.compression][0]}')
+
+
+class HashingFile:
+    """
+    Файл для записи, считающий размер и SHA-256 записанных байт
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+@contextmanager
+def compressed(file, compression):
+    if compression == 'gzip':
+        with gzip.GzipFile(fileobj=file, mode='wb', mtime=0) as output:
+            yield output
+    elif compression == 'zstd':
+        with zstandard.ZstdCompressor().stream_writer(
+                file, closefd=False) as output:
+            yield output
+    else:
+        yield file
+
+
+def export_catalog(job):
+    """
+    Выгружаем каталог магазина в отдельный файл выгрузки.
+    Файл пишется под временным именем и переименовывается в конце,
+    поэтому параллельные выгрузки не мешают друг другу, а недописанный
+    файл никогда не отдается.
+    Возвращает путь к файлу относительно EXPORT_ROOT, число товаров,
+    размер и SHA-256 файла
+    """
+    extension = EXPORT_COMPRESSIONS[job.compression][0]
+    file = os.path.join(str(job.shop_id),
+                        f'{job.id}.{job.format}{extension}')
+    path = export_file_path(file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial_path = f'{path}.part'
+    count = 0
+
+    def counted(goods):
+        nonlocal count
+        for good in goods:
+            count += 1
+            yield good
+
+    try:
+        with open(partial_path, 'wb') as output:
+            hashing = HashingFile(output)
+            with compressed(hashing, job.compression) as sink:
+                for text in iter_export(
+                        job.shop, job.format,
+                        goods=counted(iter_export_goods(job.shop))):
+                    sink.write(text.encode('utf-8'))
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return file, count, hashing.size, hashing.sha256.hexdigest()
+
+
+def iter_file_range(path, start, length, block_size=64 * 1024):
+    """
+    Читаем length байт файла начиная с start
+    """
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            data = file.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def find_snapshot(shop, export_format, compression=''):
+    """
+    Готовая выгрузка текущей версии каталога магазина, если она есть.
+    Выключенный магазин готовых выгрузок не отдает
+    """
+    if not shop.state:
+        return None
+    for job in ExportJob.objects.filter(
+            shop=shop, catalog_version=shop.catalog_version,
+            format=export_format, compression=compression,
+            state='done').exclude(sha256='').order_by('-finished_at'):
+        if os.path.exists(export_file_path(job.file)):
+            return job
+        job.expire()
+    return None
+
+
+def expire_snapshot(job):
+    try:
+        os.remove(export_file_path(job.file))
+    except FileNotFoundError:
+        pass
+    job.expire()
+
+
+def evict_snapshots(max_bytes=None):
+    """
+    Удаляем выгрузки устаревших версий каталога, затем самые старые,
+    пока общий размер файлов больше бюджета
+    """
+    max_bytes = settings.EXPORT_CACHE_MAX_BYTES if max_bytes is None \
+        else max_bytes
+    done = ExportJob.objects.filter(state='done')
+    for job in done.exclude(catalog_version=F('shop__catalog_version')):
+        expire_snapshot(job)
+    total = done.aggregate(total=Sum('size'))['total'] or 0
+    if total <= max_bytes:
+        return
+    for job in done.order_by('finished_at').iterator():
+        expire_snapshot(job)
+        total -= job.size
+        if total <= max_bytes:
+            break
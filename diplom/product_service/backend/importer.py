@@ -0,0 +1,489 @@
+import hashlib
+import json
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from backend import intern
+from backend.versions import bump_catalog_version
+from backend.catalog import refresh_catalog_items
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, \
+    ProductParameter, StagedProductInfo, ImportShard, CatalogItem
+
+
+class ImportInProgress(Exception):
+    """
+    Магазин занят другой загрузкой прайс-листа
+    """
+
+
+def good_fingerprint(item):
+    """
+    Отпечаток товара: цена, количество, модель и параметры.
+    Модель и параметры необязательны
+    """
+    data = [item.get('model', ''), item['price'], item['price_rrc'],
+            item['quantity'],
+            sorted((str(name), str(value))
+                   for name, value in item.get('parameters', {}).items())]
+    return hashlib.md5(json.dumps(data, ensure_ascii=False).encode()
+                       ).hexdigest()
+
+
+def _remember(intern_cache, mapping):
+    """
+    Кладем ключи в кэш процесса только после фиксации транзакции,
+    чтобы не запомнить id откаченных записей
+    """
+    transaction.on_commit(lambda: intern_cache.set_many(mapping))
+
+
+class CatalogImporter:
+    """
+    Пакетная загрузка прайс-листа магазина.
+
+    Существующие категории, продукты и параметры ищутся сначала в кэше
+    процесса (backend.intern), остальные читаются одним запросом на пачку
+    товаров и разрешаются через словари в памяти, а запись идет
+    через bulk_create. Число запросов зависит от количества пачек,
+    а не от количества товаров.
+
+    Новые и изменившиеся товары каждой пачки складываются
+    в StagedProductInfo своей транзакцией вместе с ImportShard, в котором
+    остаются id неизменившихся товаров пачки. Каталог магазина не меняется,
+    пока publish_catalog не перенесет товары одной транзакцией.
+    """
+
+    def __init__(self, shop, import_id=None, batch_size=None, job=None):
+        self.shop = shop
+        self.import_id = import_id or uuid.uuid4().hex
+        self.batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+        intern.sync_all()
+        # ImportJob, в который пишется прогресс по каждой пачке
+        self.job = job
+        self.shop_name = None
+        # (название, id категории) -> id продукта
+        self.products = {}
+        # название параметра -> id параметра
+        self.parameters = {}
+
+    def acquire(self):
+        """
+        Занимаем магазин до публикации или отмены загрузки.
+
+        Вторая загрузка того же магазина, начатая раньше, чем закончилась
+        первая, получает ImportInProgress: иначе каждая публикация сняла бы
+        с продажи товары другой. Брошенную загрузку новая сменяет через
+        IMPORT_LEASE_TIMEOUT секунд
+        """
+        now = timezone.now()
+        taken = Shop.objects.filter(
+            Q(import_id='') | Q(import_id=self.import_id)
+            | Q(import_expires_at__lt=now), pk=self.shop.pk).update(
+            import_id=self.import_id,
+            import_expires_at=now + timedelta(
+                seconds=settings.IMPORT_LEASE_TIMEOUT))
+        if not taken:
+            raise ImportInProgress('Магазин уже загружает другой прайс-лист')
+
+    def run(self, records):
+        """
+        Загружаем записи прайс-листа, полученные из readers.
+
+        Товары копятся в пачки по batch_size, поэтому расход памяти
+        не зависит от размера файла.
+        """
+        self.acquire()
+        categories = []
+        goods = []
+        for section, value in records:
+            if section == 'shop':
+                self.shop_name = value
+            elif section == 'category':
+                categories.append(value)
+            elif section == 'good':
+                if categories:
+                    self.import_categories(categories)
+                    categories = []
+                goods.append(value)
+                if len(goods) >= self.batch_size:
+                    self.stage_goods(goods)
+                    goods = []
+        if categories:
+            self.import_categories(categories)
+        if goods:
+            self.stage_goods(goods)
+
+    def import_categories(self, categories):
+        """
+        Создаем недостающие категории и привязываем их к магазину.
+        Название категории необязательно: у существующей категории
+        оно не меняется
+        """
+        names = {category['id']: category.get('name', '')
+                 for category in categories}
+        if not names:
+            return
+        existing = set(intern.categories.get_many(names))
+        rows = (Category.objects.filter(id__in=names.keys() - existing)
+                .order_by().values_list('id', flat=True))
+        existing.update(rows)
+        Category.objects.bulk_create(
+            [Category(id=category_id, name=name)
+             for category_id, name in names.items()
+             if category_id not in existing],
+            batch_size=self.batch_size)
+        _remember(intern.categories, {category_id: category_id
+                                      for category_id in names})
+        through = Category.shops.through
+        through.objects.bulk_create(
+            [through(category_id=category_id, shop_id=self.shop.id)
+             for category_id in names],
+            batch_size=self.batch_size, ignore_conflicts=True)
+
+    def _resolve_products(self, goods):
+        keys = {(item['name'], item['category']) for item in goods}
+        missing = keys - self.products.keys()
+        if not missing:
+            return
+        self.products.update(intern.products.get_many(missing))
+        missing -= self.products.keys()
+        if not missing:
+            return
+        found = {}
+        rows = (Product.objects
+                .filter(name__in={name for name, _ in missing},
+                        category_id__in={category for _, category in missing})
+                .order_by('id').values_list('name', 'category_id', 'id'))
+        for name, category_id, product_id in rows:
+            if (name, category_id) in missing:
+                found.setdefault((name, category_id), product_id)
+        created = Product.objects.bulk_create(
+            [Product(name=name, category_id=category_id)
+             for name, category_id in missing - found.keys()],
+            batch_size=self.batch_size)
+        for product in created:
+            found[(product.name, product.category_id)] = product.id
+        self.products.update(found)
+        _remember(intern.products, found)
+
+    def _resolve_parameters(self, goods):
+        names = {name for item in goods
+                 for name in item.get('parameters', {})}
+        missing = names - self.parameters.keys()
+        if not missing:
+            return
+        self.parameters.update(intern.parameters.get_many(missing))
+        missing -= self.parameters.keys()
+        if not missing:
+            return
+        found = {}
+        rows = (Parameter.objects.filter(name__in=missing).order_by('id')
+                .values_list('name', 'id'))
+        for name, parameter_id in rows:
+            found.setdefault(name, parameter_id)
+        created = Parameter.objects.bulk_create(
+            [Parameter(name=name) for name in missing - found.keys()],
+            batch_size=self.batch_size)
+        for parameter in created:
+            found[parameter.name] = parameter.id
+        self.parameters.update(found)
+        _remember(intern.parameters, found)
+
+    def stage_goods(self, goods):
+        """
+        Подготавливаем пачку товаров одной транзакцией вместе с ее шардом
+        """
+        self._resolve_products(goods)
+        self._resolve_parameters(goods)
+        with transaction.atomic():
+            shard = ImportShard(import_id=self.import_id,
+                                shop_id=self.shop.id, job=self.job)
+            self.write_shard(shard, goods)
+
+    def write_shard(self, shard, goods):
+        """
+        Складываем новые и изменившиеся товары в промежуточную таблицу,
+        результат пишем в шард.
+
+        Сравниваем отпечатки товаров с текущими: неизменившиеся товары
+        не подготавливаются, в шарде остаются только их id. Продукты
+        и параметры должны быть уже разрешены.
+        """
+        # повторяющиеся товары схлопываем, побеждает последний
+        rows = {}
+        for item in goods:
+            product_id = self.products[(item['name'], item['category'])]
+            rows[(product_id, item['id'])] = item
+        # (id продукта, внешний ИД) -> (id, отпечаток, в продаже)
+        existing = {
+            (product_id, external_id): (pk, fingerprint, is_active)
+            for product_id, external_id, pk, fingerprint, is_active in
+            ProductInfo.objects.filter(
+                shop_id=self.shop.id,
+                product_id__in={product_id for product_id, _ in rows})
+            .order_by().values_list('product_id', 'external_id', 'id',
+                                    'fingerprint', 'is_active')}
+        stats = {'unchanged': 0, 'updated': 0, 'inserted': 0}
+        seen_ids = []
+        staged = []
+        for (product_id, external_id), item in rows.items():
+            fingerprint = good_fingerprint(item)
+            current = existing.get((product_id, external_id))
+            if current is None:
+                stats['inserted'] += 1
+            elif current[1:] == (fingerprint, True):
+                stats['unchanged'] += 1
+                seen_ids.append(current[0])
+                continue
+            else:
+                stats['updated'] += 1
+            staged.append(StagedProductInfo(
+                import_id=self.import_id,
+                shop_id=self.shop.id,
+                product_id=product_id,
+                external_id=external_id,
+                model=item.get('model', ''),
+                price=item['price'],
+                price_rrc=item['price_rrc'],
+                quantity=item['quantity'],
+                fingerprint=fingerprint,
+                parameters={self.parameters[name]: str(value)
+                            for name, value in
+                            item.get('parameters', {}).items()}))
+        StagedProductInfo.objects.bulk_create(staged,
+                                              batch_size=self.batch_size)
+
+        shard.goods = []
+        shard.done = True
+        shard.seen_ids = seen_ids
+        shard.stats = stats
+        shard.save()
+        if self.job:
+            self.job.add_progress(goods=len(goods), rows=len(staged))
+
+
+class ShardedCatalogImporter(CatalogImporter):
+    """
+    Разбиение большого прайс-листа на шарды для параллельной загрузки.
+
+    Товары группируются по категориям, каждый шард сохраняется в ImportShard
+    и подготавливается отдельной задачей, в памяти держится не больше двух
+    шардов. Продукты и параметры создаются здесь же, до записи шарда,
+    чтобы параллельные шарды не создали дубликаты. Если весь прайс-лист
+    умещается в один шард, он подготавливается сразу, без разбиения.
+    """
+
+    def __init__(self, shop, import_id=None, batch_size=None, job=None,
+                 shard_size=None):
+        super().__init__(shop, import_id=import_id, batch_size=batch_size,
+                         job=job)
+        self.shard_size = shard_size or settings.IMPORT_SHARD_SIZE
+        # id категории -> товары, ожидающие записи в шард
+        self.buffers = defaultdict(list)
+        self.buffered = 0
+        self.shard_ids = []
+
+    def run(self, records):
+        """
+        Раскладываем прайс-лист по шардам, возвращаем id шардов,
+        которые еще нужно подготовить
+        """
+        self.acquire()
+        categories = []
+        for section, value in records:
+            if section == 'shop':
+                self.shop_name = value
+            elif section == 'category':
+                categories.append(value)
+            elif section == 'good':
+                if categories:
+                    self.import_categories(categories)
+                    categories = []
+                buffer = self.buffers[value['category']]
+                buffer.append(value)
+                self.buffered += 1
+                if len(buffer) >= self.shard_size:
+                    self._write_shard(value['category'])
+                elif self.buffered >= 2 * self.shard_size:
+                    self._write_shard(max(self.buffers,
+                                          key=lambda key: len(
+                                              self.buffers[key])))
+        if categories:
+            self.import_categories(categories)
+
+        if not self.shard_ids and self.buffered <= self.shard_size:
+            goods = [item for buffer in self.buffers.values()
+                     for item in buffer]
+            for start in range(0, len(goods), self.batch_size):
+                self.stage_goods(goods[start:start + self.batch_size])
+        else:
+            for category_id in list(self.buffers):
+                self._write_shard(category_id)
+        self.buffers.clear()
+        return self.shard_ids
+
+    def _write_shard(self, category_id):
+        goods = self.buffers.pop(category_id)
+        self.buffered -= len(goods)
+        self._resolve_products(goods)
+        self._resolve_parameters(goods)
+        shard = ImportShard.objects.create(import_id=self.import_id,
+                                           shop_id=self.shop.id,
+                                           job=self.job,
+                                           goods=goods)
+        self.shard_ids.append(shard.id)
+
+
+def import_shard(shard_id, batch_size=None):
+    """
+    Подготавливаем товары одного шарда к публикации.
+    Товары и отметка о подготовке шарда сохраняются одной транзакцией,
+    поэтому повторный запуск безопасен
+    """
+    with transaction.atomic():
+        shard = ImportShard.objects.select_for_update(of=('self',)) \
+            .select_related('shop', 'job').filter(pk=shard_id,
+                                                  done=False).first()
+        if shard is None:
+            return
+        importer = CatalogImporter(shard.shop, import_id=shard.import_id,
+                                   batch_size=batch_size, job=shard.job)
+        importer._resolve_products(shard.goods)
+        importer._resolve_parameters(shard.goods)
+        importer.write_shard(shard, shard.goods)
+
+
+def discard_import(import_id):
+    """
+    Удаляем шарды и подготовленные товары незавершенной загрузки
+    и освобождаем магазин. Каталог, витрина и версия каталога остаются
+    прежними
+    """
+    with transaction.atomic():
+        ImportShard.objects.filter(import_id=import_id).delete()
+        StagedProductInfo.objects.filter(import_id=import_id).delete()
+        Shop.objects.filter(import_id=import_id).update(
+            import_id='', import_expires_at=None)
+
+
+def publish_catalog(shop, import_id, shop_name=None, batch_size=None,
+                    job=None):
+    """
+    Публикуем загруженный прайс-лист одной транзакцией.
+
+    Подготовленные шардами новые и изменившиеся товары переносятся
+    в каталог, товары магазина, которых не было в прайс-листе, снимаются
+    с продажи без удаления, чтобы не терять позиции заказов. Увеличивается
+    версия каталога, обновляются строки витрины изменившихся товаров.
+    До фиксации покупатели, корзины и выгрузки видят прежний каталог.
+    Возвращает число неизмененных, обновленных, добавленных и снятых
+    с продажи товаров.
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    stats = {'unchanged': 0, 'updated': 0, 'inserted': 0, 'removed': 0}
+    rows_written = 0
+    with transaction.atomic():
+        # параллельные публикации одного магазина выполняются по очереди
+        shop.state, lease = Shop.objects.select_for_update().filter(
+            pk=shop.pk).values_list('state', 'import_id').get()
+        if lease != import_id:
+            raise ImportInProgress('Магазин занят другой загрузкой')
+        shards = ImportShard.objects.filter(import_id=import_id)
+        if shards.filter(done=False).exists():
+            raise ValueError('Не все шарды загрузки подготовлены')
+        seen = set()
+        for seen_ids, shard_stats in shards.values_list('seen_ids', 'stats'):
+            seen.update(seen_ids)
+            for name, count in shard_stats.items():
+                stats[name] += count
+
+        staged = StagedProductInfo.objects.filter(import_id=import_id)
+        changed_ids = []
+        batch = []
+        for row in staged.order_by('id').iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                rows_written += _publish_batch(shop, batch, changed_ids,
+                                               batch_size)
+                batch = []
+        if batch:
+            rows_written += _publish_batch(shop, batch, changed_ids,
+                                           batch_size)
+        seen.update(changed_ids)
+
+        missing = [pk for pk in ProductInfo.objects.filter(
+            shop_id=shop.id, is_active=True).values_list(
+            'id', flat=True).iterator(chunk_size=batch_size)
+            if pk not in seen]
+        for start in range(0, len(missing), batch_size):
+            ProductInfo.objects.filter(
+                id__in=missing[start:start + batch_size]).update(
+                is_active=False)
+        stats['removed'] = len(missing)
+        rows_written += len(missing)
+
+        # магазин освобождается для следующей загрузки
+        released = {'import_id': '', 'import_expires_at': None}
+        renamed = shop_name and shop.name != shop_name
+        if renamed:
+            shop.name = released['name'] = shop_name
+            CatalogItem.objects.filter(shop_id=shop.id).update(
+                shop_name=shop_name)
+        Shop.objects.filter(pk=shop.pk).update(**released)
+        # прайс-лист без изменений оставляет готовые выгрузки и витрину
+        # актуальными
+        if renamed or changed_ids or missing:
+            bump_catalog_version([shop.id])
+        # строки витрины и поисковые индексы обновляются только
+        # у изменившихся и снятых с продажи товаров
+        refresh_catalog_items(changed_ids + missing, batch_size)
+        shards.delete()
+        staged.delete()
+    if job:
+        job.add_progress(rows=rows_written)
+    return stats
+
+
+def _publish_batch(shop, batch, changed_ids, batch_size):
+    """
+    Переносим пачку подготовленных товаров в каталог магазина,
+    возвращаем число записанных строк
+    """
+    # товар, встретившийся в прайс-листе дважды, берем последним
+    rows = {}
+    for row in batch:
+        rows[(row.product_id, row.external_id)] = row
+    product_infos = ProductInfo.objects.bulk_create(
+        [ProductInfo(product_id=row.product_id,
+                     external_id=row.external_id,
+                     model=row.model,
+                     price=row.price,
+                     price_rrc=row.price_rrc,
+                     quantity=row.quantity,
+                     fingerprint=row.fingerprint,
+                     is_active=True,
+                     shop_id=shop.id)
+         for row in rows.values()],
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['product', 'shop', 'external_id'],
+        update_fields=['model', 'price', 'price_rrc', 'quantity',
+                       'fingerprint', 'is_active'])
+    ids = [product_info.id for product_info in product_infos]
+    # у изменившихся товаров набор параметров мог сократиться
+    ProductParameter.objects.filter(product_info_id__in=ids).delete()
+    product_parameters = ProductParameter.objects.bulk_create(
+        [ProductParameter(product_info_id=product_info.id,
+                          parameter_id=int(parameter_id),
+                          value=value)
+         for product_info, row in zip(product_infos, rows.values())
+         for parameter_id, value in row.parameters.items()],
+        batch_size=batch_size)
+    changed_ids += ids
+    return len(product_infos) + len(product_parameters)
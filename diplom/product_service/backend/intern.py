@@ -0,0 +1,115 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from backend.transactions import on_commit_once
+
+logger = logging.getLogger(__name__)
+
+# алиас CACHES с поколениями кэшей имен
+CACHE_ALIAS = 'intern'
+
+
+class InternCache:
+    """
+    Ограниченный LRU-кэш процесса: натуральный ключ -> первичный ключ.
+
+    Кэш живет в процессе воркера и переиспользуется всеми загрузками.
+    При удалении или изменении записи в любом процессе увеличивается
+    общее поколение в кэше CACHE_ALIAS, и процессы сбрасывают свои
+    копии при следующей сверке.
+
+    Ошибки этого кэша не глотаются: потерянное увеличение поколения
+    оставило бы в других процессах id удаленных записей. Если поколение
+    не удалось прочитать, процесс работает с пустым кэшем.
+    """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.generation_key = f'intern:{name}:generation'
+        self.generation = None
+        # ключ -> id, порядок от давно использованных к недавним
+        self._ids = OrderedDict()
+        # id -> ключ, для инвалидации по первичному ключу
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                pk = self._ids.get(key)
+                if pk is not None:
+                    self._ids.move_to_end(key)
+                    found[key] = pk
+        return found
+
+    def set_many(self, mapping):
+        with self._lock:
+            for key, pk in mapping.items():
+                self._ids[key] = pk
+                self._ids.move_to_end(key)
+                self._keys[pk] = key
+            while len(self._ids) > self.maxsize:
+                _, pk = self._ids.popitem(last=False)
+                self._keys.pop(pk, None)
+
+    def invalidate(self, pk):
+        """
+        Забываем запись в своем процессе и сообщаем остальным
+        """
+        with self._lock:
+            key = self._keys.pop(pk, None)
+            if key is not None:
+                self._ids.pop(key, None)
+        on_commit_once(self._bump_generation)
+
+    def _bump_generation(self, values=()):
+        cache = caches[CACHE_ALIAS]
+        if not cache.add(self.generation_key, 1, timeout=None):
+            try:
+                cache.incr(self.generation_key)
+            except ValueError:
+                cache.add(self.generation_key, 1, timeout=None)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._keys.clear()
+
+    def sync(self):
+        """
+        Сбрасываем кэш, если записи менялись в другом процессе
+        """
+        try:
+            generation = caches[CACHE_ALIAS].get(self.generation_key)
+        except Exception:
+            # без поколения нельзя доверять ни одной записи
+            logger.warning('Не удалось прочитать поколение кэша имен %s',
+                           self.name, exc_info=True)
+            self.clear()
+            self.generation = None
+            return
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+
+# id категории из прайс-листа -> id существующей категории
+categories = InternCache('category', settings.INTERN_CACHE_SIZE)
+# название параметра -> id
+parameters = InternCache('parameter', settings.INTERN_CACHE_SIZE)
+# (название, id категории) -> id продукта
+products = InternCache('product', settings.INTERN_CACHE_SIZE)
+
+
+def sync_all():
+    for intern_cache in (categories, parameters, products):
+        intern_cache.sync()
@@ -0,0 +1,52 @@
+import json
+import platform
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from backend.benchmark import run_benchmark, git_revision
+
+
+class Command(BaseCommand):
+    """
+    Замер импорта и экспорта каталога на синтетических прайс-листах.
+    Данные создаются в настроенной базе и удаляются после замера,
+    запускать только на локальной базе
+    """
+    help = 'Замер импорта и экспорта каталога, отчет в JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--goods', type=int, nargs='+',
+                            default=[1000, 10000, 100000],
+                            help='Размеры прайс-листов')
+        parser.add_argument('--max-parameters', type=int, default=8,
+                            help='Наибольшее число параметров у товара')
+        parser.add_argument('--output', default='benchmark.json',
+                            help='Файл отчета')
+        parser.add_argument('--no-trace-memory', action='store_true',
+                            help='Не замерять память: tracemalloc '
+                                 'замедляет этапы')
+
+    def handle(self, *args, **options):
+        report = {
+            'revision': git_revision(),
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'results': [],
+        }
+        for goods in sorted(options['goods']):
+            for result in run_benchmark(
+                    goods, options['max_parameters'],
+                    trace_memory=not options['no_trace_memory']):
+                report['results'].append(result)
+                self.stdout.write(
+                    f"{result['phase']:>8} {goods:>7} товаров: "
+                    f"{result['wall_time']} с, {result['queries']} запросов, "
+                    f"{result['rows_per_sec']} товаров/с, "
+                    f"память {result.get('peak_memory_kb', '-')} КБ")
+        with open(options['output'], 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(
+            f"Отчет записан в {options['output']}"))
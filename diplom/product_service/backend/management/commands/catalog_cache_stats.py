@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from backend.caching import catalog_cache, CACHED_VIEWS
+
+
+class Command(BaseCommand):
+    """
+    Попадания и промахи кэша ответов /products, /shops и /categories
+    и число ответов 304 с момента последнего сброса счетчиков
+    """
+    help = 'Статистика кэша ответов каталога'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help='Сбросить счетчики после вывода')
+
+    def handle(self, *args, **options):
+        for view_name, counters in catalog_cache.stats(CACHED_VIEWS).items():
+            total = counters['hits'] + counters['misses']
+            ratio = counters['hits'] / total if total else 0
+            self.stdout.write(
+                f"{view_name:>10}: попаданий {counters['hits']}, "
+                f"промахов {counters['misses']}, доля попаданий "
+                f"{ratio:.1%}, ответов 304 {counters['not_modified']}")
+        if options['reset']:
+            catalog_cache.reset_stats(CACHED_VIEWS)
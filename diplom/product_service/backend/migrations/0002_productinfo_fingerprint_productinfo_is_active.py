@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 08:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productinfo',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=32, verbose_name='Отпечаток'),
+        ),
+        migrations.AddField(
+            model_name='productinfo',
+            name='is_active',
+            field=models.BooleanField(default=True, verbose_name='В продаже'),
+        ),
+    ]
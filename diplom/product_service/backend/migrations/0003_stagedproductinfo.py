@@ -0,0 +1,34 @@
+# Generated by Django 5.0.2 on 2026-10-18 08:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0002_productinfo_fingerprint_productinfo_is_active'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedProductInfo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('import_id', models.CharField(db_index=True, max_length=36, verbose_name='ИД загрузки')),
+                ('external_id', models.PositiveIntegerField(verbose_name='Внешний ИД')),
+                ('model', models.CharField(blank=True, max_length=80, verbose_name='Модель')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+                ('price', models.PositiveIntegerField(verbose_name='Цена')),
+                ('price_rrc', models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')),
+                ('fingerprint', models.CharField(max_length=32, verbose_name='Отпечаток')),
+                ('parameters', models.JSONField(default=dict, verbose_name='Параметры')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='staged_product_infos', to='backend.product', verbose_name='Продукт')),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='staged_product_infos', to='backend.shop', verbose_name='Магазин')),
+            ],
+            options={
+                'verbose_name': 'Подготовленный товар',
+                'verbose_name_plural': 'Список подготовленных товаров',
+            },
+        ),
+    ]
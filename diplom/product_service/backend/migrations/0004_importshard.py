@@ -0,0 +1,27 @@
+# Generated by Django 5.0.2 on 2026-10-18 08:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0003_stagedproductinfo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('import_id', models.CharField(db_index=True, max_length=36, verbose_name='ИД загрузки')),
+                ('goods', models.JSONField(default=list, verbose_name='Товары')),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='import_shards', to='backend.shop', verbose_name='Магазин')),
+            ],
+            options={
+                'verbose_name': 'Шард загрузки',
+                'verbose_name_plural': 'Список шардов загрузки',
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.0.2 on 2026-10-18 08:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0004_importshard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(verbose_name='Ссылка')),
+                ('state', models.CharField(choices=[('new', 'Новая'), ('running', 'Выполняется'), ('done', 'Завершена'), ('failed', 'Ошибка')], default='new', max_length=15, verbose_name='Статус')),
+                ('goods_processed', models.PositiveIntegerField(default=0, verbose_name='Обработано товаров')),
+                ('rows_written', models.PositiveIntegerField(default=0, verbose_name='Записано строк')),
+                ('errors', models.JSONField(blank=True, default=list, verbose_name='Ошибки')),
+                ('result', models.JSONField(blank=True, default=dict, verbose_name='Результат')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('shop', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='import_jobs', to='backend.shop', verbose_name='Магазин')),
+            ],
+            options={
+                'verbose_name': 'Загрузка прайс-листа',
+                'verbose_name_plural': 'Список загрузок прайс-листов',
+                'ordering': ('-created_at',),
+            },
+        ),
+        migrations.AddField(
+            model_name='importshard',
+            name='job',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='backend.importjob', verbose_name='Загрузка'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0005_importjob_importshard_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(default='yaml', max_length=10, verbose_name='Формат')),
+                ('state', models.CharField(choices=[('new', 'Новая'), ('running', 'Выполняется'), ('done', 'Завершена'), ('failed', 'Ошибка')], default='new', max_length=15, verbose_name='Статус')),
+                ('file', models.CharField(blank=True, max_length=255, verbose_name='Файл')),
+                ('goods_exported', models.PositiveIntegerField(default=0, verbose_name='Выгружено товаров')),
+                ('size', models.PositiveBigIntegerField(default=0, verbose_name='Размер файла')),
+                ('errors', models.JSONField(blank=True, default=list, verbose_name='Ошибки')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='export_jobs', to='backend.shop', verbose_name='Магазин')),
+            ],
+            options={
+                'verbose_name': 'Выгрузка каталога',
+                'verbose_name_plural': 'Список выгрузок каталога',
+                'ordering': ('-created_at',),
+            },
+        ),
+    ]
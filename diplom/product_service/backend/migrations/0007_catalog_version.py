@@ -0,0 +1,32 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0006_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='catalog_version',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Версия каталога'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='catalog_version',
+            field=models.PositiveIntegerField(default=0, verbose_name='Версия каталога'),
+        ),
+        migrations.AlterField(
+            model_name='exportjob',
+            name='state',
+            field=models.CharField(choices=[('new', 'Новая'), ('running', 'Выполняется'), ('done', 'Завершена'), ('failed', 'Ошибка'), ('expired', 'Устарела')], default='new', max_length=15, verbose_name='Статус'),
+        ),
+        migrations.AddIndex(
+            model_name='exportjob',
+            index=models.Index(fields=['shop', 'catalog_version', 'format'], name='export_snapshot_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0007_catalog_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='compression',
+            field=models.CharField(blank=True, default='', max_length=10, verbose_name='Сжатие'),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64, verbose_name='Контрольная сумма SHA-256'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_catalog(apps, schema_editor):
+    """
+    Заполняем витрину товарами в продаже у включенных магазинов
+    """
+    ProductInfo = apps.get_model('backend', 'ProductInfo')
+    ProductParameter = apps.get_model('backend', 'ProductParameter')
+    CatalogItem = apps.get_model('backend', 'CatalogItem')
+    goods = ProductInfo.objects.filter(
+        is_active=True, shop__state=True).order_by('id').values_list(
+        'id', 'shop_id', 'shop__name', 'product__category_id',
+        'product__category__name', 'product__name', 'model', 'external_id',
+        'quantity', 'price', 'price_rrc').iterator(chunk_size=1000)
+    batch = []
+
+    def flush():
+        parameters = {}
+        for product_info_id, name, value in ProductParameter.objects.filter(
+                product_info_id__in=[row[0] for row in batch]).order_by(
+                'product_info_id', 'id').values_list(
+                'product_info_id', 'parameter__name', 'value'):
+            parameters.setdefault(product_info_id, {})[name] = value
+        CatalogItem.objects.bulk_create(
+            CatalogItem(product_info_id=row[0], shop_id=row[1],
+                        shop_name=row[2], category_id=row[3],
+                        category_name=row[4] or '', product_name=row[5],
+                        model=row[6], external_id=row[7], quantity=row[8],
+                        price=row[9], price_rrc=row[10],
+                        parameters=parameters.get(row[0], {}))
+            for row in batch)
+        batch.clear()
+
+    for row in goods:
+        batch.append(row)
+        if len(batch) >= 1000:
+            flush()
+    if batch:
+        flush()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0008_export_compression'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogItem',
+            fields=[
+                ('product_info', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='catalog_item', serialize=False, to='backend.productinfo', verbose_name='Информация о продукте')),
+                ('shop_name', models.CharField(max_length=50, verbose_name='Магазин')),
+                ('category_name', models.CharField(blank=True, max_length=40, verbose_name='Категория')),
+                ('product_name', models.CharField(max_length=80, verbose_name='Название')),
+                ('model', models.CharField(blank=True, max_length=80, verbose_name='Модель')),
+                ('external_id', models.PositiveIntegerField(verbose_name='Внешний ИД')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+                ('price', models.PositiveIntegerField(verbose_name='Цена')),
+                ('price_rrc', models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')),
+                ('parameters', models.JSONField(default=dict, verbose_name='Параметры')),
+                ('category', models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='catalog_items', to='backend.category', verbose_name='Категория')),
+                ('shop', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='catalog_items', to='backend.shop', verbose_name='Магазин')),
+            ],
+            options={
+                'verbose_name': 'Строка витрины',
+                'verbose_name_plural': 'Витрина каталога',
+                'indexes': [models.Index(fields=['shop', 'product_info'], name='catalog_shop_idx'), models.Index(fields=['category', 'product_info'], name='catalog_category_idx'), models.Index(fields=['price', 'product_info'], name='catalog_price_idx')],
+            },
+        ),
+        migrations.RunPython(build_catalog, migrations.RunPython.noop),
+    ]
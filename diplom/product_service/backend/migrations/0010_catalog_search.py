@@ -0,0 +1,65 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:34
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+def fill_search_text(apps, schema_editor):
+    """
+    Текст для поиска у существующих строк витрины
+    """
+    CatalogItem = apps.get_model('backend', 'CatalogItem')
+    batch = []
+    for item in CatalogItem.objects.order_by('pk').only(
+            'pk', 'product_name', 'model', 'parameters').iterator(
+            chunk_size=1000):
+        item.search_text = ' '.join(
+            [item.product_name, item.model,
+             *map(str, item.parameters.values())]).lower()
+        batch.append(item)
+        if len(batch) >= 1000:
+            CatalogItem.objects.bulk_update(batch, ['search_text'])
+            batch = []
+    if batch:
+        CatalogItem.objects.bulk_update(batch, ['search_text'])
+
+
+def create_search_indexes(apps, schema_editor):
+    """
+    GIN-индексы полнотекстового и триграммного поиска, только в PostgreSQL.
+    Выражение индекса совпадает с SearchVector в backend/search.py
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "CREATE INDEX catalog_search_idx ON backend_catalogitem "
+        "USING gin (to_tsvector('russian'::regconfig, "
+        "COALESCE(search_text, '')))")
+    schema_editor.execute(
+        "CREATE INDEX catalog_search_trgm_idx ON backend_catalogitem "
+        "USING gin (search_text gin_trgm_ops)")
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS catalog_search_idx')
+    schema_editor.execute('DROP INDEX IF EXISTS catalog_search_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0009_catalogitem'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='catalogitem',
+            name='search_text',
+            field=models.TextField(blank=True, default='', verbose_name='Текст для поиска'),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
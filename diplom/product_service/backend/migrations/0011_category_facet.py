@@ -0,0 +1,69 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:35
+
+from collections import Counter
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_facets(apps, schema_editor):
+    """
+    Фасеты по существующим строкам витрины
+    """
+    CatalogItem = apps.get_model('backend', 'CatalogItem')
+    CategoryFacet = apps.get_model('backend', 'CategoryFacet')
+    facets = Counter()
+    for shop_id, category_id, parameters in CatalogItem.objects.values_list(
+            'shop_id', 'category_id', 'parameters').iterator(chunk_size=1000):
+        for name, value in parameters.items():
+            facets[shop_id, category_id, name, value] += 1
+    CategoryFacet.objects.bulk_create(
+        (CategoryFacet(shop_id=shop_id, category_id=category_id,
+                       parameter=name, value=value, count=count)
+         for (shop_id, category_id, name, value), count in facets.items()),
+        batch_size=1000)
+
+
+def create_parameters_index(apps, schema_editor):
+    """
+    GIN-индекс для отбора по параметрам условием @>, только в PostgreSQL
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX catalog_parameters_idx ON backend_catalogitem '
+        'USING gin (parameters jsonb_path_ops)')
+
+
+def drop_parameters_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS catalog_parameters_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0010_catalog_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('parameter', models.CharField(max_length=40, verbose_name='Параметр')),
+                ('value', models.CharField(max_length=100, verbose_name='Значение')),
+                ('count', models.PositiveIntegerField(verbose_name='Количество товаров')),
+                ('category', models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='facets', to='backend.category', verbose_name='Категория')),
+                ('shop', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='facets', to='backend.shop', verbose_name='Магазин')),
+            ],
+            options={
+                'verbose_name': 'Фасет категории',
+                'verbose_name_plural': 'Фасеты категорий',
+                'indexes': [models.Index(fields=['category', 'shop'], name='facet_category_idx'), models.Index(fields=['shop', 'category'], name='facet_shop_idx')],
+            },
+        ),
+        migrations.RunPython(build_facets, migrations.RunPython.noop),
+        migrations.RunPython(create_parameters_index, drop_parameters_index),
+    ]
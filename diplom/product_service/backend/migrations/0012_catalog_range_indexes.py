@@ -0,0 +1,29 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0011_category_facet'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(fields=['category', 'price', 'product_info'], name='catalog_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(fields=['shop', 'price', 'product_info'], name='catalog_shop_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(fields=['price_rrc', 'product_info'], name='catalog_price_rrc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(fields=['quantity', 'product_info'], name='catalog_quantity_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0013_index_audit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importshard',
+            name='done',
+            field=models.BooleanField(default=False, verbose_name='Подготовлен'),
+        ),
+        migrations.AddField(
+            model_name='importshard',
+            name='seen_ids',
+            field=models.JSONField(default=list, verbose_name='Неизменившиеся товары'),
+        ),
+        migrations.AddField(
+            model_name='importshard',
+            name='stats',
+            field=models.JSONField(default=dict, verbose_name='Счетчики'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='import_expires_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Загрузка занимает магазин до'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='import_id',
+            field=models.CharField(blank=True, max_length=36, verbose_name='ИД выполняющейся загрузки'),
+        ),
+    ]
@@ -3,6 +3,7 @@ from django.contrib.auth.models import AbstractUser, UserManager, \
     PermissionsMixin
 from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
 from django.contrib.auth.models import User
@@ -17,6 +18,17 @@ STATE_CHOICES = (
     ('canceled', 'Отменен'),
 )
 
+IMPORT_STATE_CHOICES = (
+    ('new', 'Новая'),
+    ('running', 'Выполняется'),
+    ('done', 'Завершена'),
+    ('failed', 'Ошибка'),
+)
+
+EXPORT_STATE_CHOICES = IMPORT_STATE_CHOICES + (
+    ('expired', 'Устарела'),
+)
+
 USER_TYPE_CHOICES = (
     ('shop', 'Магазин'),
     ('buyer', 'Покупатель'),
@@ -113,6 +125,15 @@ class Shop(models.Model):
                                 on_delete=models.CASCADE)
     state = models.BooleanField(verbose_name='статус получения заказов',
                                 default=True)
+    # увеличивается при каждой публикации прайс-листа и правке каталога
+    catalog_version = models.PositiveIntegerField(
+        verbose_name='Версия каталога', default=0)
+    # загрузка прайс-листа, занявшая магазин, и срок, после которого
+    # брошенную загрузку может сменить новая
+    import_id = models.CharField(max_length=36, blank=True,
+                                 verbose_name='ИД выполняющейся загрузки')
+    import_expires_at = models.DateTimeField(
+        verbose_name='Загрузка занимает магазин до', null=True, blank=True)
 
     class Meta:
         verbose_name = 'Магазин'
@@ -149,6 +170,10 @@ class Product(models.Model):
         verbose_name = 'Продукт'
         verbose_name_plural = "Список продуктов"
         ordering = ('-name',)
+        indexes = [
+            # поиск продуктов по имени при загрузке прайс-листа
+            models.Index(fields=['name', 'category'], name='product_name_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -168,8 +193,9 @@ class ProductInfo(models.Model):
     price = models.PositiveIntegerField(verbose_name='Цена')
     price_rrc = models.PositiveIntegerField(
         verbose_name='Рекомендуемая розничная цена')
-
-
+    fingerprint = models.CharField(max_length=32, verbose_name='Отпечаток',
+                                   blank=True)
+    is_active = models.BooleanField(verbose_name='В продаже', default=True)
 
     class Meta:
         verbose_name = 'Информация о продукте'
@@ -178,10 +204,315 @@ class ProductInfo(models.Model):
             models.UniqueConstraint(fields=['product', 'shop', 'external_id'],
                                     name='unique_product_info'),
         ]
+        indexes = [
+            # товары магазина в продаже по порядку id: выгрузка и витрина
+            models.Index(fields=['shop', 'is_active', 'id'],
+                         name='product_info_shop_idx'),
+        ]
     # def __str__(self):
     #     return self.model
 
 
+class ImportJob(models.Model):
+    """
+    Загрузка прайс-листа: состояние, прогресс и скорость
+    """
+    objects = models.manager.Manager()
+    # у проверки прайс-листа магазина может еще не быть
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='import_jobs', null=True,
+                             blank=True, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, verbose_name='Пользователь',
+                             related_name='import_jobs', null=True,
+                             blank=True, on_delete=models.CASCADE)
+    url = models.URLField(verbose_name='Ссылка')
+    # только проверка прайс-листа: в result пишется отчет validation,
+    # каталог не меняется
+    dry_run = models.BooleanField(verbose_name='Только проверка',
+                                  default=False)
+    state = models.CharField(verbose_name='Статус',
+                             choices=IMPORT_STATE_CHOICES, max_length=15,
+                             default='new')
+    goods_processed = models.PositiveIntegerField(
+        verbose_name='Обработано товаров', default=0)
+    rows_written = models.PositiveIntegerField(verbose_name='Записано строк',
+                                               default=0)
+    errors = models.JSONField(verbose_name='Ошибки', default=list,
+                              blank=True)
+    result = models.JSONField(verbose_name='Результат', default=dict,
+                              blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Загрузка прайс-листа'
+        verbose_name_plural = "Список загрузок прайс-листов"
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f'{self.shop_id} {self.created_at}'
+
+    @property
+    def elapsed(self):
+        """
+        Время выполнения в секундах
+        """
+        if not self.started_at:
+            return 0
+        finished_at = self.finished_at or timezone.now()
+        return (finished_at - self.started_at).total_seconds()
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        return round(self.rows_written / elapsed, 1) if elapsed else 0
+
+    def add_progress(self, goods=0, rows=0):
+        """
+        Увеличиваем счетчики одним запросом, безопасно для параллельных шардов
+        """
+        ImportJob.objects.filter(pk=self.pk).update(
+            goods_processed=models.F('goods_processed') + goods,
+            rows_written=models.F('rows_written') + rows)
+
+    def start(self):
+        self.state = 'running'
+        self.started_at = timezone.now()
+        self.save(update_fields=['state', 'started_at'])
+
+    def finish(self, result):
+        self.refresh_from_db(fields=['goods_processed', 'rows_written'])
+        self.state = 'done'
+        self.result = result
+        self.finished_at = timezone.now()
+        self.save(update_fields=['state', 'result', 'finished_at'])
+
+    def fail(self, error):
+        self.refresh_from_db(fields=['goods_processed', 'rows_written',
+                                     'errors'])
+        self.state = 'failed'
+        self.errors.append(str(error))
+        self.finished_at = timezone.now()
+        self.save(update_fields=['state', 'errors', 'finished_at'])
+
+
+class CatalogItem(models.Model):
+    """
+    Витрина каталога: одна строка на предложение магазина со всеми
+    данными для выдачи /products, без соединений и подзапросов.
+    Строятся только товары в продаже у включенных магазинов
+    """
+    objects = models.manager.Manager()
+    product_info = models.OneToOneField(ProductInfo, primary_key=True,
+                                        verbose_name='Информация о продукте',
+                                        related_name='catalog_item',
+                                        on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='catalog_items', db_index=False,
+                             on_delete=models.CASCADE)
+    shop_name = models.CharField(max_length=50, verbose_name='Магазин')
+    category = models.ForeignKey(Category, verbose_name='Категория',
+                                 related_name='catalog_items', null=True,
+                                 db_index=False, on_delete=models.CASCADE)
+    category_name = models.CharField(max_length=40, verbose_name='Категория',
+                                     blank=True)
+    product_name = models.CharField(max_length=80, verbose_name='Название')
+    model = models.CharField(max_length=80, verbose_name='Модель', blank=True)
+    external_id = models.PositiveIntegerField(verbose_name='Внешний ИД')
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    price = models.PositiveIntegerField(verbose_name='Цена')
+    price_rrc = models.PositiveIntegerField(
+        verbose_name='Рекомендуемая розничная цена')
+    # имя параметра -> значение
+    parameters = models.JSONField(verbose_name='Параметры', default=dict)
+    # название, модель и значения параметров в нижнем регистре, в PostgreSQL
+    # по нему построены полнотекстовый и триграммный индексы, см. search.py
+    search_text = models.TextField(verbose_name='Текст для поиска',
+                                   blank=True, default='')
+
+    class Meta:
+        verbose_name = 'Строка витрины'
+        verbose_name_plural = "Витрина каталога"
+        indexes = [
+            # фильтры /products с постраничным выводом по ключу
+            models.Index(fields=['shop', 'product_info'],
+                         name='catalog_shop_idx'),
+            models.Index(fields=['category', 'product_info'],
+                         name='catalog_category_idx'),
+            models.Index(fields=['price', 'product_info'],
+                         name='catalog_price_idx'),
+            # диапазон и сортировка по цене внутри категории и магазина
+            models.Index(fields=['category', 'price', 'product_info'],
+                         name='catalog_category_price_idx'),
+            models.Index(fields=['shop', 'price', 'product_info'],
+                         name='catalog_shop_price_idx'),
+            models.Index(fields=['price_rrc', 'product_info'],
+                         name='catalog_price_rrc_idx'),
+            models.Index(fields=['quantity', 'product_info'],
+                         name='catalog_quantity_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.shop_name} {self.product_name}'
+
+
+class CategoryFacet(models.Model):
+    """
+    Индекс фасетов: сколько товаров магазина в категории имеют значение
+    параметра. Собирается вместе с витриной, по нему считаются фасеты
+    /products без группировки по таблице параметров
+    """
+    objects = models.manager.Manager()
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='facets', db_index=False,
+                             on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, verbose_name='Категория',
+                                 related_name='facets', null=True,
+                                 db_index=False, on_delete=models.CASCADE)
+    parameter = models.CharField(max_length=40, verbose_name='Параметр')
+    value = models.CharField(max_length=100, verbose_name='Значение')
+    count = models.PositiveIntegerField(verbose_name='Количество товаров')
+
+    class Meta:
+        verbose_name = 'Фасет категории'
+        verbose_name_plural = "Фасеты категорий"
+        indexes = [
+            models.Index(fields=['category', 'shop'],
+                         name='facet_category_idx'),
+            models.Index(fields=['shop', 'category'], name='facet_shop_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.parameter}: {self.value} ({self.count})'
+
+
+class ExportJob(models.Model):
+    """
+    Выгрузка каталога магазина в файл
+    """
+    objects = models.manager.Manager()
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='export_jobs',
+                             on_delete=models.CASCADE)
+    format = models.CharField(verbose_name='Формат', max_length=10,
+                              default='yaml')
+    # '', 'gzip' или 'zstd'
+    compression = models.CharField(verbose_name='Сжатие', max_length=10,
+                                   default='', blank=True)
+    # версия каталога магазина, с которой снята выгрузка
+    catalog_version = models.PositiveIntegerField(
+        verbose_name='Версия каталога', null=True, blank=True)
+    state = models.CharField(verbose_name='Статус',
+                             choices=EXPORT_STATE_CHOICES, max_length=15,
+                             default='new')
+    # путь относительно settings.EXPORT_ROOT
+    file = models.CharField(verbose_name='Файл', max_length=255, blank=True)
+    goods_exported = models.PositiveIntegerField(
+        verbose_name='Выгружено товаров', default=0)
+    size = models.PositiveBigIntegerField(verbose_name='Размер файла',
+                                          default=0)
+    sha256 = models.CharField(verbose_name='Контрольная сумма SHA-256',
+                              max_length=64, blank=True)
+    errors = models.JSONField(verbose_name='Ошибки', default=list,
+                              blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Выгрузка каталога'
+        verbose_name_plural = "Список выгрузок каталога"
+        ordering = ('-created_at',)
+        indexes = [
+            models.Index(fields=['shop', 'catalog_version', 'format'],
+                         name='export_snapshot_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.shop_id} {self.created_at}'
+
+    def start(self, catalog_version=None):
+        self.state = 'running'
+        self.catalog_version = catalog_version
+        self.started_at = timezone.now()
+        self.save(update_fields=['state', 'catalog_version', 'started_at'])
+
+    def finish(self, file, goods_exported, size, sha256):
+        self.state = 'done'
+        self.file = file
+        self.goods_exported = goods_exported
+        self.size = size
+        self.sha256 = sha256
+        self.finished_at = timezone.now()
+        self.save(update_fields=['state', 'file', 'goods_exported', 'size',
+                                 'sha256', 'finished_at'])
+
+    def fail(self, error):
+        self.state = 'failed'
+        self.errors.append(str(error))
+        self.finished_at = timezone.now()
+        self.save(update_fields=['state', 'errors', 'finished_at'])
+
+    def expire(self):
+        self.state = 'expired'
+        self.save(update_fields=['state'])
+
+
+class StagedProductInfo(models.Model):
+    """
+    Промежуточная таблица загрузки прайс-листа: новые и изменившиеся
+    товары. В каталог они попадают только при публикации загрузки
+    """
+    objects = models.manager.Manager()
+    import_id = models.CharField(max_length=36, verbose_name='ИД загрузки',
+                                 db_index=True)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='staged_product_infos',
+                             on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, verbose_name='Продукт',
+                                related_name='staged_product_infos',
+                                on_delete=models.CASCADE)
+    external_id = models.PositiveIntegerField(verbose_name='Внешний ИД')
+    model = models.CharField(max_length=80, verbose_name='Модель', blank=True)
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    price = models.PositiveIntegerField(verbose_name='Цена')
+    price_rrc = models.PositiveIntegerField(
+        verbose_name='Рекомендуемая розничная цена')
+    fingerprint = models.CharField(max_length=32, verbose_name='Отпечаток')
+    # id параметра -> значение
+    parameters = models.JSONField(verbose_name='Параметры', default=dict)
+
+    class Meta:
+        verbose_name = 'Подготовленный товар'
+        verbose_name_plural = "Список подготовленных товаров"
+
+
+class ImportShard(models.Model):
+    """
+    Часть прайс-листа, которую подготавливает отдельная задача.
+    После подготовки товары шарда очищаются, а для публикации остаются
+    id неизменившихся товаров шарда и счетчики
+    """
+    objects = models.manager.Manager()
+    import_id = models.CharField(max_length=36, verbose_name='ИД загрузки',
+                                 db_index=True)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='import_shards',
+                             on_delete=models.CASCADE)
+    job = models.ForeignKey(ImportJob, verbose_name='Загрузка',
+                            related_name='shards', null=True, blank=True,
+                            on_delete=models.CASCADE)
+    goods = models.JSONField(verbose_name='Товары', default=list)
+    done = models.BooleanField(verbose_name='Подготовлен', default=False)
+    seen_ids = models.JSONField(verbose_name='Неизменившиеся товары',
+                                default=list)
+    stats = models.JSONField(verbose_name='Счетчики', default=dict)
+
+    class Meta:
+        verbose_name = 'Шард загрузки'
+        verbose_name_plural = "Список шардов загрузки"
+
 
 class Parameter(models.Model):
     objects = models.manager.Manager()
@@ -191,6 +522,9 @@ class Parameter(models.Model):
         verbose_name = 'Имя параметра'
         verbose_name_plural = "Список имен параметров"
         ordering = ('-name',)
+        indexes = [
+            models.Index(fields=['name'], name='parameter_name_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -216,6 +550,11 @@ class ProductParameter(models.Model):
             models.UniqueConstraint(fields=['product_info', 'parameter'],
                                     name='unique_product_parameter'),
         ]
+        indexes = [
+            # параметры пачки товаров по порядку id товара
+            models.Index(fields=['product_info', 'id'],
+                         name='product_parameter_info_idx'),
+        ]
 
 
 class Contact(models.Model):
@@ -259,6 +598,10 @@ class Order(models.Model):
         verbose_name = 'Заказ'
         verbose_name_plural = "Список заказ"
         ordering = ('-dt',)
+        indexes = [
+            # корзина пользователя и его заказы
+            models.Index(fields=['user', 'state'], name='order_user_state_idx'),
+        ]
 
     def __str__(self):
         return str(self.dt)
@@ -0,0 +1,144 @@
+from base64 import b64decode, b64encode
+from binascii import Error as Base64Error
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from ujson import dumps as dump_json, loads as load_json
+
+
+def keyset_filter(ordering, position):
+    """
+    Условие "строка после position" для сортировки ordering:
+    (a, b) > (x, y) как a >= x AND (a > x OR b > y).
+    Первое сравнение отдельно, чтобы база шла по индексу диапазоном
+    от позиции, а не перебирала строки с меньшими значениями
+    """
+    name, value = ordering[0], position[0]
+    if name.startswith('-'):
+        name, after, at_or_after = name[1:], 'lt', 'lte'
+    else:
+        after, at_or_after = 'gt', 'gte'
+    if len(ordering) == 1:
+        return Q(**{f'{name}__{after}': value})
+    return Q(**{f'{name}__{at_or_after}': value}) & (
+        Q(**{f'{name}__{after}': value})
+        | keyset_filter(ordering[1:], position[1:]))
+
+
+def invert(ordering):
+    return tuple(name[1:] if name.startswith('-') else f'-{name}'
+                 for name in ordering)
+
+
+class ProductCursorPagination(BasePagination):
+    """
+    Постраничный вывод каталога по ключу (keyset).
+
+    Курсор хранит значения всех полей сортировки последней (первой)
+    строки страницы, и следующая страница выбирается условием
+    (price, pk) > (x, y), а не смещением. Дальние страницы стоят столько же,
+    сколько первая, в том числе среди тысяч строк с одной ценой или
+    количеством, и COUNT(*) по всей таблице не выполняется.
+    Ответ как у CursorPagination DRF: next, previous и results
+    """
+    page_size = settings.PRODUCTS_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.PRODUCTS_MAX_PAGE_SIZE
+    cursor_query_param = 'cursor'
+    ordering_param = 'ordering'
+    invalid_cursor_message = 'Неверный курсор'
+    # значение параметра ordering -> сортировка, первичный ключ - последний,
+    # чтобы порядок был однозначным
+    orderings = {
+        'id': ('pk',),
+        'price': ('price', 'pk'),
+        '-price': ('-price', '-pk'),
+        'price_rrc': ('price_rrc', 'pk'),
+        '-price_rrc': ('-price_rrc', '-pk'),
+        'quantity': ('quantity', 'pk'),
+        '-quantity': ('-quantity', '-pk'),
+    }
+    ordering = orderings['id']
+
+    def get_ordering(self, request, queryset, view):
+        return self.orderings.get(
+            request.query_params.get(self.ordering_param), self.ordering)
+
+    def get_page_size(self, request):
+        value = request.query_params.get(self.page_size_query_param, '')
+        if value.isdigit() and int(value) > 0:
+            return min(int(value), self.max_page_size)
+        return self.page_size
+
+    def decode_cursor(self, request):
+        """
+        Курсор - направление и значения полей сортировки строки,
+        после которой начинается страница
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return False, None
+        try:
+            reverse, position = load_json(b64decode(encoded.encode('ascii'),
+                                                    validate=True))
+        except (UnicodeEncodeError, Base64Error, ValueError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+        if (not isinstance(position, list)
+                or len(position) != len(self.ordering)
+                or not all(isinstance(value, int) and
+                           not isinstance(value, bool)
+                           for value in position)):
+            raise NotFound(self.invalid_cursor_message)
+        return bool(reverse), position
+
+    def encode_cursor(self, reverse, row):
+        position = [row[name.lstrip('-')] if isinstance(row, dict)
+                    else getattr(row, name.lstrip('-'))
+                    for name in self.ordering]
+        encoded = b64encode(dump_json([int(reverse), position]).encode())
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   encoded.decode('ascii'))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        reverse, position = self.decode_cursor(request)
+        # назад идем обратной сортировкой от первой строки страницы
+        ordering = invert(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(keyset_filter(ordering, position))
+        page_size = self.get_page_size(request)
+        rows = list(queryset[:page_size + 1])
+        has_more = len(rows) > page_size
+        self.page = rows[:page_size]
+        if reverse:
+            self.page.reverse()
+        self.has_next = has_more if not reverse else position is not None
+        self.has_previous = position is not None if not reverse else has_more
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            # назад от первой строки ничего не нашлось: следующая страница
+            # начинается с начала
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(False, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(True, self.page[0])
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
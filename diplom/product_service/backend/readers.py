@@ -0,0 +1,389 @@
+import csv
+import io
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from itertools import chain
+from urllib.parse import urlsplit
+from zipfile import BadZipFile
+
+import yaml
+from django.conf import settings
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+from requests import get
+from ujson import loads as load_json
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+class PriceListError(Exception):
+    """
+    Прайс-лист не удалось скачать или разобрать
+    """
+
+
+class LimitedStream:
+    """
+    Файлоподобная обертка над ответом requests с ограничением
+    на размер и время скачивания
+    """
+
+    def __init__(self, response, max_bytes, timeout):
+        self.url = response.url
+        self.content_type = response.headers.get('Content-Type', '')
+        self._chunks = response.iter_content(chunk_size=64 * 1024)
+        self._buffer = bytearray()
+        self.max_bytes = max_bytes
+        self.deadline = time.monotonic() + timeout
+        self.read_bytes = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            if time.monotonic() > self.deadline:
+                raise PriceListError('Превышено время загрузки прайс-листа')
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self.read_bytes += len(chunk)
+            if self.read_bytes > self.max_bytes:
+                raise PriceListError('Превышен размер прайс-листа')
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    # чтобы обертка читалась через io.TextIOWrapper
+    read1 = read
+    closed = False
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+
+@contextmanager
+def open_price_list(url):
+    """
+    Открываем прайс-лист по ссылке для потокового чтения
+    """
+    max_bytes = settings.IMPORT_MAX_BYTES
+    timeout = settings.IMPORT_TIMEOUT
+    response = get(url, stream=True, timeout=timeout)
+    try:
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise PriceListError('Превышен размер прайс-листа')
+        yield LimitedStream(response, max_bytes, timeout)
+    finally:
+        response.close()
+
+
+# секции прайс-листа и имена записей, которые из них получаются
+YAML_SECTIONS = {
+    'categories': 'category',
+    'goods': 'good',
+}
+
+
+# сколько разных скаляров запоминаем при разборе одного файла
+SCALAR_CACHE_SIZE = 10000
+
+
+def _build_value(loader, anchors, scalars):
+    """
+    Собираем значение из событий парсера, не строя дерево всего документа.
+
+    Ключи и повторяющиеся значения прайс-листа разбираются один раз:
+    готовые скаляры неизменяемы и берутся из scalars.
+    """
+    event = loader.get_event()
+    event_class = event.__class__
+    if event_class is yaml.ScalarEvent:
+        key = (event.tag, event.value, event.implicit, event.style)
+        value = scalars.get(key)
+        if value is None:
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = loader.resolve(yaml.ScalarNode, event.value,
+                                     event.implicit)
+            node = yaml.ScalarNode(tag, event.value, style=event.style)
+            constructor = loader.yaml_constructors.get(
+                tag, loader.yaml_constructors[None])
+            value = constructor(loader, node)
+            if len(scalars) >= SCALAR_CACHE_SIZE:
+                scalars.clear()
+            scalars[key] = value
+    elif event_class is yaml.AliasEvent:
+        return anchors[event.anchor]
+    elif event_class is yaml.SequenceStartEvent:
+        value = []
+        if event.anchor:
+            anchors[event.anchor] = value
+        while not loader.check_event(yaml.SequenceEndEvent):
+            value.append(_build_value(loader, anchors, scalars))
+        loader.get_event()
+    elif event_class is yaml.MappingStartEvent:
+        value = {}
+        if event.anchor:
+            anchors[event.anchor] = value
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _build_value(loader, anchors, scalars)
+            value[key] = _build_value(loader, anchors, scalars)
+        loader.get_event()
+    else:
+        raise PriceListError(f'Неожиданный элемент YAML: {event}')
+    if event.anchor:
+        anchors[event.anchor] = value
+    return value
+
+
+def iter_yaml_price_list(stream):
+    """
+    Потоково читаем YAML прайс-лист.
+
+    Возвращает пары ('shop', название), ('category', словарь)
+    и ('good', словарь) по мере разбора файла.
+    """
+    loader = YamlLoader(stream)
+    anchors = {}
+    scalars = {}
+    try:
+        for event_class in (yaml.StreamStartEvent, yaml.DocumentStartEvent,
+                            yaml.MappingStartEvent):
+            if not loader.check_event(event_class):
+                raise PriceListError('Неверный формат прайс-листа')
+            loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _build_value(loader, anchors, scalars)
+            if key in YAML_SECTIONS and loader.check_event(
+                    yaml.SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield YAML_SECTIONS[key], _build_value(loader, anchors,
+                                                           scalars)
+                loader.get_event()
+            else:
+                value = _build_value(loader, anchors, scalars)
+                if key == 'shop':
+                    yield 'shop', value
+    except yaml.YAMLError as error:
+        raise PriceListError(str(error)) from error
+    finally:
+        loader.dispose()
+
+
+# заголовки таблицы прайс-листа, остальные колонки - параметры товара
+TABLE_COLUMNS = ('id', 'category', 'category_name', 'shop', 'name', 'model',
+                 'price', 'price_rrc', 'quantity')
+# без этих колонок товар не загрузить, category_name, shop и model
+# необязательны
+TABLE_REQUIRED_COLUMNS = ('id', 'category', 'name', 'price', 'price_rrc',
+                          'quantity')
+TABLE_INTEGER_COLUMNS = ('id', 'category', 'price', 'price_rrc', 'quantity')
+
+
+def _table_integer(value):
+    """
+    Приводим число из ячейки к int, нечисловое значение оставляем как есть
+    """
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        value = value.strip()
+        if value.isdigit():
+            return int(value)
+    return value
+
+
+def iter_table_price_list(rows):
+    """
+    Читаем прайс-лист из строк таблицы, первая строка - заголовок.
+
+    Магазин берется из колонки shop, категория объявляется перед
+    первым своим товаром. Возвращает те же записи, что и YAML.
+    """
+    header = next(rows, None)
+    if not header:
+        raise PriceListError('Неверный формат прайс-листа')
+    header = [str(name).strip() if name is not None else ''
+              for name in header]
+    missing = [name for name in TABLE_REQUIRED_COLUMNS if name not in header]
+    if missing:
+        raise PriceListError(f'Нет колонок: {", ".join(missing)}')
+    parameters = [(index, name) for index, name in enumerate(header)
+                  if name and name not in TABLE_COLUMNS]
+    columns = [(index, name) for index, name in enumerate(header)
+               if name in TABLE_COLUMNS]
+    shop = None
+    categories = set()
+    for row in rows:
+        if not any(cell not in (None, '') for cell in row):
+            continue
+        # пустая ячейка XLSX читается как None, в CSV - как пустая строка
+        good = {name: '' if row[index] is None else row[index]
+                for index, name in columns if index < len(row)}
+        for name in TABLE_INTEGER_COLUMNS:
+            if name in good:
+                good[name] = _table_integer(good[name])
+        row_shop = good.pop('shop', None)
+        if row_shop and shop is None:
+            shop = row_shop
+            yield 'shop', shop
+        category_name = good.pop('category_name', None)
+        category_id = good.get('category')
+        if category_id not in categories:
+            categories.add(category_id)
+            category = {'id': category_id}
+            if category_name not in (None, ''):
+                category['name'] = category_name
+            yield 'category', category
+        good['parameters'] = {
+            name: row[index] for index, name in parameters
+            if index < len(row) and row[index] not in (None, '')}
+        yield 'good', good
+
+
+def iter_csv_price_list(stream):
+    """
+    Потоково читаем CSV прайс-лист в UTF-8, разделитель
+    определяется по заголовку
+    """
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        first = lines.readline()
+        try:
+            dialect = csv.Sniffer().sniff(first, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        yield from iter_table_price_list(
+            csv.reader(chain([first], lines), dialect))
+    except (csv.Error, UnicodeDecodeError) as error:
+        raise PriceListError(str(error)) from error
+    finally:
+        # поток принадлежит вызывающему, обертка его не закрывает
+        lines.detach()
+
+
+def iter_jsonl_price_list(stream):
+    """
+    Потоково читаем прайс-лист в JSON Lines.
+
+    Каждая строка - объект из одного ключа: {"shop": название},
+    {"category": словарь} или {"good": словарь}.
+    """
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig')
+    try:
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = load_json(line)
+            except ValueError as error:
+                raise PriceListError(f'Строка {number}: {error}') from error
+            if not isinstance(record, dict) or len(record) != 1:
+                raise PriceListError(f'Строка {number}: неверная запись')
+            (section, value), = record.items()
+            if section in ('shop', 'category', 'good'):
+                yield section, value
+    except UnicodeDecodeError as error:
+        raise PriceListError(str(error)) from error
+    finally:
+        lines.detach()
+
+
+# сколько байт XLSX держим в памяти, прежде чем писать на диск
+XLSX_SPOOL_SIZE = 16 * 1024 * 1024
+
+
+def iter_xlsx_price_list(stream):
+    """
+    Читаем первый лист XLSX прайс-листа.
+    XLSX - zip-архив, поэтому файл сначала складывается во временный файл,
+    а строки листа читаются в режиме read_only без загрузки всей книги
+    """
+    with tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_SIZE) as file:
+        shutil.copyfileobj(stream, file, 64 * 1024)
+        file.seek(0)
+        try:
+            workbook = load_workbook(file, read_only=True, data_only=True)
+        except (InvalidFileException, BadZipFile, KeyError) as error:
+            raise PriceListError(str(error)) from error
+        try:
+            yield from iter_table_price_list(
+                workbook.active.iter_rows(values_only=True))
+        finally:
+            workbook.close()
+
+
+PRICE_LIST_READERS = {
+    'yaml': iter_yaml_price_list,
+    'csv': iter_csv_price_list,
+    'jsonl': iter_jsonl_price_list,
+    'xlsx': iter_xlsx_price_list,
+}
+
+PRICE_LIST_CONTENT_TYPES = {
+    'application/yaml': 'yaml',
+    'application/x-yaml': 'yaml',
+    'text/yaml': 'yaml',
+    'text/x-yaml': 'yaml',
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'application/jsonl': 'jsonl',
+    'application/x-jsonlines': 'jsonl',
+    'application/x-ndjson': 'jsonl',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
+        'xlsx',
+}
+
+PRICE_LIST_EXTENSIONS = {
+    '.yaml': 'yaml',
+    '.yml': 'yaml',
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.xlsx': 'xlsx',
+}
+
+
+def detect_price_list_format(url, content_type=''):
+    """
+    Определяем формат по Content-Type, затем по расширению файла.
+    По умолчанию прайс-лист считается YAML
+    """
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in PRICE_LIST_CONTENT_TYPES:
+        return PRICE_LIST_CONTENT_TYPES[content_type]
+    path = urlsplit(url or '').path.lower()
+    for extension, price_format in PRICE_LIST_EXTENSIONS.items():
+        if path.endswith(extension):
+            return price_format
+    return 'yaml'
+
+
+def iter_price_list(stream, price_format=None):
+    """
+    Читаем прайс-лист в любом поддерживаемом формате
+    """
+    if price_format is None:
+        price_format = detect_price_list_format(
+            getattr(stream, 'url', None), getattr(stream, 'content_type', ''))
+    if price_format not in PRICE_LIST_READERS:
+        raise PriceListError(f'Неизвестный формат прайс-листа: {price_format}')
+    return PRICE_LIST_READERS[price_format](stream)
@@ -0,0 +1,83 @@
+from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.db import connection
+from django.db.models import Q
+from django.db.models.fields.json import KeyTransform
+
+# конфигурация полнотекстового поиска, та же, что в индексе
+# catalog_search_idx (миграция 0011)
+SEARCH_CONFIG = 'russian'
+
+
+def search_text(product_name, model, parameters):
+    """
+    Текст строки витрины для поиска: название, модель и значения
+    параметров в нижнем регистре
+    """
+    return ' '.join([product_name, model, *map(str, parameters.values())]
+                    ).lower()
+
+
+def search_catalog(queryset, q):
+    """
+    Отбираем строки витрины по строке поиска q.
+
+    В PostgreSQL - полнотекстовый поиск по GIN-индексу выражения
+    to_tsvector, а если он ничего не нашел (опечатка, часть слова) -
+    поиск по сходству триграмм по GIN-индексу pg_trgm.
+    В остальных базах - вхождение всех слов запроса
+    """
+    q = q.strip().lower()
+    if not q:
+        return queryset
+    if connection.vendor == 'postgresql':
+        found = queryset.alias(
+            search_vector=SearchVector('search_text', config=SEARCH_CONFIG)
+        ).filter(search_vector=SearchQuery(q, config=SEARCH_CONFIG,
+                                           search_type='websearch'))
+        if found.exists():
+            return found
+        return queryset.filter(search_text__trigram_word_similar=q)
+    for word in q.split():
+        queryset = queryset.filter(search_text__contains=word)
+    return queryset
+
+
+def parse_parameter_filters(parameters):
+    """
+    Фильтры по параметрам {"Цвет": "черный", "Встроенная память": ["32",
+    "64"]} -> {имя: [значения]}. При неверном формате ValueError
+    """
+    if not isinstance(parameters, dict):
+        raise ValueError('Ожидается объект {параметр: значение}')
+    filters = {}
+    for name, values in parameters.items():
+        if not isinstance(values, list):
+            values = [values]
+        if not values or not all(
+                isinstance(value, (str, int, float)) for value in values):
+            raise ValueError(f'Неверное значение параметра {name}')
+        filters[name] = [str(value) for value in values]
+    return filters
+
+
+def filter_parameters(queryset, filters):
+    """
+    Отбираем строки витрины, у которых каждый параметр из filters
+    имеет одно из указанных значений.
+
+    В PostgreSQL - условием вхождения @> по GIN-индексу
+    catalog_parameters_idx (миграция 0012), в остальных базах -
+    сравнением значения по ключу JSON
+    """
+    for index, (name, values) in enumerate(filters.items()):
+        if connection.vendor == 'postgresql':
+            query = Q()
+            for value in values:
+                query |= Q(parameters__contains={name: value})
+            queryset = queryset.filter(query)
+        else:
+            alias = f'parameter_{index}'
+            queryset = queryset.alias(
+                **{alias: KeyTransform(name, 'parameters')}).filter(
+                **{f'{alias}__in': values})
+    return queryset
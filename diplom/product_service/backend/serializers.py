@@ -1,6 +1,11 @@
+from abc import ABC, abstractmethod
+from operator import itemgetter
+
+from django.db.models import QuerySet
 from rest_framework import serializers
 
-from backend.models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact
+from backend.models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact, \
+    ImportJob, ExportJob, CatalogItem
 
 
 class ContactSerializer(serializers.ModelSerializer):
@@ -63,6 +68,57 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
 
+# поле ответа каталога -> колонки витрины, из которых оно строится
+CATALOG_ITEM_COLUMNS = {
+    'id': ('pk',),
+    'model': ('model',),
+    'product': ('product_name', 'category_name'),
+    'shop': ('shop_name',),
+    'quantity': ('quantity',),
+    'price': ('price',),
+    'price_rrc': ('price_rrc',),
+    'product_parameters': ('parameters',),
+}
+
+
+def catalog_item_columns(fields):
+    """
+    Колонки витрины для полей ответа fields
+    """
+    return tuple(column for name in fields
+                 for column in CATALOG_ITEM_COLUMNS[name])
+
+
+class CatalogItemSerializer(serializers.ModelSerializer):
+    """
+    Строка витрины в том же виде, что и ProductInfoSerializer.
+    fields - только эти поля ответа
+    """
+    id = serializers.IntegerField(source='product_info_id', read_only=True)
+    product = serializers.SerializerMethodField()
+    shop = serializers.CharField(source='shop_name', read_only=True)
+    product_parameters = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CatalogItem
+        fields = ('id', 'model', 'product', 'shop', 'quantity', 'price',
+                  'price_rrc', 'product_parameters',)
+        read_only_fields = fields
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    def get_product(self, obj):
+        return {'name': obj.product_name, 'category': obj.category_name}
+
+    def get_product_parameters(self, obj):
+        return [{'parameter': name, 'value': value}
+                for name, value in obj.parameters.items()]
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
@@ -72,6 +128,11 @@ class OrderItemSerializer(serializers.ModelSerializer):
             'order': {'write_only': True}
         }
 
+    def validate_product_info(self, value):
+        if not value.is_active:
+            raise serializers.ValidationError('Товар снят с продажи')
+        return value
+
 
 class OrderItemCreateSerializer(OrderItemSerializer):
     product_info = ProductInfoSerializer(read_only=True)
@@ -87,3 +148,169 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         fields = ('id', 'ordered_items', 'state', 'dt', 'total_sum', 'contact',)
         read_only_fields = ('id',)
+
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ExportJob
+        fields = ('id', 'format', 'compression', 'catalog_version', 'state',
+                  'goods_exported', 'size', 'sha256', 'errors', 'created_at',
+                  'started_at', 'finished_at',)
+        read_only_fields = fields
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    elapsed = serializers.FloatField(read_only=True)
+    rows_per_second = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'url', 'dry_run', 'state', 'goods_processed', 'rows_written', 'errors', 'result', 'created_at',
+                  'started_at', 'finished_at', 'elapsed', 'rows_per_second',)
+        read_only_fields = fields
+
+
+class ValuesSerializer(ABC):
+    """
+    Быстрая сериализация только для чтения.
+
+    Дает тот же JSON, что и соответствующий ModelSerializer, но строит его
+    из словарей queryset.values() без объектов моделей и полей DRF.
+    Принимает queryset или уже выбранные строки values_fields, интерфейс
+    как у сериализатора: ValuesSerializer(rows, many=True).data.
+    Наследник задает values_fields и to_representation
+    """
+    # поля для queryset.values()
+    values_fields = ()
+
+    def __init__(self, instance=None, many=False, **kwargs):
+        self.instance = instance
+        self.many = many
+
+    def get_rows(self, instance):
+        if isinstance(instance, QuerySet):
+            # объекты связей не нужны, их поля читаются соединениями
+            return list(instance.prefetch_related(None).values(
+                *self.values_fields))
+        return instance if self.many else [instance]
+
+    @property
+    def data(self):
+        data = self.to_representation(self.get_rows(self.instance))
+        return data if self.many else data[0]
+
+    @abstractmethod
+    def to_representation(self, rows):
+        """
+        Строки values_fields -> список словарей ответа
+        """
+
+
+class CatalogItemValuesSerializer(ValuesSerializer):
+    """
+    Строки витрины, как CatalogItemSerializer.
+    fields - только эти поля ответа, строкам нужны только их колонки
+    """
+    values_fields = catalog_item_columns(CATALOG_ITEM_COLUMNS)
+    # поле ответа -> значение из строки values()
+    getters = {
+        'id': itemgetter('pk'),
+        'model': itemgetter('model'),
+        'product': lambda row: {'name': row['product_name'],
+                                'category': row['category_name']},
+        'shop': itemgetter('shop_name'),
+        'quantity': itemgetter('quantity'),
+        'price': itemgetter('price'),
+        'price_rrc': itemgetter('price_rrc'),
+        'product_parameters': lambda row: [
+            {'parameter': name, 'value': value}
+            for name, value in row['parameters'].items()],
+    }
+
+    def __init__(self, instance=None, many=False, fields=None, **kwargs):
+        super().__init__(instance, many, **kwargs)
+        # порядок полей всегда как в CatalogItemSerializer
+        self.fields = tuple(name for name in CATALOG_ITEM_COLUMNS
+                            if fields is None or name in fields)
+        self.values_fields = catalog_item_columns(self.fields)
+
+    def to_representation(self, rows):
+        getters = [(name, self.getters[name]) for name in self.fields]
+        return [{name: get(row) for name, get in getters} for row in rows]
+
+
+class ProductInfoValuesSerializer(ValuesSerializer):
+    """
+    Товары, как ProductInfoSerializer. Параметры всех товаров читаются
+    одним запросом
+    """
+    values_fields = ('id', 'model', 'product__name', 'product__category__name',
+                     'shop__name', 'quantity', 'price', 'price_rrc')
+
+    def to_representation(self, rows):
+        parameters = {}
+        for product_info_id, name, value in ProductParameter.objects.filter(
+                product_info_id__in=[row['id'] for row in rows]).order_by(
+                'product_info_id', 'id').values_list(
+                'product_info_id', 'parameter__name', 'value'):
+            parameters.setdefault(product_info_id, []).append(
+                {'parameter': name, 'value': value})
+        return [{
+            'id': row['id'],
+            'model': row['model'],
+            'product': {'name': row['product__name'],
+                        'category': row['product__category__name']},
+            'shop': row['shop__name'],
+            'quantity': row['quantity'],
+            'price': row['price'],
+            'price_rrc': row['price_rrc'],
+            'product_parameters': parameters.get(row['id'], []),
+        } for row in rows]
+
+
+class OrderValuesSerializer(ValuesSerializer):
+    """
+    Заказы с позициями, товарами и контактом, как OrderSerializer.
+    Queryset заказов должен содержать аннотацию total_sum.
+    Четыре запроса на любое число заказов: заказы с контактом, позиции,
+    товары, параметры товаров
+    """
+    contact_fields = ('id', 'city', 'street', 'house', 'structure',
+                      'building', 'apartment', 'phone')
+    values_fields = ('id', 'state', 'dt', 'total_sum', 'contact_id') + tuple(
+        f'contact__{name}' for name in contact_fields)
+    # дата заказа в том же виде, что у DateTimeField сериализатора
+    dt_field = serializers.DateTimeField()
+
+    def to_representation(self, rows):
+        items = {}
+        product_info_ids = set()
+        for order_id, item_id, product_info_id, quantity in \
+                OrderItem.objects.filter(
+                    order_id__in=[row['id'] for row in rows]).order_by(
+                    'order_id', 'id').values_list(
+                    'order_id', 'id', 'product_info_id', 'quantity'):
+            items.setdefault(order_id, []).append(
+                (item_id, product_info_id, quantity))
+            product_info_ids.add(product_info_id)
+        product_infos = {
+            product_info['id']: product_info
+            for product_info in ProductInfoValuesSerializer(
+                ProductInfo.objects.filter(pk__in=product_info_ids),
+                many=True).data}
+        dt_to_representation = self.dt_field.to_representation
+        return [{
+            'id': row['id'],
+            'ordered_items': [
+                {'id': item_id,
+                 'product_info': product_infos[product_info_id],
+                 'quantity': quantity}
+                for item_id, product_info_id, quantity in
+                items.get(row['id'], [])],
+            'state': row['state'],
+            'dt': dt_to_representation(row['dt']),
+            'total_sum': row['total_sum'],
+            'contact': None if row['contact_id'] is None else {
+                name: row[f'contact__{name}']
+                for name in self.contact_fields},
+        } for row in rows]
@@ -1,15 +1,28 @@
 from typing import Type
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.dispatch import receiver, Signal
 from django_rest_passwordreset.signals import reset_password_token_created
-from backend.tasks import task_new_user, task_new_order, task_password_reset
-from backend.models import ConfirmEmailToken, User
+from backend.tasks import task_new_user, task_new_order, \
+    task_password_reset, task_rebuild_catalog
+from backend import intern
+from backend.models import ConfirmEmailToken, User, Category, Parameter, \
+    Product, ProductInfo, ProductParameter, CatalogItem
+from backend.versions import bump_catalog_version
+from backend.catalog import refresh_catalog_items, refresh_facets
+from backend.caching import catalog_cache
+from backend.transactions import on_commit_once
 
 new_user_registered = Signal()
 
 new_order = Signal()
 
 
+def _rebuild_catalogs(shop_ids):
+    # витрину всех товаров магазина собирает воркер, а не запрос
+    for shop_id in shop_ids:
+        task_rebuild_catalog.delay(shop_id)
+
+
 @receiver(reset_password_token_created)
 def password_reset_token_created(sender, instance, reset_password_token,
                                  **kwargs):
@@ -36,3 +49,107 @@ def new_order_signal(user_id, **kwargs):
     отправяем письмо при изменении статуса заказа
     """
     task_new_order.delay(user_id)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed_signal(sender, instance, **kwargs):
+    """
+    сбрасываем категорию в кэше имен и ответы /categories
+    при изменении или удалении
+    """
+    intern.categories.invalidate(instance.pk)
+    catalog_cache.bump()
+
+
+@receiver(post_save, sender=Parameter)
+@receiver(post_delete, sender=Parameter)
+def parameter_changed_signal(sender, instance, **kwargs):
+    """
+    сбрасываем параметр в кэше имен при изменении или удалении
+    """
+    intern.parameters.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed_signal(sender, instance, **kwargs):
+    """
+    сбрасываем продукт в кэше имен при изменении или удалении
+    """
+    intern.products.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=ProductInfo)
+def product_info_saved_signal(sender, instance, **kwargs):
+    """
+    увеличиваем версию каталога магазина и обновляем витрину
+    при правке товара
+    """
+    bump_catalog_version([instance.shop_id])
+    refresh_catalog_items([instance.pk])
+
+
+@receiver(post_save, sender=ProductParameter)
+def product_parameter_saved_signal(sender, instance, **kwargs):
+    """
+    увеличиваем версию каталога магазина и обновляем витрину
+    при правке параметра товара
+    """
+    bump_catalog_version(ProductInfo.objects.filter(
+        pk=instance.product_info_id).values_list('shop_id', flat=True))
+    refresh_catalog_items([instance.product_info_id])
+
+
+@receiver(post_save, sender=Product)
+def product_saved_signal(sender, instance, created, **kwargs):
+    """
+    переименованный продукт меняет каталоги всех магазинов, где он есть
+    """
+    if not created:
+        product_infos = ProductInfo.objects.filter(product=instance)
+        bump_catalog_version(product_infos.values_list(
+            'shop_id', flat=True).distinct())
+        refresh_catalog_items(product_infos.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Product)
+def product_deleted_signal(sender, instance, **kwargs):
+    """
+    удаленный продукт пропадает из каталогов всех магазинов, где он есть:
+    строки витрины удаляются каскадом, фасеты пересчитываем после фиксации
+    """
+    bump_catalog_version(ProductInfo.objects.filter(
+        product=instance).values_list('shop_id', flat=True).distinct())
+    on_commit_once(refresh_facets, CatalogItem.objects.filter(
+        product_info__product=instance).values_list(
+        'shop_id', 'category_id').distinct())
+
+
+@receiver(post_save, sender=Parameter)
+@receiver(pre_delete, sender=Parameter)
+def parameter_changed_catalog_signal(sender, instance, **kwargs):
+    """
+    переименованный или удаленный параметр меняет каталоги всех магазинов,
+    где он есть. Параметр бывает у товаров многих магазинов, поэтому
+    витрину пересобирает воркер после фиксации
+    """
+    if kwargs.get('created'):
+        return
+    shop_ids = set(ProductInfo.objects.filter(
+        product_parameters__parameter=instance).values_list(
+        'shop_id', flat=True).distinct())
+    bump_catalog_version(shop_ids)
+    on_commit_once(_rebuild_catalogs, shop_ids)
+
+
+@receiver(post_save, sender=Category)
+def category_saved_signal(sender, instance, created, **kwargs):
+    """
+    переименованная категория меняет каталоги всех ее магазинов,
+    витрину пересобирает воркер после фиксации
+    """
+    if not created:
+        shop_ids = set(instance.shops.values_list('id', flat=True))
+        bump_catalog_version(shop_ids)
+        on_commit_once(_rebuild_catalogs, shop_ids)
@@ -1,13 +1,22 @@
-import yaml
 import logging
-from celery import shared_task
+from celery import shared_task, chord
 from django.conf import settings
 from django.core.mail import send_mail
+from django.db import DatabaseError
 from django.contrib.auth import get_user_model
 from django_rest_passwordreset.models import ResetPasswordToken
+from requests import RequestException
 from product_service.celery import app
+from backend.importer import ShardedCatalogImporter, publish_catalog, \
+    discard_import, import_shard, ImportInProgress
+from backend.readers import open_price_list, iter_price_list, \
+    PriceListError
+from backend.validation import validate_price_list
+from backend.exporters import export_catalog, evict_snapshots
+from backend.catalog import rebuild_shop_catalog
 from backend.models import ConfirmEmailToken, User, Shop, Category, \
-    ProductParameter, Parameter, ProductInfo, Product
+    ProductParameter, Parameter, ProductInfo, Product, ImportJob, \
+    ExportJob
 
 
 @app.task
@@ -87,87 +96,169 @@ def task_new_order(user_id):
 
 
 @shared_task
-def task_product_export(user_id):
+def task_product_export(user_id, export_id=None):
     """
-        Задача для экспорта товаров из базы в файл
+        Задача для экспорта товаров из базы в файл.
+        Каждая выгрузка пишется в свой файл, товары читаются и пишутся
+        пачками. Готовая выгрузка хранится, пока не изменится версия
+        каталога магазина. Возвращает ИД выгрузки
     """
 
     UserModel = get_user_model()
     user = UserModel.objects.get(pk=user_id)
-    datas = Shop.objects.filter(state=True,
-                                user_id=user.id, ).prefetch_related(
-        'categories__products__product_infos__product_parameters__parameter')
-    if datas:
-        list_category = []
-        list_goods = []
-        for shops in datas:
-            shop = shops.name
-            for category in shops.categories.all():
-                list_category.append({
-                    'id': category.id,
-                    'name': category.name
-                })
-
-                for product in category.products.all():
-                    for product_info in product.product_infos.all():
-                        dict_parameter = {}
-                        for par in product_info.product_parameters.all():
-                            dict_parameter.update(
-                                {par.parameter.name: par.value})
-
-                        list_goods.append({
-                            'category': product.category_id,
-                            'name': product.name,
-                            'model': product_info.price,
-                            'id': product_info.external_id,
-                            'price': product_info.price,
-                            'price_rrc': product_info.price_rrc,
-                            'quantity': product_info.quantity,
-                            'parameter': dict_parameter,
-
-                        })
-
-        data = {
-            'shop': shop,
-            'category': list_category,
-            'goods': list_goods,
-        }
-
-        with open("product.yaml", "a", encoding='utf-8') as file:
-            yaml.dump(data, file, allow_unicode=True, sort_keys=False)
-        return 'Done'
+    shop = Shop.objects.filter(state=True, user_id=user.id).first()
+    if export_id is None:
+        if shop is None:
+            return None
+        job = ExportJob.objects.create(shop=shop)
+    else:
+        job = ExportJob.objects.get(pk=export_id)
+    if shop is None:
+        job.start()
+        job.fail('Магазин выключен')
+        return job.id
+    # версию читаем до товаров: если каталог изменится во время выгрузки,
+    # она сразу окажется устаревшей
+    job.start(shop.catalog_version)
+    try:
+        file, count, size, sha256 = export_catalog(job)
+    except Exception as error:
+        job.fail(error)
+        raise
+    job.finish(file, count, size, sha256)
+    evict_snapshots()
+    return job.id
 
 
 @shared_task(bind=True)
-def task_product_import(self, item, data, user_id, *args, **kwargs):
-    """
-    Задача для обновление базы данных
-    """
-    shop, _ = Shop.objects.get_or_create(name=data['shop'],
-                                         user_id=user_id)
-    for category in data['categories']:
-        category_object, _ = Category.objects.get_or_create(
-            id=category['id'], name=category['name'])
-        category_object.shops.add(shop.id)
-        category_object.save()
-    ProductInfo.objects.filter(shop_id=shop.id).delete()
-    for item in data['goods']:
-        product, _ = Product.objects.get_or_create(
-            name=item['name'], category_id=item['category'])
-
-        product_info = ProductInfo.objects.create(
-            product_id=product.id,
-            external_id=item['id'],
-            model=item['model'],
-            price=item['price'],
-            price_rrc=item['price_rrc'],
-            quantity=item['quantity'],
-            shop_id=shop.id)
-        for name, value in item['parameters'].items():
-            parameter_object, _ = Parameter.objects.get_or_create(
-                name=name)
-            ProductParameter.objects.create(
-                product_info_id=product_info.id,
-                parameter_id=parameter_object.id,
-                value=value)
+def task_product_import(self, shop_id, url, job_id=None, price_format=None,
+                        *args, **kwargs):
+    """
+    Задача для обновление базы данных.
+    Прайс-лист скачивается и разбирается потоково прямо в воркере.
+    Формат (YAML, CSV, JSON Lines или XLSX) определяется по Content-Type
+    или расширению, если не передан явно.
+    Большой прайс-лист делится на шарды, которые подготавливаются
+    параллельно на разных воркерах, и публикуется после последнего шарда.
+    Пока загрузка не опубликована или не отменена, следующая загрузка
+    того же магазина завершается ошибкой. Результат публикации - число
+    неизмененных, обновленных, добавленных и снятых с продажи товаров,
+    ход загрузки пишется в ImportJob
+    """
+    shop = Shop.objects.get(pk=shop_id)
+    job = ImportJob.objects.filter(pk=job_id).first()
+    if job:
+        job.start()
+    importer = ShardedCatalogImporter(shop, import_id=self.request.id,
+                                      job=job)
+    try:
+        # товары подготавливаются пачками, каталог магазина меняется только
+        # при публикации
+        with open_price_list(url) as stream:
+            shard_ids = importer.run(iter_price_list(stream, price_format))
+        if not shard_ids:
+            stats = publish_catalog(shop, importer.import_id,
+                                    shop_name=importer.shop_name, job=job)
+            if job:
+                job.finish(stats)
+            return stats
+    except ImportInProgress as error:
+        # магазин занят другой загрузкой, ее данные не трогаем
+        discard_import(importer.import_id)
+        if job:
+            job.fail(error)
+        return None
+    except Exception as error:
+        discard_import(importer.import_id)
+        if job:
+            job.fail(error)
+        raise
+
+    publish = task_product_import_publish.si(
+        shop.id, importer.import_id, importer.shop_name, job_id).on_error(
+        task_product_import_discard.si(importer.import_id, job_id))
+    chord(task_product_import_shard.si(shard_id)
+          for shard_id in shard_ids)(publish)
+    return {'import_id': importer.import_id, 'shards': len(shard_ids)}
+
+
+@shared_task
+def task_validate_price_list(job_id, url, price_format=None):
+    """
+    Проверка прайс-листа без записи в базу.
+    Файл скачивается и разбирается в воркере, как и при загрузке,
+    отчет об ошибках пишется в результат ImportJob
+    """
+    job = ImportJob.objects.select_related('shop', 'user').get(pk=job_id)
+    job.start()
+    # без магазина в файле загрузка оставит текущее название, а новый
+    # магазин назовет по компании пользователя
+    if job.shop:
+        shop_name = job.shop.name
+    elif job.user:
+        shop_name = (job.user.company or job.user.email)[:50]
+    else:
+        shop_name = None
+    try:
+        with open_price_list(url) as stream:
+            report = validate_price_list(iter_price_list(stream, price_format),
+                                         shop_name)
+    except (PriceListError, RequestException) as error:
+        job.fail(error)
+        return None
+    job.add_progress(goods=report['goods'])
+    job.finish(report)
+    return report['valid']
+
+
+@shared_task(bind=True, autoretry_for=(DatabaseError,), retry_backoff=True,
+             max_retries=settings.IMPORT_SHARD_RETRIES)
+def task_product_import_shard(self, shard_id):
+    """
+    Подготовка товаров одного шарда прайс-листа к публикации.
+    При ошибке базы шард перезапускается сам, не затрагивая остальные
+    """
+    import_shard(shard_id)
+    return 'Done'
+
+
+@shared_task
+def task_product_import_publish(shop_id, import_id, shop_name=None,
+                                job_id=None):
+    """
+    Публикация прайс-листа после подготовки всех шардов
+    """
+    shop = Shop.objects.get(pk=shop_id)
+    job = ImportJob.objects.filter(pk=job_id).first()
+    try:
+        stats = publish_catalog(shop, import_id, shop_name=shop_name, job=job)
+    except Exception as error:
+        discard_import(import_id)
+        if job:
+            job.fail(error)
+        raise
+    if job:
+        job.finish(stats)
+    return stats
+
+
+@shared_task
+def task_product_import_discard(import_id, job_id=None):
+    """
+    Очистка шардов и подготовленных товаров после неудачной загрузки,
+    каталог магазина остается прежним
+    """
+    discard_import(import_id)
+    job = ImportJob.objects.filter(pk=job_id).first()
+    if job and job.state != 'failed':
+        job.fail('Не удалось загрузить часть прайс-листа')
     return 'Done'
+
+
+@shared_task
+def task_rebuild_catalog(shop_id):
+    """
+    Пересборка витрины каталога магазина
+    """
+    shop = Shop.objects.get(pk=shop_id)
+    return rebuild_shop_catalog(shop)
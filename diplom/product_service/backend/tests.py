@@ -1,3 +1,1561 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import tablib
+import yaml
+from openpyxl import Workbook
+
+from django.core.cache import cache, caches
+from django.db import connection, transaction
+from django.db.models import Sum, F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from django.contrib import admin
+
+from backend import intern
+from backend.admin import ProductInfoAdmin, ShopAdmin, ProductResource
+from backend.benchmark import run_benchmark, CATEGORY_ID_START
+from backend.caching import catalog_cache
+from backend.catalog import rebuild_shop_catalog, category_facets
+from backend.importer import CatalogImporter, ShardedCatalogImporter, \
+    import_shard, publish_catalog, discard_import, ImportInProgress
+from backend.readers import iter_price_list, PriceListError
+from backend.exporters import iter_export_goods, iter_export, \
+    export_categories
+from backend.models import User, Shop, Category, Product, ProductInfo, \
+    Parameter, ProductParameter, Order, OrderItem, Contact, CatalogItem, \
+    CategoryFacet, ConfirmEmailToken, ImportShard, ImportJob, \
+    StagedProductInfo
+from backend.serializers import CatalogItemSerializer, \
+    CatalogItemValuesSerializer, ProductInfoSerializer, \
+    ProductInfoValuesSerializer, OrderSerializer, OrderValuesSerializer
+from backend.tasks import task_new_user, task_rebuild_catalog, \
+    task_validate_price_list, task_product_export, task_product_import
+from backend.validation import validate_price_list
+from backend.views import ProductInfoView, BasketView, OrderView
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'intern': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+               'LOCATION': 'intern'},
+}
+
+
+def create_catalog():
+    """
+    Два магазина, товары с параметрами и без, заказы с контактом и без
+    """
+    buyer = User.objects.create_user(email='buyer@example.com',
+                                     password='password', is_active=True)
+    contact = Contact.objects.create(user=buyer, city='Москва',
+                                     street='Тверская', house='1',
+                                     phone='+79990000000')
+    phones = Category.objects.create(name='Смартфоны')
+    cases = Category.objects.create(name='Аксессуары')
+    color = Parameter.objects.create(name='Цвет')
+    memory = Parameter.objects.create(name='Встроенная память (Гб)')
+    product_infos = []
+    for shop_index in range(2):
+        shop = Shop.objects.create(name=f'Магазин {shop_index}')
+        for index in range(5):
+            category = phones if index % 2 else cases
+            product = Product.objects.create(name=f'Товар {index}',
+                                             category=category)
+            product_info = ProductInfo.objects.create(
+                product=product, shop=shop, external_id=index,
+                model=f'model/{index}', quantity=index,
+                price=1000 + index, price_rrc=1100 + index)
+            if index:
+                ProductParameter.objects.create(
+                    product_info=product_info, parameter=color,
+                    value='черный')
+            if index % 2:
+                ProductParameter.objects.create(
+                    product_info=product_info, parameter=memory,
+                    value=str(32 * index))
+            product_infos.append(product_info)
+    for state, order_contact, items in (
+            ('basket', None, product_infos[:3]),
+            ('new', contact, product_infos[3:7]),
+            ('confirmed', None, [])):
+        order = Order.objects.create(user=buyer, state=state,
+                                     contact=order_contact)
+        for quantity, product_info in enumerate(items, 1):
+            OrderItem.objects.create(order=order, product_info=product_info,
+                                     quantity=quantity)
+    return buyer
+
+
+def make_goods(count, categories=2, price=1000):
+    """
+    Товары прайс-листа в формате поставщика
+    """
+    return [{'id': index + 1, 'category': 1001 + index % categories,
+             'model': f'model/{index}', 'name': f'Товар {index}',
+             'price': price + index, 'price_rrc': price + index + 100,
+             'quantity': index,
+             'parameters': {'Цвет': 'черный', 'Память (Гб)': 32 * index}}
+            for index in range(count)]
+
+
+def price_list(goods, shop='Связной'):
+    """
+    Записи прайс-листа, как их возвращают readers
+    """
+    yield 'shop', shop
+    for category_id in sorted({item['category'] for item in goods}):
+        yield 'category', {'id': category_id,
+                           'name': f'Категория {category_id}'}
+    for item in goods:
+        yield 'good', item
+
+
+def clear_intern():
+    """
+    Кэш имен процесса переживает откат тестовой транзакции
+    """
+    for intern_cache in (intern.categories, intern.parameters,
+                         intern.products):
+        intern_cache.clear()
+
+
+def catalog_state(shop):
+    """
+    Каталог магазина без суррогатных ключей, для сравнения загрузок
+    """
+    parameters = {}
+    for product_info_id, name, value in ProductParameter.objects.filter(
+            product_info__shop=shop).values_list(
+            'product_info_id', 'parameter__name', 'value'):
+        parameters.setdefault(product_info_id, {})[name] = value
+    return sorted(
+        (name, category_id, external_id, model, price, price_rrc, quantity,
+         is_active, sorted(parameters.get(pk, {}).items()))
+        for pk, name, category_id, external_id, model, price, price_rrc,
+        quantity, is_active in ProductInfo.objects.filter(
+            shop=shop).values_list(
+            'id', 'product__name', 'product__category_id', 'external_id',
+            'model', 'price', 'price_rrc', 'quantity', 'is_active'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ValuesSerializerTest(TestCase):
+    """
+    Быстрая сериализация из values() дает тот же JSON байт в байт,
+    что и ModelSerializer
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer = create_catalog()
+
+    def assertSameJSON(self, expected, actual):
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(expected), renderer.render(actual))
+
+    def test_catalog_item(self):
+        catalog_items = CatalogItem.objects.order_by('pk')
+        self.assertEqual(catalog_items.count(), 10)
+        self.assertSameJSON(
+            CatalogItemSerializer(catalog_items, many=True).data,
+            CatalogItemValuesSerializer(catalog_items, many=True).data)
+
+    def test_catalog_item_matches_product_info(self):
+        self.assertSameJSON(
+            ProductInfoSerializer(ProductInfo.objects.order_by('id'),
+                                  many=True).data,
+            CatalogItemValuesSerializer(CatalogItem.objects.order_by('pk'),
+                                        many=True).data)
+
+    def test_product_info(self):
+        product_infos = ProductInfo.objects.order_by('id')
+        self.assertSameJSON(
+            ProductInfoSerializer(product_infos, many=True).data,
+            ProductInfoValuesSerializer(product_infos, many=True).data)
+        product_info = product_infos.last()
+        self.assertSameJSON(
+            ProductInfoSerializer(product_info).data,
+            ProductInfoValuesSerializer(
+                product_infos.filter(pk=product_info.pk).values(
+                    *ProductInfoValuesSerializer.values_fields).get()).data)
+
+    def test_order(self):
+        orders = Order.objects.filter(user=self.buyer).prefetch_related(
+            'ordered_items__product_info__product__category',
+            'ordered_items__product_info__product_parameters__parameter'
+        ).select_related('contact').annotate(
+            total_sum=Sum(F('ordered_items__quantity') * F(
+                'ordered_items__product_info__price'))).distinct()
+        self.assertSameJSON(OrderSerializer(orders, many=True).data,
+                            OrderValuesSerializer(orders, many=True).data)
+
+    def test_products_view(self):
+        client = APIClient()
+        for params in ({}, {'ordering': '-price', 'page_size': 3},
+                       {'shop_id': Shop.objects.first().pk},
+                       {'fields': 'id,product,price,shop'},
+                       {'fields': 'price', 'include': 'parameters',
+                        'ordering': 'price', 'page_size': 4}):
+            fast = client.get('/api/v1/products', params)
+            # ответ не должен прийти из кэша ответов
+            cache.clear()
+            with mock.patch.object(ProductInfoView,
+                                   'values_serializer_class', None):
+                slow = client.get('/api/v1/products', params)
+            self.assertEqual(fast.status_code, 200)
+            self.assertEqual(fast.content, slow.content)
+
+    def test_products_fields(self):
+        response = APIClient().get('/api/v1/products', {
+            'fields': 'id,price', 'include': 'parameters'})
+        self.assertEqual(response.status_code, 200)
+        for item in response.data['results']:
+            self.assertEqual(list(item),
+                             ['id', 'price', 'product_parameters'])
+        response = APIClient().get('/api/v1/products', {'fields': 'name'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_order_views(self):
+        client = APIClient()
+        client.force_authenticate(self.buyer)
+        for view, url in ((BasketView, '/api/v1/basket'),
+                          (OrderView, '/api/v1/order')):
+            fast = client.get(url)
+            with mock.patch.object(view, 'order_serializer_class',
+                                   OrderSerializer):
+                slow = client.get(url)
+            self.assertEqual(fast.status_code, 200)
+            self.assertEqual(fast.content, slow.content)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ConditionalGetTest(TransactionTestCase):
+    """
+    ETag по версиям каталога: 304 без запросов к базе, новый ETag после
+    изменения каталога. Версии увеличиваются после фиксации транзакции,
+    поэтому транзакции здесь настоящие
+    """
+
+    def setUp(self):
+        cache.clear()
+        create_catalog()
+
+    def test_not_modified(self):
+        client = APIClient()
+        for url in ('/api/v1/products', '/api/v1/categories',
+                    '/api/v1/shops'):
+            response = client.get(url)
+            etag = response['ETag']
+            with self.assertNumQueries(0):
+                response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(response.content, b'')
+
+    def test_etag_changes_with_catalog(self):
+        client = APIClient()
+        shop = Shop.objects.first()
+        other_shop = Shop.objects.last()
+        url = f'/api/v1/products?shop_id={shop.pk}'
+        etag = client.get(url)['ETag']
+        other_etag = client.get(
+            f'/api/v1/products?shop_id={other_shop.pk}')['ETag']
+        self.assertNotEqual(etag, other_etag)
+        product_info = ProductInfo.objects.filter(shop=shop).first()
+        product_info.price += 1
+        product_info.save()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn(product_info.price,
+                      [item['price'] for item in response.data['results']])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class InternCacheTest(TransactionTestCase):
+    """
+    Поколение кэша имен увеличивается один раз на транзакцию
+    и только после ее фиксации
+    """
+
+    def setUp(self):
+        caches['intern'].clear()
+        intern.parameters.clear()
+        Parameter.objects.bulk_create(
+            Parameter(name=f'Параметр {index}') for index in range(5))
+
+    def generation(self):
+        return caches['intern'].get(intern.parameters.generation_key)
+
+    def test_bump_once_per_transaction(self):
+        with transaction.atomic():
+            Parameter.objects.all().delete()
+            self.assertIsNone(self.generation())
+        self.assertEqual(self.generation(), 1)
+        Parameter.objects.create(name='Цвет')
+        self.assertEqual(self.generation(), 2)
+
+    def test_rollback(self):
+        with self.assertRaises(ZeroDivisionError):
+            with transaction.atomic():
+                Parameter.objects.all().delete()
+                1 / 0
+        self.assertIsNone(self.generation())
+        self.assertEqual(Parameter.objects.count(), 5)
+
+    def test_sync(self):
+        intern.parameters.sync()
+        intern.parameters.set_many({'Цвет': 1})
+        intern.parameters.sync()
+        self.assertEqual(intern.parameters.get_many(['Цвет']), {'Цвет': 1})
+        # запись изменили в другом процессе
+        caches['intern'].set(intern.parameters.generation_key, 10)
+        intern.parameters.sync()
+        self.assertEqual(intern.parameters.get_many(['Цвет']), {})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AdminImportTest(TestCase):
+    """
+    Импорт продуктов из админки находит записи по id одним запросом
+    на весь файл
+    """
+
+    def setUp(self):
+        self.category = Category.objects.create(id=1, name='Смартфоны')
+        self.products = Product.objects.bulk_create(
+            Product(name=f'Товар {index}', category=self.category)
+            for index in range(20))
+
+    def import_products(self, rows):
+        dataset = tablib.Dataset(headers=['id', 'name', 'category'])
+        for row in rows:
+            dataset.append(row)
+        with CaptureQueriesContext(connection) as queries:
+            result = ProductResource().import_data(dataset)
+        self.assertFalse(result.has_errors())
+        # в PostgreSQL после вставки новых строк import_export еще
+        # сдвигает последовательность id запросом SELECT setval(...)
+        return [query['sql'] for query in queries
+                if query['sql'].startswith('SELECT "backend_product".')]
+
+    def test_match_by_id(self):
+        renamed = self.products[0]
+        selects = self.import_products(
+            [(renamed.id, 'Новое имя', self.category.id),
+             ('', 'Новый товар', self.category.id)])
+        # переименованный продукт обновлен, а не создан заново
+        self.assertEqual(Product.objects.get(pk=renamed.id).name,
+                         'Новое имя')
+        self.assertEqual(Product.objects.count(), 21)
+        self.assertEqual(len(selects), 1)
+
+    def test_one_select_per_file(self):
+        selects = self.import_products(
+            [(product.id, product.name, self.category.id)
+             for product in self.products])
+        self.assertEqual(len(selects), 1)
+
+
+def legacy_import(shop, records):
+    """
+    Прежняя загрузка через get_or_create на каждую запись, эталон
+    для пакетной
+    """
+    ProductInfo.objects.filter(shop=shop).delete()
+    for section, value in records:
+        if section == 'category':
+            category, _ = Category.objects.get_or_create(
+                id=value['id'], name=value['name'])
+            category.shops.add(shop.id)
+        elif section == 'good':
+            product, _ = Product.objects.get_or_create(
+                name=value['name'], category_id=value['category'])
+            product_info = ProductInfo.objects.create(
+                product=product, shop=shop, external_id=value['id'],
+                model=value['model'], price=value['price'],
+                price_rrc=value['price_rrc'], quantity=value['quantity'])
+            for name, parameter_value in value['parameters'].items():
+                parameter, _ = Parameter.objects.get_or_create(name=name)
+                ProductParameter.objects.create(
+                    product_info=product_info, parameter=parameter,
+                    value=parameter_value)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogImporterTest(TestCase):
+    """
+    Пакетная загрузка дает тот же каталог, что и прежняя, пропускает
+    неизменившиеся товары и снимает с продажи пропавшие при публикации
+    """
+
+    def setUp(self):
+        clear_intern()
+        self.shop = Shop.objects.create(name='Связной')
+
+    def load(self, goods, shop=None):
+        importer = CatalogImporter(shop or self.shop, batch_size=4)
+        importer.run(price_list(goods))
+        return importer
+
+    def publish(self, goods):
+        importer = self.load(goods)
+        return publish_catalog(self.shop, importer.import_id)
+
+    def active_state(self, shop):
+        return [row for row in catalog_state(shop) if row[7]]
+
+    def test_same_state_as_legacy(self):
+        legacy_shop = Shop.objects.create(name='Эталон')
+        goods = make_goods(10, categories=3)
+        changed = goods[1:] + make_goods(12, categories=3)[10:]
+        changed[0] = dict(changed[0], price=1, model='model/new')
+        changed[1] = dict(changed[1], parameters={'Вес (г)': 150})
+        for step in (goods, changed):
+            legacy_import(legacy_shop, price_list(step))
+            self.publish(step)
+            self.assertEqual(self.active_state(self.shop),
+                             catalog_state(legacy_shop))
+        self.assertEqual(Product.objects.count(), 12)
+        self.assertEqual(Parameter.objects.count(), 3)
+
+    def test_queries_do_not_grow(self):
+        def count_queries(count):
+            clear_intern()
+            importer = CatalogImporter(self.shop, batch_size=count)
+            with CaptureQueriesContext(connection) as queries, \
+                    transaction.atomic():
+                importer.run(price_list(make_goods(count)))
+                transaction.set_rollback(True)
+            return len(queries)
+
+        # одна пачка из 4 товаров и одна из 80 - одинаково запросов
+        # (80 строк по 11 полей - один INSERT и в SQLite)
+        self.assertEqual(count_queries(4), count_queries(80))
+
+    def test_delta(self):
+        goods = make_goods(6)
+        self.publish(goods)
+        parameter_ids = set(ProductParameter.objects.values_list(
+            'id', flat=True))
+        self.assertEqual(self.publish(goods), {
+            'unchanged': 6, 'updated': 0, 'inserted': 0, 'removed': 0})
+        # неизменившиеся товары не переписываются
+        self.assertEqual(set(ProductParameter.objects.values_list(
+            'id', flat=True)), parameter_ids)
+        goods[0] = dict(goods[0], quantity=100)
+        self.assertEqual(self.publish(goods), {
+            'unchanged': 5, 'updated': 1, 'inserted': 0, 'removed': 0})
+        self.assertEqual(
+            ProductInfo.objects.get(shop=self.shop, external_id=1).quantity,
+            100)
+
+    def test_retire_on_publish(self):
+        goods = make_goods(6)
+        self.publish(goods)
+        importer = self.load(goods[2:])
+        # до публикации пропавшие товары остаются в продаже
+        self.assertEqual(ProductInfo.objects.filter(
+            shop=self.shop, is_active=True).count(), 6)
+        stats = publish_catalog(self.shop, importer.import_id)
+        self.assertEqual(stats['removed'], 2)
+        self.assertEqual(set(ProductInfo.objects.filter(
+            shop=self.shop, is_active=True).values_list(
+            'external_id', flat=True)), {3, 4, 5, 6})
+        self.assertEqual(set(CatalogItem.objects.filter(
+            shop=self.shop).values_list('external_id', flat=True)),
+            {3, 4, 5, 6})
+        # вернувшийся товар снова в продаже
+        self.publish(goods)
+        self.assertEqual(ProductInfo.objects.filter(
+            shop=self.shop, is_active=True).count(), 6)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ShardedImportTest(TestCase):
+    """
+    Шарды подготавливают товары в промежуточной таблице, каталог меняется
+    только при публикации, отмена загрузки оставляет его прежним
+    """
+
+    def setUp(self):
+        clear_intern()
+        self.shop = Shop.objects.create(name='Связной')
+
+    def run_shards(self, goods):
+        importer = ShardedCatalogImporter(self.shop, shard_size=3,
+                                          batch_size=2)
+        shard_ids = importer.run(price_list(goods))
+        self.assertGreater(len(shard_ids), 1)
+        return importer, shard_ids
+
+    def test_shards_stage_goods(self):
+        importer, shard_ids = self.run_shards(make_goods(8))
+        for shard_id in shard_ids:
+            import_shard(shard_id)
+            # повторный запуск шарда ничего не меняет
+            import_shard(shard_id)
+        self.assertEqual(StagedProductInfo.objects.count(), 8)
+        # до публикации каталог магазина не меняется
+        self.assertFalse(ProductInfo.objects.filter(shop=self.shop).exists())
+        self.assertFalse(CatalogItem.objects.filter(shop=self.shop).exists())
+        stats = publish_catalog(self.shop, importer.import_id,
+                                shop_name=importer.shop_name)
+        self.assertEqual(stats, {'unchanged': 0, 'updated': 0,
+                                 'inserted': 8, 'removed': 0})
+        self.assertEqual(ProductParameter.objects.filter(
+            product_info__shop=self.shop).count(), 16)
+        self.assertEqual(CatalogItem.objects.filter(shop=self.shop).count(),
+                         8)
+        self.assertFalse(ImportShard.objects.exists())
+        self.assertFalse(StagedProductInfo.objects.exists())
+
+    def test_reimport_keeps_catalog_until_publish(self):
+        goods = make_goods(8)
+        importer, shard_ids = self.run_shards(goods)
+        for shard_id in shard_ids:
+            import_shard(shard_id)
+        publish_catalog(self.shop, importer.import_id)
+        before = catalog_state(self.shop)
+        goods[0] = dict(goods[0], price=1, parameters={'Цвет': 'белый'})
+        importer, shard_ids = self.run_shards(goods[1:] + goods[:1])
+        for shard_id in shard_ids:
+            import_shard(shard_id)
+        # подготовлен только изменившийся товар, пропавших нет
+        self.assertEqual(StagedProductInfo.objects.count(), 1)
+        self.assertEqual(catalog_state(self.shop), before)
+        stats = publish_catalog(self.shop, importer.import_id)
+        self.assertEqual(stats, {'unchanged': 7, 'updated': 1,
+                                 'inserted': 0, 'removed': 0})
+        item = CatalogItem.objects.get(shop=self.shop, external_id=1)
+        self.assertEqual((item.price, item.parameters),
+                         (1, {'Цвет': 'белый'}))
+
+    def test_publish_requires_all_shards(self):
+        importer, shard_ids = self.run_shards(make_goods(8))
+        import_shard(shard_ids[0])
+        with self.assertRaises(ValueError):
+            publish_catalog(self.shop, importer.import_id)
+
+    def test_discard(self):
+        goods = make_goods(8)
+        importer, shard_ids = self.run_shards(goods)
+        for shard_id in shard_ids:
+            import_shard(shard_id)
+        publish_catalog(self.shop, importer.import_id)
+        self.shop.refresh_from_db()
+        before = catalog_state(self.shop), self.shop.catalog_version
+        importer, shard_ids = self.run_shards(
+            [dict(item, price=1) for item in goods])
+        import_shard(shard_ids[0])
+        discard_import(importer.import_id)
+        self.assertFalse(ImportShard.objects.exists())
+        self.assertFalse(StagedProductInfo.objects.exists())
+        # каталог, витрина и версия каталога остались прежними
+        self.shop.refresh_from_db()
+        self.assertEqual((catalog_state(self.shop),
+                          self.shop.catalog_version), before)
+        self.assertFalse(CatalogItem.objects.filter(price=1).exists())
+        # магазин свободен для следующей загрузки
+        self.run_shards(goods)
+
+    def test_concurrent_import(self):
+        first, shard_ids = self.run_shards(make_goods(8))
+        for shard_id in shard_ids:
+            import_shard(shard_id)
+        with self.assertRaises(ImportInProgress):
+            self.run_shards(make_goods(4))
+        # брошенную загрузку по истечении срока сменяет новая, а ее
+        # публикация уже не пройдет
+        Shop.objects.filter(pk=self.shop.pk).update(
+            import_expires_at=timezone.now() - timedelta(seconds=1))
+        second, shard_ids = self.run_shards(make_goods(4))
+        with self.assertRaises(ImportInProgress):
+            publish_catalog(self.shop, first.import_id)
+        for shard_id in shard_ids:
+            import_shard(shard_id)
+        publish_catalog(self.shop, second.import_id)
+        self.assertEqual(ProductInfo.objects.filter(
+            shop=self.shop, is_active=True).count(), 4)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogSearchTest(TestCase):
+    """
+    Поиск по витрине, строки витрины обновляются при загрузке только
+    у изменившихся товаров
+    """
+
+    def setUp(self):
+        clear_intern()
+        cache.clear()
+        self.shop = Shop.objects.create(name='Связной')
+        self.goods = make_goods(6)
+        self.load(self.goods)
+
+    def load(self, goods, shop='Связной'):
+        importer = CatalogImporter(self.shop)
+        importer.run(price_list(goods, shop))
+        self.shop.refresh_from_db()
+        return publish_catalog(self.shop, importer.import_id,
+                               shop_name=importer.shop_name)
+
+    def search(self, q):
+        response = APIClient().get('/api/v1/products', {'q': q})
+        self.assertEqual(response.status_code, 200)
+        return [item['model'] for item in response.data['results']]
+
+    def test_search(self):
+        self.assertEqual(self.search('model/3'), ['model/3'])
+        self.assertEqual(len(self.search('черный')), 6)
+        self.assertEqual(self.search('Товар 5 черный'), ['model/5'])
+        self.assertEqual(self.search('белый'), [])
+
+    def test_incremental_refresh(self):
+        # строки, которые публикация не должна переписать
+        CatalogItem.objects.update(search_text='метка')
+        self.goods[2] = dict(self.goods[2], model='model/new', price=1)
+        stats = self.load(self.goods[:5])
+        self.assertEqual(stats, {'unchanged': 4, 'updated': 1, 'inserted': 0,
+                                 'removed': 1})
+        items = CatalogItem.objects.order_by('external_id')
+        self.assertEqual([item.external_id for item in items], [1, 2, 3, 4, 5])
+        self.assertEqual(
+            [item.search_text == 'метка' for item in items],
+            [True, True, False, True, True])
+        self.assertEqual(items[2].price, 1)
+        self.assertEqual(self.search('model/new'), ['model/new'])
+
+    def test_rename_shop(self):
+        self.load(self.goods, shop='Связной 2')
+        self.assertEqual(
+            set(CatalogItem.objects.values_list('shop_name', flat=True)),
+            {'Связной 2'})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PriceListFormatsTest(TestCase):
+    """
+    Один прайс-лист в YAML, CSV, JSON Lines и XLSX дает один и тот же
+    каталог. Колонки model и category_name необязательны
+    """
+    columns = ['id', 'category', 'name', 'price', 'price_rrc', 'quantity',
+               'Цвет', 'Память (Гб)']
+
+    def setUp(self):
+        clear_intern()
+        self.goods = make_goods(5)
+        for item in self.goods:
+            del item['model']
+
+    def rows(self):
+        return [[item['id'], item['category'], item['name'], item['price'],
+                 item['price_rrc'], item['quantity'],
+                 item['parameters']['Цвет'],
+                 item['parameters']['Память (Гб)']]
+                for item in self.goods]
+
+    def as_yaml(self):
+        return yaml.safe_dump({
+            'shop': 'Связной',
+            'categories': [{'id': category_id} for category_id in
+                           sorted({item['category'] for item in self.goods})],
+            'goods': self.goods}, allow_unicode=True).encode()
+
+    def as_csv(self):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=';')
+        writer.writerow(self.columns)
+        writer.writerows(self.rows())
+        return buffer.getvalue().encode()
+
+    def as_jsonl(self):
+        lines = [{'shop': 'Связной'}]
+        lines += [{'category': {'id': category_id}} for category_id in
+                  sorted({item['category'] for item in self.goods})]
+        lines += [{'good': item} for item in self.goods]
+        return '\n'.join(json.dumps(line, ensure_ascii=False)
+                         for line in lines).encode()
+
+    def as_xlsx(self):
+        workbook = Workbook()
+        workbook.active.append(self.columns)
+        for row in self.rows():
+            workbook.active.append(row)
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        return buffer.getvalue()
+
+    def load(self, price_format, data):
+        shop = Shop.objects.create(name=price_format)
+        importer = ShardedCatalogImporter(shop)
+        importer.run(iter_price_list(io.BytesIO(data), price_format))
+        publish_catalog(shop, importer.import_id)
+        return shop
+
+    def test_formats(self):
+        expected = catalog_state(self.load('yaml', self.as_yaml()))
+        self.assertEqual(len(expected), 5)
+        self.assertEqual({row[3] for row in expected}, {''})
+        for price_format in ('csv', 'jsonl', 'xlsx'):
+            data = getattr(self, f'as_{price_format}')()
+            with self.subTest(price_format):
+                self.assertEqual(
+                    catalog_state(self.load(price_format, data)), expected)
+        self.assertEqual(CatalogItem.objects.count(), 20)
+
+    def test_missing_column(self):
+        data = b'id,category,name,price\n1,1001,Phone,100\n'
+        with self.assertRaisesMessage(PriceListError,
+                                      'Нет колонок: price_rrc, quantity'):
+            list(iter_price_list(io.BytesIO(data), 'csv'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BenchmarkTest(TestCase):
+    """
+    Замер идет через задачу загрузки и убирает за собой только свои записи
+    и рабочий каталог
+    """
+
+    def test_cleanup(self):
+        clear_intern()
+        category = Category.objects.create(id=CATEGORY_ID_START,
+                                           name='Настоящая')
+        product = Product.objects.create(name='Настоящий', category=category)
+        color = Parameter.objects.create(name='Цвет')
+        workdirs = []
+        original = tempfile.mkdtemp
+
+        def mkdtemp(**kwargs):
+            workdirs.append(original(**kwargs))
+            return workdirs[-1]
+
+        # 50 товаров по 20 в шарде: загрузка идет через chord шардов
+        with mock.patch('tempfile.mkdtemp', mkdtemp), \
+                override_settings(IMPORT_SHARD_SIZE=20):
+            results = run_benchmark(50, max_parameters=3)
+        self.assertEqual([result['phase'] for result in results],
+                         ['import', 'reimport', 'export'])
+        self.assertEqual(results[1]['stats']['unchanged'], 50)
+        for result in results:
+            self.assertGreater(result['peak_memory_kb'], 0)
+        self.assertEqual(list(Category.objects.all()), [category])
+        self.assertEqual(list(Product.objects.all()), [product])
+        self.assertEqual(list(Parameter.objects.all()), [color])
+        self.assertFalse(Shop.objects.exists())
+        self.assertFalse(os.path.exists(workdirs[0]))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PriceListValidationTest(TestCase):
+    """
+    Проверка прайс-листа: отчет об ошибках, проверка в воркере без записи
+    в каталог
+    """
+
+    def records(self):
+        goods = make_goods(4, categories=1)
+        goods[1] = dict(goods[1], id=1)
+        del goods[2]['price']
+        goods[3] = dict(goods[3], category=7)
+        yield 'shop', 'Связной'
+        yield 'category', {'id': 'x', 'name': 'Неверная'}
+        yield 'category', {'id': 1001, 'name': 'Смартфоны'}
+        yield 'category', {'id': 1001, 'name': 'Смартфоны'}
+        yield 'category', {'id': 1002, 'name': 'Я' * 41}
+        yield 'category', {'id': 1003}
+        for item in goods:
+            yield 'good', item
+
+    def test_report(self):
+        report = validate_price_list(self.records())
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['categories'], 2)
+        self.assertEqual(report['goods'], 4)
+        self.assertEqual(
+            [(error['section'], error['number'], error['field'])
+             for error in report['errors']],
+            [('category', 1, 'id'), ('category', 4, 'name'),
+             ('good', 2, 'id'), ('good', 3, 'price'),
+             ('good', 4, 'category')])
+
+    def dry_run(self, client, url):
+        with mock.patch('backend.views.task_validate_price_list.delay') \
+                as delay:
+            response = client.post('/api/v1/partner/update',
+                                   {'url': url, 'dry_run': 'true'})
+        job = ImportJob.objects.latest('id')
+        self.assertEqual(response.json(), {'Status': True, 'job_id': job.id})
+        self.assertTrue(job.dry_run)
+        delay.assert_called_once_with(job.id, url, None)
+        return job
+
+    def test_dry_run_without_shop(self):
+        user = User.objects.create_user(email='shop@example.com',
+                                        password='password', type='shop',
+                                        is_active=True)
+        client = APIClient()
+        client.force_authenticate(user)
+        job = self.dry_run(client, 'https://example.com/new.yaml')
+        # проверка не создает магазин
+        self.assertFalse(Shop.objects.exists())
+        self.assertIsNone(job.shop)
+        response = client.get(f'/api/v1/partner/update/{job.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['dry_run'])
+        # без магазина и колонки shop загрузка назовет магазин по
+        # пользователю
+        data = 'id;category;name;price;price_rrc;quantity\n' \
+               '1;1001;Телефон;1000;1200;5\n'
+        with mock.patch('backend.tasks.open_price_list') as open_price_list:
+            open_price_list.return_value.__enter__.return_value = \
+                io.BytesIO(data.encode())
+            self.assertTrue(task_validate_price_list(job.id, job.url, 'csv'))
+        job.refresh_from_db()
+        self.assertEqual(job.result['shop'], 'shop@example.com')
+        self.assertEqual(validate_price_list(iter([]))['errors'][0]['error'],
+                         'Не указан магазин')
+
+    def test_dry_run(self):
+        user = User.objects.create_user(email='shop@example.com',
+                                        password='password', type='shop',
+                                        is_active=True)
+        shop = Shop.objects.create(name='Связной', user=user,
+                                   url='https://example.com/old.yaml')
+        client = APIClient()
+        client.force_authenticate(user)
+        url = 'https://example.com/new.yaml'
+        job = self.dry_run(client, url)
+        self.assertEqual(job.shop, shop)
+        shop.refresh_from_db()
+        self.assertEqual(shop.url, 'https://example.com/old.yaml')
+
+        data = yaml.safe_dump({
+            'shop': 'Связной', 'categories': [{'id': 1001, 'name': 'Ок'}],
+            'goods': make_goods(3, categories=1)}, allow_unicode=True)
+        with mock.patch('backend.tasks.open_price_list') as open_price_list:
+            open_price_list.return_value.__enter__.return_value = \
+                io.BytesIO(data.encode())
+            self.assertTrue(task_validate_price_list(job.id, url, 'yaml'))
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.goods_processed), ('done', 3))
+        self.assertTrue(job.result['valid'])
+        self.assertFalse(ProductInfo.objects.exists())
+
+        # в CSV нет колонки shop: проверка, как и загрузка, оставляет
+        # название магазина
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=';')
+        writer.writerow(['id', 'category', 'name', 'price', 'price_rrc',
+                         'quantity'])
+        writer.writerow([1, 1001, 'Телефон', 1000, 1200, 5])
+        with mock.patch('backend.tasks.open_price_list') as open_price_list:
+            open_price_list.return_value.__enter__.return_value = \
+                io.BytesIO(buffer.getvalue().encode())
+            self.assertTrue(task_validate_price_list(job.id, url, 'csv'))
+        job.refresh_from_db()
+        self.assertEqual(job.result['shop'], 'Связной')
+        self.assertEqual(job.result['errors'], [])
+
+        with mock.patch('backend.tasks.open_price_list',
+                        side_effect=PriceListError('Превышен размер')):
+            self.assertIsNone(task_validate_price_list(job.id, url))
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.errors), ('failed',
+                                                   ['Превышен размер']))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, EXPORT_ACCEL_REDIRECT='')
+class CatalogExportTest(TestCase):
+    """
+    Выгрузка в NDJSON и CSV загружается обратно, готовая выгрузка
+    переиспользуется до изменения каталога и докачивается по Range
+    """
+
+    def setUp(self):
+        clear_intern()
+        export_root = tempfile.mkdtemp(prefix='exports-')
+        self.addCleanup(shutil.rmtree, export_root, ignore_errors=True)
+        settings = self.settings(EXPORT_ROOT=export_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = User.objects.create_user(
+            email='shop@example.com', password='password', type='shop',
+            is_active=True)
+        self.shop = Shop.objects.create(name='Связной', user=self.user)
+        self.goods = make_goods(5)
+        self.load(self.shop, price_list(self.goods))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def load(self, shop, records):
+        importer = CatalogImporter(shop)
+        with self.captureOnCommitCallbacks(execute=True):
+            importer.run(records)
+            publish_catalog(shop, importer.import_id)
+        shop.refresh_from_db()
+
+    def export(self, compression=''):
+        with mock.patch('backend.views.task_product_export.delay') as delay:
+            response = self.client.post('/api/v1/partner/export', {
+                'format': 'ndjson', 'compression': compression})
+        export_id = response.data['export_id']
+        if delay.called:
+            task_product_export(self.user.id, export_id)
+        return export_id
+
+    def download(self, export_id, **headers):
+        response = self.client.get(f'/api/v1/partner/export/{export_id}',
+                                   headers=headers)
+        # прочитанный до конца потоковый ответ клиент закрывает сам
+        content = b''.join(response.streaming_content) \
+            if response.streaming else response.content
+        return response, content
+
+    def test_round_trip(self):
+        expected = catalog_state(self.shop)
+        for export_format, price_format in (('ndjson', 'jsonl'),
+                                            ('csv', 'csv')):
+            with self.subTest(export_format):
+                data = ''.join(iter_export(self.shop, export_format))
+                shop = Shop.objects.create(name=export_format)
+                self.load(shop, iter_price_list(io.BytesIO(data.encode()),
+                                                price_format))
+                self.assertEqual(catalog_state(shop), expected)
+        # YAML остается в прежнем виде
+        data = yaml.safe_load(''.join(iter_export(self.shop, 'yaml')))
+        self.assertEqual(data['goods'][0]['parameter'],
+                         {'Цвет': 'черный', 'Память (Гб)': '0'})
+
+    def test_csv_header(self):
+        chunks = iter_export(self.shop, 'csv')
+        with CaptureQueriesContext(connection) as queries:
+            header = next(chunks)
+        # колонки параметров берутся из фасетов, а не из параметров товаров
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'productparameter' in query['sql']])
+        self.assertTrue(header.rstrip().endswith('Память (Гб),Цвет'))
+
+    def test_disabled_shop(self):
+        export_id = self.export()
+        Shop.objects.filter(pk=self.shop.pk).update(state=False)
+        self.shop.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            rebuild_shop_catalog(self.shop)
+        # выключенный магазин выгружается пустым, готовая выгрузка
+        # не отдается
+        response = self.client.get('/api/v1/partner/export',
+                                   {'output': 'ndjson'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines, ['{"shop":"Связной"}'])
+        self.assertNotEqual(self.export(), export_id)
+
+    def test_snapshot(self):
+        export_id = self.export()
+        self.assertEqual(self.export(), export_id)
+        self.goods[0] = dict(self.goods[0], price=1)
+        self.load(self.shop, price_list(self.goods))
+        self.assertNotEqual(self.export(), export_id)
+
+    def test_range(self):
+        text = ''.join(iter_export(self.shop, 'ndjson')).encode()
+        export_id = self.export('gzip')
+        response, content = self.download(export_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(gzip.decompress(content), text)
+        etag = response['ETag']
+        for header, part in (('bytes=10-19', content[10:20]),
+                             ('bytes=-5', content[-5:]),
+                             (f'bytes={len(content) - 3}-',
+                              content[-3:])):
+            with self.subTest(header):
+                response, data = self.download(export_id, Range=header,
+                                               If_Range=etag)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(data, part)
+        response, _ = self.download(export_id,
+                                    Range=f'bytes={len(content)}-')
+        self.assertEqual(response.status_code, 416)
+        # файл изменился с прошлой докачки - отдаем целиком
+        response, data = self.download(export_id, Range='bytes=10-19',
+                                       If_Range='"old"')
+        self.assertEqual((response.status_code, data), (200, content))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ProductPaginationTest(TestCase):
+    """
+    Постраничный вывод по ключу проходит все строки при тысячах
+    одинаковых значений сортировки и не использует OFFSET
+    """
+    # больше offset_cutoff CursorPagination DRF
+    ties = 1200
+
+    @classmethod
+    def setUpTestData(cls):
+        clear_intern()
+        shop = Shop.objects.create(name='Связной')
+        goods = [dict(item, price=500, price_rrc=600, quantity=0)
+                 for item in make_goods(cls.ties)]
+        goods += make_goods(cls.ties + 50)[cls.ties:]
+        importer = CatalogImporter(shop)
+        importer.run(price_list(goods))
+        publish_catalog(shop, importer.import_id)
+        cls.rows = {row['pk']: row for row in CatalogItem.objects.values(
+            'pk', 'price', 'price_rrc', 'quantity')}
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def get(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def walk(self, ordering):
+        pages = []
+        data = self.get('/api/v1/products', {
+            'ordering': ordering, 'page_size': 200, 'fields': 'id'})
+        self.assertIsNone(data['previous'])
+        while True:
+            pages.append([item['id'] for item in data['results']])
+            if not data['next']:
+                break
+            data = self.get(data['next'])
+        # обратно по ссылкам previous - те же страницы
+        back = [[item['id'] for item in data['results']]]
+        while data['previous']:
+            data = self.get(data['previous'])
+            back.append([item['id'] for item in data['results']])
+        self.assertEqual(back[::-1], pages)
+        return [pk for page in pages for pk in page]
+
+    def test_ties(self):
+        for ordering in ('price', '-price', 'quantity', '-quantity',
+                         'price_rrc', '-price_rrc', 'id'):
+            with self.subTest(ordering):
+                field = ordering.lstrip('-')
+                field = 'pk' if field == 'id' else field
+                ids = self.walk(ordering)
+                self.assertEqual(
+                    ids, sorted(self.rows, reverse=ordering.startswith('-'),
+                                key=lambda pk: (self.rows[pk][field], pk)))
+
+    def test_no_offset(self):
+        data = self.get('/api/v1/products', {'ordering': 'quantity',
+                                             'page_size': 500})
+        with CaptureQueriesContext(connection) as queries:
+            self.get(data['next'])
+        self.assertFalse([query for query in queries
+                          if 'OFFSET' in query['sql'].upper()])
+
+    def test_invalid_cursor(self):
+        for cursor in ('junk', 'WzAsIFsxXV0=', 'WzAsIFsieCIsIDFdXQ=='):
+            response = self.client.get('/api/v1/products', {
+                'ordering': 'price', 'cursor': cursor})
+            self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogReadModelTest(TestCase):
+    """
+    Удаление продуктов, товаров и параметров и переименование категорий
+    меняют витрину, фасеты и версию каталога
+    """
+
+    def setUp(self):
+        clear_intern()
+        self.shop = Shop.objects.create(name='Связной')
+        importer = CatalogImporter(self.shop)
+        with self.captureOnCommitCallbacks(execute=True):
+            importer.run(price_list(make_goods(4, categories=1)))
+            publish_catalog(self.shop, importer.import_id)
+        self.version = self.catalog_version()
+
+    def catalog_version(self):
+        return Shop.objects.get(pk=self.shop.pk).catalog_version
+
+    def colors(self):
+        return category_facets(1001).get('Цвет')
+
+    def test_delete_product(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(name='Товар 0').delete()
+        self.assertEqual(CatalogItem.objects.count(), 3)
+        self.assertEqual(self.colors(), [{'value': 'черный', 'count': 3}])
+        self.assertGreater(self.catalog_version(), self.version)
+
+    def test_admin_delete_product_info(self):
+        model_admin = ProductInfoAdmin(ProductInfo, admin.site)
+        with self.captureOnCommitCallbacks(execute=True):
+            model_admin.delete_queryset(None, ProductInfo.objects.filter(
+                external_id__in=[1, 2]))
+        self.assertEqual(CatalogItem.objects.count(), 2)
+        self.assertEqual(self.colors(), [{'value': 'черный', 'count': 2}])
+        self.assertGreater(self.catalog_version(), self.version)
+
+    def test_delete_parameter(self):
+        with mock.patch('backend.signals.task_rebuild_catalog.delay',
+                        side_effect=task_rebuild_catalog) as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            Parameter.objects.get(name='Цвет').delete()
+        delay.assert_called_once_with(self.shop.id)
+        self.assertEqual(CatalogItem.objects.count(), 4)
+        self.assertFalse(CatalogItem.objects.filter(
+            parameters__has_key='Цвет').exists())
+        self.assertIsNone(self.colors())
+        self.assertGreater(self.catalog_version(), self.version)
+
+    def test_rename_category(self):
+        with mock.patch('backend.signals.task_rebuild_catalog.delay') \
+                as delay:
+            with self.captureOnCommitCallbacks() as callbacks:
+                Category.objects.filter(pk=1001).first().save()
+            # витрина не пересобирается внутри запроса
+            delay.assert_not_called()
+            for callback in callbacks:
+                callback()
+        delay.assert_called_once_with(self.shop.id)
+        self.assertGreater(self.catalog_version(), self.version)
+
+    def test_admin_rename_shop(self):
+        form = mock.Mock(changed_data=['name'])
+        self.shop.refresh_from_db()
+        self.shop.name = 'Связной 2'
+        with mock.patch('backend.admin.task_rebuild_catalog.delay') \
+                as delay, self.captureOnCommitCallbacks(execute=True):
+            ShopAdmin(Shop, admin.site).save_model(None, self.shop, form,
+                                                   True)
+        delay.assert_called_once_with(self.shop.id)
+        # выгрузки со старым названием больше не отдаются
+        self.assertGreater(self.catalog_version(), self.version)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogFacetsTest(TestCase):
+    """
+    Фасеты считаются по всей выдаче запроса и не показывают товары
+    выключенного магазина
+    """
+
+    def setUp(self):
+        clear_intern()
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='shop@example.com', password='password', type='shop',
+            is_active=True)
+        goods = make_goods(6, categories=2)
+        for item in goods[:2]:
+            item['parameters'] = dict(item['parameters'], Цвет='белый')
+        for name, user, shop_goods in (('Связной', self.user, goods),
+                                       ('Евросеть', None, goods[:3])):
+            shop = Shop.objects.create(name=name, user=user)
+            importer = CatalogImporter(shop)
+            importer.run(price_list(shop_goods))
+            publish_catalog(shop, importer.import_id)
+
+    def get(self, params):
+        response = APIClient().get('/api/v1/products',
+                                   {'page_size': 100, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def count(self, results):
+        facets = {}
+        for item in results:
+            for parameter in item['product_parameters']:
+                values = facets.setdefault(parameter['parameter'], {})
+                values[parameter['value']] = \
+                    values.get(parameter['value'], 0) + 1
+        return {name: sorted(
+            ({'value': value, 'count': count}
+             for value, count in values.items()),
+            key=lambda facet: (-facet['count'], facet['value']))
+            for name, values in sorted(facets.items())}
+
+    def test_result_set(self):
+        for params in ({}, {'category_id': 1001},
+                       {'shop_id': Shop.objects.get(name='Евросеть').id},
+                       {'q': 'белый', 'facets': 'true'},
+                       {'price_max': 1002, 'facets': 'true'},
+                       {'category_id': 1002, 'in_stock': 'true',
+                        'facets': 'true'},
+                       {'parameters': json.dumps({'Цвет': 'черный'}),
+                        'facets': 'true'}):
+            with self.subTest(params):
+                data = self.get(params)
+                self.assertTrue(data['results'])
+                self.assertEqual(data['facets'], self.count(data['results']))
+                self.assertFalse(data.get('facets_partial', False))
+        self.assertEqual(self.get({})['facets']['Цвет'], [
+            {'value': 'черный', 'count': 5},
+            {'value': 'белый', 'count': 4}])
+
+    def test_free_form_opt_in(self):
+        # фасеты по поиску и фильтрам считаются только по запросу
+        self.assertNotIn('facets', self.get({'q': 'белый'}))
+        with self.settings(FACETS_MAX_ITEMS=2):
+            data = self.get({'price_max': 1002, 'facets': 'true'})
+        self.assertGreater(len(data['results']), 2)
+        self.assertTrue(data['facets_partial'])
+        self.assertEqual(sum(value['count']
+                             for value in data['facets']['Цвет']), 2)
+
+    def test_first_page_only(self):
+        data = self.get({'page_size': 2})
+        response = APIClient().get(data['next'])
+        self.assertNotIn('facets', response.data)
+
+    def test_shop_off(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/api/v1/partner/state', {'state': 'off'})
+        self.assertTrue(response.json()['Status'])
+        shop_id = Shop.objects.get(name='Связной').id
+        data = self.get({'shop_id': shop_id, 'category_id': 1001})
+        self.assertEqual((data['results'], data['facets']), ([], {}))
+        self.assertFalse(CategoryFacet.objects.filter(
+            shop_id=shop_id).exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ResponseCacheTest(TransactionTestCase):
+    """
+    Ответы каталога читаются из кэша без запросов к базе, пока не изменится
+    версия каталога или магазина
+    """
+
+    def setUp(self):
+        cache.clear()
+        create_catalog()
+        self.client = APIClient()
+        self.shop, self.other_shop = Shop.objects.order_by('id')
+
+    def assertCached(self, url):
+        with self.assertNumQueries(0):
+            return self.client.get(url).data
+
+    def test_hits_and_misses(self):
+        catalog_cache.reset_stats(['products'])
+        first = self.client.get('/api/v1/products').data
+        self.assertEqual(self.assertCached('/api/v1/products'), first)
+        self.assertEqual(catalog_cache.stats(['products'])['products'],
+                         {'hits': 1, 'misses': 1, 'not_modified': 0})
+
+    def test_shop_version(self):
+        url = f'/api/v1/products?shop_id={self.shop.pk}'
+        other_url = f'/api/v1/products?shop_id={self.other_shop.pk}'
+        for address in (url, other_url, '/api/v1/products'):
+            self.client.get(address)
+        product_info = ProductInfo.objects.filter(shop=self.shop).first()
+        product_info.price = 1
+        product_info.save()
+        # ответы другого магазина остаются в кэше
+        self.assertCached(other_url)
+        for address in (url, '/api/v1/products'):
+            self.assertIn(1, [item['price'] for item in
+                              self.client.get(address).data['results']])
+
+    def test_categories(self):
+        self.client.get('/api/v1/categories')
+        self.assertCached('/api/v1/categories')
+        Category.objects.filter(name='Смартфоны').update(name='Телефоны')
+        Category.objects.get(name='Телефоны').save()
+        self.assertIn('Телефоны', [
+            category['name'] for category in
+            self.client.get('/api/v1/categories').data['results']])
+
+    def test_shared_version(self):
+        url = f'/api/v1/products?shop_id={self.shop.pk}'
+        self.client.get(url)
+        # название категории есть в ответах всех магазинов
+        Category.objects.get(name='Смартфоны').save()
+        catalog_cache.reset_stats(['products'])
+        self.client.get(url)
+        self.assertEqual(
+            catalog_cache.stats(['products'])['products']['misses'], 1)
+
+    def test_lost_version(self):
+        versions = catalog_cache.versions(self.shop.pk)
+        cache.delete(catalog_cache.version_key(self.shop.pk))
+        new_versions = catalog_cache.versions(self.shop.pk)
+        self.assertEqual(new_versions[0], versions[0])
+        self.assertGreater(new_versions[1], versions[1])
+
+
+# таблицы, которые растут вместе с каталогом и числом покупателей
+LARGE_TABLES = {model._meta.db_table for model in (
+    User, ConfirmEmailToken, Product, ProductInfo, ProductParameter, Order,
+    OrderItem, CatalogItem, CategoryFacet)}
+
+
+WHOLE_CATALOG_FACETS = 'FROM "backend_categoryfacet" GROUP BY'
+
+
+def iter_plan_nodes(node):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from iter_plan_nodes(child)
+
+
+@skipUnless(connection.vendor == 'postgresql',
+            'планы запросов проверяются только в PostgreSQL')
+@override_settings(CACHES=LOCMEM_CACHES)
+class QueryPlanTest(TestCase):
+    """
+    EXPLAIN для горячих запросов представлений и задач: ни один из них
+    не должен читать большие таблицы последовательным сканированием.
+
+    Планы строятся с настройками планировщика по умолчанию на данных,
+    объем которых похож на рабочий, поэтому Seq Scan в плане значит,
+    что планировщик и в рабочей базе выберет его
+    """
+    # строк в каждой большой таблице
+    rows = 20000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer = create_catalog()
+        cls.shop = Shop.objects.first()
+        cls.token = ConfirmEmailToken.objects.create(user=cls.buyer)
+        # покупатели с токенами, корзинами и заказами
+        users = User.objects.bulk_create(
+            User(email=f'user{index}@example.com', username=f'user{index}')
+            for index in range(cls.rows // 4))
+        ConfirmEmailToken.objects.bulk_create(
+            ConfirmEmailToken(user=user, key=f'key{user.pk}')
+            for user in users)
+        # оптовые магазины с параметрами товаров в сотне категорий
+        categories = Category.objects.bulk_create(
+            Category(name=f'Опт {index}') for index in range(100))
+        parameters = Parameter.objects.all()[:2]
+        cls.partner = User.objects.create_user(
+            email='partner@example.com', password='password', type='shop',
+            is_active=True)
+        wholesalers = Shop.objects.bulk_create(
+            Shop(name=f'Оптовик {index}',
+                 user=cls.partner if index == 0 else None)
+            for index in range(10))
+        cls.wholesale = wholesalers[0]
+        cls.wholesale_category = categories[0]
+        products = Product.objects.bulk_create(
+            Product(name=f'Опт {index}',
+                    category=categories[index % len(categories)])
+            for index in range(cls.rows))
+        product_infos = ProductInfo.objects.bulk_create(
+            ProductInfo(product=product,
+                        shop=wholesalers[index % len(wholesalers)],
+                        external_id=index, quantity=index % 50,
+                        price=index, price_rrc=index)
+            for index, product in enumerate(products))
+        ProductParameter.objects.bulk_create(
+            ProductParameter(product_info=product_info, parameter=parameter,
+                             value=str(product_info.external_id))
+            for product_info in product_infos for parameter in parameters)
+        orders = Order.objects.bulk_create(
+            Order(user=user, state=state)
+            for user in users for state in ('basket', 'new'))
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, quantity=1,
+                      product_info=product_infos[index % cls.rows])
+            for index, order in enumerate(orders * 2))
+        for wholesale in wholesalers:
+            rebuild_shop_catalog(wholesale)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def capture(self, run):
+        with CaptureQueriesContext(connection) as queries:
+            run()
+        return [query['sql'] for query in queries.captured_queries
+                if query['sql'].lstrip().upper().startswith(
+                    ('SELECT', 'UPDATE', 'DELETE', 'WITH'))]
+
+    def assertNoSeqScan(self, statements):
+        self.assertTrue(statements)
+        with connection.cursor() as cursor:
+            for sql in statements:
+                if WHOLE_CATALOG_FACETS in sql and 'WHERE' not in sql:
+                    # фасеты всего каталога без фильтров - свертка всего
+                    # индекса фасетов, один раз на версию каталога: ответ
+                    # кэшируется
+                    continue
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                for node in iter_plan_nodes(plan[0]['Plan']):
+                    if node['Node Type'] == 'Seq Scan':
+                        self.assertNotIn(
+                            node['Relation Name'], LARGE_TABLES,
+                            f'последовательное сканирование в {sql}')
+
+    def test_basket(self):
+        client = APIClient()
+        client.force_authenticate(self.buyer)
+        basket = Order.objects.get(user=self.buyer, state='basket')
+        item = basket.ordered_items.first()
+        self.assertNoSeqScan(self.capture(lambda: (
+            client.get('/api/v1/basket'),
+            client.put('/api/v1/basket', {'items': json.dumps(
+                [{'id': item.id, 'quantity': 5}])}),
+            client.delete('/api/v1/basket', {'items': str(item.id)}))))
+
+    def test_orders(self):
+        client = APIClient()
+        client.force_authenticate(self.buyer)
+        self.assertNoSeqScan(self.capture(
+            lambda: client.get('/api/v1/order')))
+
+    def test_products(self):
+        client = APIClient()
+        category = Category.objects.first()
+        params_list = (
+            {}, {'shop_id': self.shop.pk},
+            {'category_id': category.pk, 'ordering': 'price'},
+            {'price_min': 100, 'price_max': 200, 'ordering': '-price'},
+            {'category_id': category.pk, 'parameters': json.dumps(
+                {'Цвет': 'черный'})},
+            {'q': 'Товар'},
+            {'category_id': self.wholesale_category.pk, 'ordering': 'price',
+             'price_min': 1000},
+            {'shop_id': self.wholesale.pk, 'ordering': 'quantity'},
+            {'shop_id': self.wholesale.pk, 'parameters': json.dumps(
+                {'Цвет': '5'})})
+
+        def run():
+            for params in params_list:
+                cache.clear()
+                response = client.get('/api/v1/products', params)
+                self.assertEqual(response.status_code, 200)
+                if response.data['next']:
+                    # страница по курсору среди тысяч равных значений
+                    self.assertEqual(client.get(
+                        response.data['next']).status_code, 200)
+
+        self.assertNoSeqScan(self.capture(run))
+
+    def test_confirm_account(self):
+        self.assertNoSeqScan(self.capture(
+            lambda: APIClient().post('/api/v1/user/register/confirm', {
+                'email': self.buyer.email, 'token': self.token.key})))
+
+    def test_tasks(self):
+        self.assertNoSeqScan(self.capture(lambda: (
+            task_new_user(self.buyer.id),
+            task_rebuild_catalog(self.shop.id),
+            list(iter_export_goods(self.shop)))))
+
+    def wholesale_price_list(self):
+        """
+        Прайс-лист оптового магазина: у части товаров новые цены, часть
+        пропала
+        """
+        goods = list(iter_export_goods(self.wholesale))
+        for good in goods[:20]:
+            good['price'] += 1
+        yield 'shop', self.wholesale.name
+        for category in export_categories(self.wholesale):
+            yield 'category', category
+        for good in goods[:-20]:
+            yield 'good', good
+
+    def test_import(self):
+        goods = ProductInfo.objects.filter(shop=self.wholesale)
+        job = ImportJob.objects.create(shop=self.wholesale,
+                                       user=self.partner,
+                                       url='https://example.com/opt.yaml')
+        result = {}
+        # в рабочей базе пачка в тысячи раз меньше таблицы, здесь таблицы
+        # в 20 тысяч строк, поэтому и пачка меньше
+        with self.settings(IMPORT_SHARD_SIZE=500, IMPORT_BATCH_SIZE=100), \
+                mock.patch('backend.tasks.open_price_list'), \
+                mock.patch('backend.tasks.iter_price_list',
+                           return_value=self.wholesale_price_list()), \
+                mock.patch('backend.tasks.chord') as chord:
+            statements = self.capture(lambda: result.update(
+                task_product_import(self.wholesale.id, job.url, job.id)))
+            # шарды и публикацию, как и воркеры, запускаем по очереди
+            shard_ids = [signature.args[0]
+                         for signature in chord.call_args.args[0]]
+            self.assertEqual(len(shard_ids), result['shards'])
+            statements += self.capture(lambda: [
+                import_shard(shard_id) for shard_id in shard_ids])
+            statements += self.capture(lambda: result.update(
+                stats=publish_catalog(self.wholesale, result['import_id'],
+                                      job=job)))
+        # у созданных bulk_create товаров нет отпечатка, поэтому
+        # обновляются все товары прайс-листа
+        self.assertEqual(result['stats']['updated'], goods.count() - 20)
+        self.assertEqual(result['stats']['removed'], 20)
+        self.assertNoSeqScan(statements)
+
+    def test_partner_update(self):
+        client = APIClient()
+        client.force_authenticate(self.partner)
+        url = 'https://example.com/opt.yaml'
+        with mock.patch('backend.views.task_product_import.delay'), \
+                mock.patch('backend.views.task_validate_price_list.delay'):
+            statements = self.capture(lambda: (
+                client.post('/api/v1/partner/update', {'url': url}),
+                client.post('/api/v1/partner/update',
+                            {'url': url, 'dry_run': 'true'})))
+        job = ImportJob.objects.latest('id')
+        statements += self.capture(lambda: client.get(
+            f'/api/v1/partner/update/{job.id}'))
+        self.assertNoSeqScan(statements)
+
+    def test_export(self):
+        export_root = tempfile.mkdtemp(prefix='exports-')
+        self.addCleanup(shutil.rmtree, export_root, ignore_errors=True)
+        client = APIClient()
+        client.force_authenticate(self.partner)
+        result = {}
+
+        def export():
+            with mock.patch('backend.views.task_product_export.delay'):
+                response = client.post('/api/v1/partner/export',
+                                       {'format': 'csv'})
+            result['export_id'] = response.data['export_id']
+            task_product_export(self.partner.id, result['export_id'])
+
+        def download():
+            export_id = result['export_id']
+            for url in (f'/api/v1/partner/export/{export_id}',
+                        f'/api/v1/partner/export/{export_id}/manifest',
+                        '/api/v1/partner/export?output=csv'):
+                response = client.get(url)
+                self.assertEqual(response.status_code, 200)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+
+        with self.settings(EXPORT_ROOT=export_root):
+            statements = self.capture(export)
+            statements += self.capture(download)
+        self.assertNoSeqScan(statements)
+
+    def test_shops_and_categories(self):
+        client = APIClient()
+
+        def run():
+            for url in ('/api/v1/shops', '/api/v1/categories'):
+                cache.clear()
+                self.assertEqual(client.get(url).status_code, 200)
+
+        self.assertNoSeqScan(self.capture(run))
@@ -0,0 +1,53 @@
+import threading
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+# (база, функция) -> накопленный вызов, свои в каждом потоке, как и
+# соединения с базой
+_local = threading.local()
+
+
+class OnCommitBatch:
+    """
+    Значения, накопленные до фиксации транзакции, для одного вызова func
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.values = set()
+        self.pending = False
+
+    def add(self, values):
+        self.values.update(values)
+        self.pending = True
+
+    def flush(self):
+        if not self.pending:
+            return
+        values, self.values = self.values, set()
+        self.pending = False
+        self.func(values)
+
+
+def on_commit_once(func, values=(), using=None):
+    """
+    Вызываем func(values) после фиксации текущей транзакции один раз,
+    сколько бы раз on_commit_once ни вызывалась в ней.
+
+    Значения всех вызовов с той же func объединяются в одно множество.
+    Каскадное удаление тысяч записей дает один вызов func после фиксации,
+    а не вызов на каждую запись. Вне транзакции func вызывается сразу.
+
+    Откат транзакции отбрасывает отложенный вызов, а накопленные значения
+    достаются следующему вызову func: лишнее увеличение версии безопасно,
+    потерянное - нет.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    batches = _local.__dict__.setdefault('batches', {})
+    batch = batches.get((using, func))
+    if batch is None:
+        batch = batches[(using, func)] = OnCommitBatch(func)
+    batch.add(values)
+    # повторные регистрации дешевы: первый же вызов после фиксации
+    # обработает все значения, остальные ничего не делают
+    transaction.on_commit(batch.flush, using=using)
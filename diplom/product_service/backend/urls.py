@@ -3,7 +3,8 @@ from django_rest_passwordreset.views import reset_password_request_token, \
     reset_password_confirm
 from backend.views import ContactView, ShopView, RegisterAccount, \
     ConfirmAccount, LoginAccount, ProductInfoView, BasketView, PartnerUpdate, \
-    AccountDetails, OrderView, CategoryView, PartnerState,Partnerexport
+    AccountDetails, OrderView, CategoryView, PartnerState,Partnerexport, \
+    PartnerUpdateStatus, PartnerExportFile, PartnerExportManifest
 
 
 
@@ -13,7 +14,13 @@ app_name = 'backend'
 
 urlpatterns = [
     path('partner/update', PartnerUpdate.as_view(), name='partner-update'),
+    path('partner/update/<int:job_id>', PartnerUpdateStatus.as_view(),
+         name='partner-update-status'),
     path('partner/export', Partnerexport.as_view(), name='part-export'),
+    path('partner/export/<int:export_id>', PartnerExportFile.as_view(),
+         name='partner-export-file'),
+    path('partner/export/<int:export_id>/manifest',
+         PartnerExportManifest.as_view(), name='partner-export-manifest'),
     path('user/register', RegisterAccount.as_view(), name='user-register'),
     path('user/register/confirm', ConfirmAccount.as_view(),
          name='user-register-confirm'),
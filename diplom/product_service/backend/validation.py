@@ -0,0 +1,152 @@
+from backend.readers import PriceListError
+
+# сколько ошибок возвращаем в отчете, остальные только считаем
+MAX_REPORTED_ERRORS = 100
+
+
+def _positive_integer(value):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        return 'Ожидается целое неотрицательное число'
+
+
+def _string(max_length):
+    def check(value):
+        if not isinstance(value, (str, int, float)):
+            return 'Ожидается строка'
+        if len(str(value)) > max_length:
+            return f'Длина больше {max_length} символов'
+    return check
+
+
+_parameter_name = _string(40)
+_parameter_value = _string(100)
+
+
+def _parameters(value):
+    if not isinstance(value, dict):
+        return 'Ожидается словарь параметров'
+    for name, parameter_value in value.items():
+        if _parameter_name(name) or _parameter_value(parameter_value):
+            return f'Неверный параметр {name!r}'
+
+
+# поле товара -> проверка значения, порядок как в прайс-листе
+GOOD_SCHEMA = (
+    ('id', _positive_integer),
+    ('category', _positive_integer),
+    ('model', _string(80)),
+    ('name', _string(80)),
+    ('price', _positive_integer),
+    ('price_rrc', _positive_integer),
+    ('quantity', _positive_integer),
+    ('parameters', _parameters),
+)
+
+CATEGORY_SCHEMA = (
+    ('id', _positive_integer),
+    ('name', _string(40)),
+)
+
+# необязательные поля: табличные прайс-листы могут не содержать колонок
+# model и category_name
+GOOD_OPTIONAL = ('model', 'parameters')
+CATEGORY_OPTIONAL = ('name',)
+
+
+class PriceListValidator:
+    """
+    Проверка прайс-листа без обращения к базе.
+
+    Проверяет обязательные поля, числовые цены и количество, ссылки товаров
+    на категории из того же файла и повторяющиеся внешние ИД. Записи
+    читаются потоково, в памяти держатся только ИД категорий и товаров.
+    Табличные прайс-листы могут не содержать колонки shop, тогда, как
+    и при загрузке, остается название магазина shop_name.
+    """
+
+    def __init__(self, shop_name=None):
+        self.shop = shop_name
+        self.categories = set()
+        # номер записи категории, включая неверные и повторные
+        self.category_number = 0
+        self.external_ids = set()
+        # id категории -> номер первого товара, который на нее ссылается
+        self.unresolved = {}
+        self.goods = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, section, number, field, message, external_id=None):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'section': section, 'number': number,
+                                'id': external_id, 'field': field,
+                                'error': message})
+
+    def check(self, section, number, value, schema, optional=()):
+        if not isinstance(value, dict):
+            self.error(section, number, None, 'Ожидается словарь')
+            return False
+        valid = True
+        for field, check in schema:
+            if field not in value:
+                if field in optional:
+                    continue
+                message = 'Обязательное поле'
+            else:
+                message = check(value[field])
+            if message:
+                self.error(section, number, field, message, value.get('id'))
+                valid = False
+        return valid
+
+    def feed(self, records):
+        for section, value in records:
+            if section == 'shop':
+                self.shop = value
+            elif section == 'category':
+                self.category_number += 1
+                if self.check('category', self.category_number, value,
+                              CATEGORY_SCHEMA, CATEGORY_OPTIONAL):
+                    self.categories.add(value['id'])
+            elif section == 'good':
+                self.goods += 1
+                if not self.check('good', self.goods, value, GOOD_SCHEMA,
+                                  GOOD_OPTIONAL):
+                    continue
+                if value['id'] in self.external_ids:
+                    self.error('good', self.goods, 'id',
+                               'Повторяющийся внешний ИД', value['id'])
+                self.external_ids.add(value['id'])
+                if value['category'] not in self.categories:
+                    self.unresolved.setdefault(value['category'], self.goods)
+
+    def report(self):
+        if not self.shop:
+            self.error('shop', None, 'shop', 'Не указан магазин')
+        for category_id, number in self.unresolved.items():
+            # категория могла быть объявлена после товаров
+            if category_id not in self.categories:
+                self.error('good', number, 'category',
+                           f'Неизвестная категория {category_id}')
+        return {
+            'valid': self.error_count == 0,
+            'shop': self.shop,
+            'categories': len(self.categories),
+            'goods': self.goods,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+
+def validate_price_list(records, shop_name=None):
+    """
+    Проверяем записи прайс-листа и возвращаем отчет об ошибках.
+    shop_name - название магазина, если в файле его нет
+    """
+    validator = PriceListValidator(shop_name)
+    try:
+        validator.feed(records)
+    except PriceListError as error:
+        validator.error('file', None, None, str(error))
+    return validator.report()
@@ -0,0 +1,23 @@
+from django.db.models import F
+
+from backend.caching import catalog_cache
+from backend.models import Shop
+from backend.transactions import on_commit_once
+
+
+def _bump_versions(shop_ids):
+    Shop.objects.filter(pk__in=shop_ids).update(
+        catalog_version=F('catalog_version') + 1)
+    catalog_cache.bump_now(shop_ids)
+
+
+def bump_catalog_version(shop_ids):
+    """
+    Увеличиваем версию каталога магазинов после фиксации транзакции,
+    один раз на транзакцию, см. on_commit_once.
+    Вместе с версией каталога увеличиваются версии ответов в catalog_cache.
+    """
+    shop_ids = {shop_id for shop_id in shop_ids if shop_id is not None}
+    if not shop_ids:
+        return
+    on_commit_once(_bump_versions, shop_ids)
@@ -1,10 +1,17 @@
+import os
+import re
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from rest_framework import status
 from backend.serializers import UserSerializer, ContactSerializer, Shop, \
     ProductInfoSerializer, OrderItemSerializer, ShopSerializer, \
-    OrderSerializer, CategorySerializer
+    OrderSerializer, CategorySerializer, ImportJobSerializer, \
+    ExportJobSerializer, CatalogItemSerializer, CatalogItemValuesSerializer, \
+    OrderValuesSerializer, CATALOG_ITEM_COLUMNS, catalog_item_columns
 from backend.models import Contact, Shop, ConfirmEmailToken, ProductInfo, \
-    Category, Product, Parameter, ProductParameter, Order, User, OrderItem
+    Category, Product, Parameter, ProductParameter, Order, User, OrderItem, \
+    ImportJob, ExportJob, CatalogItem
 from distutils.util import strtobool
 from rest_framework.request import Request
 from django.contrib.auth import authenticate
@@ -14,16 +21,27 @@ from django.core.exceptions import ValidationError, ObjectDoesNotExist, \
 from django.core.validators import URLValidator
 from django.db import IntegrityError
 from django.db.models import Q, Sum, F
-from django.http import JsonResponse
-from requests import get
+from django.http import JsonResponse, FileResponse, StreamingHttpResponse, \
+    HttpResponse
 from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ParseError
 from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from ujson import loads as load_json
-from yaml import load as load_yaml, Loader
 from backend.signals import new_user_registered, new_order
-from backend.tasks import task_product_export, task_product_import
+from backend.tasks import task_product_export, task_product_import, \
+    task_validate_price_list, task_rebuild_catalog
+from backend.readers import PRICE_LIST_READERS
+from backend.pagination import ProductCursorPagination
+from backend.caching import CachedListMixin, catalog_cache
+from backend.search import search_catalog, parse_parameter_filters, \
+    filter_parameters
+from backend.catalog import category_facets, result_facets, \
+    rebuild_shop_catalog
+from backend.exporters import export_file_path, iter_export, \
+    EXPORT_FORMATS, EXPORT_COMPRESSIONS, find_snapshot, iter_file_range, \
+    export_content_type, export_download_name
 
 
 class RegisterAccount(APIView):
@@ -203,33 +221,185 @@ class ShopView(APIView):
         return Response(serializer.data)
 
 
-class ProductInfoView(APIView):
+class ProductInfoView(CachedListMixin, ListAPIView):
     """
     Класс для поиска товаров.
+    Товары читаются из витрины CatalogItem одним запросом по индексу,
+    выдача постраничная по ключу, см. ProductCursorPagination.
+    Параметр q - поиск по названию, модели и значениям параметров,
+    см. search_catalog.
+    Параметр parameters - JSON-объект {параметр: значение или список
+    значений}, см. filter_parameters.
+    Первая страница (без cursor) содержит facets - значения параметров
+    с числом товаров по всей выдаче запроса. Без q, parameters, диапазонов
+    и in_stock они берутся из индекса CategoryFacet. С ними фасеты
+    считаются по отобранным строкам витрины только по запросу facets=true
+    и не больше чем по FACETS_MAX_ITEMS строкам, см. result_facets;
+    facets_partial=true - выдача больше и посчитана не вся.
+    Параметры price_min, price_max, price_rrc_min, price_rrc_max,
+    quantity_min, quantity_max - границы диапазонов включительно,
+    in_stock=true - только товары в наличии. ordering - id, price,
+    price_rrc, quantity, с минусом по убыванию. Сортировки и диапазоны
+    внутри категории и магазина идут по составным индексам витрины.
+    Параметр fields - поля ответа через запятую (id, model, product, shop,
+    quantity, price, price_rrc), include=parameters добавляет к ним
+    product_parameters. Из базы читаются только колонки этих полей.
+    Без fields ответ полный.
+    Ответ с shop_id кэшируется по версии магазина, остальные - по общей
+    версии каталога
     """
-
-    def get(self, request: Request, *args, **kwargs):
-        query = Q(shop__state=True)
-        shop_id = request.query_params.get('shop_id')
-        category_id = request.query_params.get('category_id')
+    serializer_class = CatalogItemSerializer
+    # быстрая сериализация из values(), None - через serializer_class
+    values_serializer_class = CatalogItemValuesSerializer
+    pagination_class = ProductCursorPagination
+    cache_name = 'products'
+    # значение include -> поле ответа
+    includes = {'parameters': 'product_parameters'}
+    # параметр запроса -> условие по колонке витрины
+    range_filters = {
+        'price_min': 'price__gte',
+        'price_max': 'price__lte',
+        'price_rrc_min': 'price_rrc__gte',
+        'price_rrc_max': 'price_rrc__lte',
+        'quantity_min': 'quantity__gte',
+        'quantity_max': 'quantity__lte',
+    }
+
+    def get_serializer_class(self):
+        return self.values_serializer_class or self.serializer_class
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs['fields'] = self.get_response_fields()
+        return super().get_serializer(*args, **kwargs)
+
+    def get_response_fields(self):
+        """
+        Поля ответа по параметрам fields и include
+        """
+        fields = self.request.query_params.get('fields')
+        include = self.request.query_params.get('include')
+        if not fields:
+            return tuple(CATALOG_ITEM_COLUMNS)
+        fields = {name.strip() for name in fields.split(',') if name.strip()}
+        unknown = fields - set(CATALOG_ITEM_COLUMNS)
+        if unknown:
+            raise ParseError({'fields': f"Неизвестные поля: "
+                                        f"{', '.join(sorted(unknown))}"})
+        if include:
+            for name in include.split(','):
+                if name.strip() not in self.includes:
+                    raise ParseError({'include': f'Неизвестное значение: '
+                                                 f'{name.strip()}'})
+                fields.add(self.includes[name.strip()])
+        return tuple(name for name in CATALOG_ITEM_COLUMNS if name in fields)
+
+    def get_columns(self):
+        """
+        Колонки витрины для полей ответа и ключа постраничного вывода
+        """
+        columns = catalog_item_columns(self.get_response_fields())
+        ordering = self.paginator.get_ordering(self.request, None, self)
+        return tuple(dict.fromkeys(
+            columns + tuple(name.lstrip('-') for name in ordering)))
+
+    def get_cache_shop_id(self):
+        shop_id = self.request.query_params.get('shop_id')
+        if shop_id and shop_id.isdigit():
+            return int(shop_id)
+        return None
+
+    def get_queryset(self):
+        query = Q()
+        shop_id = self.request.query_params.get('shop_id')
+        category_id = self.request.query_params.get('category_id')
 
         if shop_id:
             query = query & Q(shop_id=shop_id)
 
         if category_id:
-            query = query & Q(product__category_id=category_id)
-
-        # фильтруем и отбрасываем дуликаты
-        queryset = (ProductInfo.objects.filter(query)
-                    .select_related
-                    ('shop', 'product__category').prefetch_related(
-            'product_parameters__parameter').distinct())
-        serializer = ProductInfoSerializer(queryset, many=True)
-
-        return Response(serializer.data)
+            query = query & Q(category_id=category_id)
+
+        for param, lookup in self.range_filters.items():
+            value = self.request.query_params.get(param)
+            if value:
+                if not value.isdigit():
+                    raise ParseError(
+                        {param: 'Ожидается неотрицательное целое число'})
+                query = query & Q(**{lookup: int(value)})
+
+        in_stock = self.request.query_params.get('in_stock')
+        if in_stock:
+            try:
+                if strtobool(in_stock):
+                    query = query & Q(quantity__gt=0)
+            except ValueError as error:
+                raise ParseError({'in_stock': str(error)})
+
+        queryset = CatalogItem.objects.filter(query)
+        q = self.request.query_params.get('q')
+        if q:
+            queryset = search_catalog(queryset, q)
+        parameters = self.request.query_params.get('parameters')
+        if parameters:
+            try:
+                parameters = load_json(parameters)
+            except ValueError:
+                raise ParseError({'parameters': 'Неверный формат запроса'})
+            try:
+                filters = parse_parameter_filters(parameters)
+            except ValueError as error:
+                raise ParseError({'parameters': str(error)})
+            queryset = filter_parameters(queryset, filters)
+        columns = self.get_columns()
+        if self.values_serializer_class:
+            return queryset.values(*columns)
+        return queryset.only(*(column for column in columns
+                               if column != 'pk'))
+
+    def paginate_queryset(self, queryset):
+        # вся выдача запроса, по ней считаются фасеты
+        self.result_queryset = queryset
+        return super().paginate_queryset(queryset)
+
+    def facets_requested(self):
+        facets = self.request.query_params.get('facets')
+        try:
+            return bool(facets) and strtobool(facets)
+        except ValueError as error:
+            raise ParseError({'facets': str(error)})
+
+    def get_facets(self):
+        """
+        Поля ответа с фасетами первой страницы
+        """
+        params = self.request.query_params
+        if any(params.get(name) for name in (
+                'q', 'parameters', 'in_stock', *self.range_filters)):
+            # группировка по строкам выдачи дорогая, только по запросу
+            if not self.facets_requested():
+                return {}
+            max_items = settings.FACETS_MAX_ITEMS
+            return {
+                'facets': result_facets(self.result_queryset, max_items),
+                'facets_partial': self.result_queryset.order_by()[
+                    max_items:max_items + 1].exists(),
+            }
+        category_id = params.get('category_id')
+        return {'facets': category_facets(
+            int(category_id) if category_id and category_id.isdigit()
+            else None, self.get_cache_shop_id())}
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.paginator.cursor_query_param not in self.request.query_params:
+            response.data.update(self.get_facets())
+        return response
 
 
 class BasketView(APIView):
+    # OrderSerializer или быстрая сериализация из values()
+    order_serializer_class = OrderValuesSerializer
+
     # получить корзину
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
@@ -243,7 +413,7 @@ class BasketView(APIView):
             total_sum=Sum(F('ordered_items__quantity') * F(
                 'ordered_items__product_info__price'))).distinct()
 
-        serializer = OrderSerializer(basket, many=True)
+        serializer = self.order_serializer_class(basket, many=True)
         return Response(serializer.data)
 
     # редактировать корзину
@@ -436,6 +606,8 @@ class OrderView(APIView):
     Attributes:
     - None
     """
+    # OrderSerializer или быстрая сериализация из values()
+    order_serializer_class = OrderValuesSerializer
 
     # получить мои заказы
     def get(self, request, *args, **kwargs):
@@ -450,7 +622,7 @@ class OrderView(APIView):
             total_sum=Sum(F('ordered_items__quantity') * F(
                 'ordered_items__product_info__price'))).distinct())
 
-        serializer = OrderSerializer(order, many=True)
+        serializer = self.order_serializer_class(order, many=True)
         return Response(serializer.data)
 
     # разместить заказ из корзины
@@ -480,20 +652,22 @@ class OrderView(APIView):
                              'Errors': 'Не указаны все необходимые аргументы'})
 
 
-class CategoryView(ListAPIView):
+class CategoryView(CachedListMixin, ListAPIView):
     """
     Класс для просмотра категорий
     """
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    cache_name = 'categories'
 
 
-class ShopView(ListAPIView):
+class ShopView(CachedListMixin, ListAPIView):
     """
     Класс для просмотра списка магазинов
     """
     queryset = Shop.objects.filter(state=True)
     serializer_class = ShopSerializer
+    cache_name = 'shops'
 
 
 class PartnerUpdate(APIView):
@@ -509,9 +683,6 @@ class PartnerUpdate(APIView):
         if request.user.type != 'shop':
             return JsonResponse(
                 {'Status': False, 'Error': 'Только для магазинов'}, status=403)
-        UserModel = get_user_model()
-        user = UserModel.objects.get(pk=request.user.id)
-        user_id = user.pk
 
         url = request.data.get('url')
         if url:
@@ -521,21 +692,68 @@ class PartnerUpdate(APIView):
                 validate_url(url)
             except ValidationError as e:
                 return JsonResponse({'Status': False, 'Error': str(e)})
+            try:
+                dry_run = strtobool(str(request.data.get('dry_run', 'false')))
+            except ValueError as error:
+                return JsonResponse({'Status': False, 'Error': str(error)})
+            # формат можно указать явно, иначе он определяется по ответу
+            price_format = request.data.get('format') or None
+            if price_format and price_format not in PRICE_LIST_READERS:
+                return JsonResponse({
+                    'Status': False,
+                    'Error': 'Поддерживаемые форматы: '
+                             + ', '.join(PRICE_LIST_READERS)})
+            if dry_run:
+                # только проверяем файл: магазин не создаем, каталог
+                # и ссылку магазина не меняем. Файл скачивает и разбирает
+                # воркер, отчет читается из результата загрузки
+                shop = Shop.objects.filter(user_id=request.user.id).first()
+                job = ImportJob.objects.create(shop=shop, user=request.user,
+                                               url=url, dry_run=True)
+                task_validate_price_list.delay(job.id, url, price_format)
             else:
-                stream = get(url).content
+                # прайс-лист скачивает и разбирает воркер, в очередь
+                # уходят только ссылка и магазин
+                shop, created = Shop.objects.update_or_create(
+                    user_id=request.user.id, defaults={'url': url},
+                    create_defaults={
+                        'url': url,
+                        'name': (request.user.company
+                                 or request.user.email)[:50]})
+                if created:
+                    # новый магазин сразу появляется в /shops
+                    catalog_cache.bump([shop.id])
+                job = ImportJob.objects.create(shop=shop, user=request.user,
+                                               url=url)
+                task_product_import.delay(shop.id, url, job.id,
+                                          price_format)
+
+            return JsonResponse({'Status': True, 'job_id': job.id})
+        return JsonResponse({'Status': False,
+                             'Errors': 'Не указаны все необходимые аргументы'})
 
-                data = load_yaml(stream, Loader=Loader)
-                if data == {404: 'Not Found'}:
-                    return Response({'message': 'Неверный url'},
-                                    status=status.HTTP_404_NOT_FOUND)
 
-                task_product_import.delay(request.user.id, data, user_id,
-                                          *args,
-                                          **kwargs)
+class PartnerUpdateStatus(APIView):
+    """
+    Статус загрузки прайс-листа
+    """
 
-            return JsonResponse({'Status': True})
-        return JsonResponse({'Status': False,
-                             'Errors': 'Не указаны все необходимые аргументы'})
+    def get(self, request, job_id, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'},
+                                status=403)
+
+        if request.user.type != 'shop':
+            return JsonResponse(
+                {'Status': False, 'Error': 'Только для магазинов'}, status=403)
+
+        job = ImportJob.objects.filter(id=job_id,
+                                       user_id=request.user.id).first()
+        if job is None:
+            return Response({'message': 'Загрузка не найдена'},
+                            status=status.HTTP_404_NOT_FOUND)
+        serializer = ImportJobSerializer(job)
+        return Response(serializer.data)
 
 
 class PartnerState(APIView):
@@ -593,8 +811,18 @@ class PartnerState(APIView):
         state = request.data.get('state')
         if state:
             try:
-                Shop.objects.filter(user_id=request.user.id).update(
-                    state=strtobool(state))
+                state = strtobool(state)
+                shops = Shop.objects.filter(user_id=request.user.id)
+                shops.update(state=state)
+                catalog_cache.bump(shops.values_list('id', flat=True))
+                if state:
+                    # витрину большого магазина собирает воркер
+                    for shop_id in shops.values_list('id', flat=True):
+                        task_rebuild_catalog.delay(shop_id)
+                else:
+                    # удаляем витрину и фасеты выключенного магазина
+                    for shop in shops:
+                        rebuild_shop_catalog(shop)
                 return JsonResponse({'Status': True})
             except ValueError as error:
                 return JsonResponse({'Status': False, 'Errors': str(error)})
@@ -605,9 +833,49 @@ class PartnerState(APIView):
 
 class Partnerexport(APIView):
     """
-    Экспорт товаров в файл
+    Экспорт товаров: POST - в файл через Celery,
+    GET - сразу потоковым ответом
     """
 
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'message': 'Требуется войти'},
+                            status=status.HTTP_403_FORBIDDEN)
+        if request.user.type != 'shop':
+            return Response({'message': 'Только для магазинов'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        # параметр format в строке запроса занят DRF, поэтому output
+        export_format = request.query_params.get('output', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return Response({'message': 'Поддерживаемые форматы: '
+                                        + ', '.join(EXPORT_FORMATS)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        shop = Shop.objects.filter(user_id=request.user.id).first()
+        if shop is None:
+            return Response({'message': 'Магазин не найден'},
+                            status=status.HTTP_404_NOT_FOUND)
+        content_type, _ = EXPORT_FORMATS[export_format]
+        # выключенный магазин выгружается пустым каталогом: готовых
+        # выгрузок у него нет, а поток не содержит категорий и товаров
+        snapshot = find_snapshot(shop, export_format)
+        try:
+            file = snapshot and open(export_file_path(snapshot.file), 'rb')
+        except FileNotFoundError:
+            file = None
+        if file:
+            # каталог не менялся с прошлой выгрузки, отдаем готовый файл
+            response = FileResponse(
+                file, content_type=f'{content_type}; charset=utf-8')
+        else:
+            # строки читаются из базы пачками по мере отправки клиенту
+            response = StreamingHttpResponse(
+                iter_export(shop, export_format),
+                content_type=f'{content_type}; charset=utf-8')
+        response['Content-Disposition'] = (
+            f'attachment; filename="catalog.{export_format}"')
+        return response
+
     def post(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return Response({'message': 'Требуется войти'},
@@ -616,8 +884,128 @@ class Partnerexport(APIView):
             return Response({'message': 'Только для магазинов'},
                             status=status.HTTP_403_FORBIDDEN)
 
-        task_product_export.delay(request.user.id)
-        return Response({'status': 'Экспорт данных прошел успешно'},
+        export_format = request.data.get('format', 'yaml')
+        if export_format not in EXPORT_FORMATS:
+            return Response({'message': 'Поддерживаемые форматы: '
+                                        + ', '.join(EXPORT_FORMATS)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        compression = request.data.get('compression', '')
+        if compression not in EXPORT_COMPRESSIONS:
+            return Response({'message': 'Поддерживаемое сжатие: '
+                                        + ', '.join(filter(
+                                            None, EXPORT_COMPRESSIONS))},
+                            status=status.HTTP_400_BAD_REQUEST)
+        shop = Shop.objects.filter(user_id=request.user.id).first()
+        if shop is None:
+            return Response({'message': 'Магазин не найден'},
+                            status=status.HTTP_404_NOT_FOUND)
+        snapshot = find_snapshot(shop, export_format, compression)
+        if snapshot:
+            return Response({'status': 'Выгрузка уже готова',
+                             'export_id': snapshot.id})
+        job = ExportJob.objects.create(shop=shop, format=export_format,
+                                       compression=compression,
+                                       catalog_version=shop.catalog_version)
+        task_product_export.delay(request.user.id, job.id)
+        return Response({'status': 'Экспорт данных прошел успешно',
+                         'export_id': job.id},
 
                         status=status.HTTP_201_CREATED)
 
+
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def export_file_response(request, job):
+    """
+    Отдаем файл выгрузки с поддержкой докачки.
+    За nginx файл отдается через X-Accel-Redirect, и Range обрабатывает
+    nginx; без него поддерживается один диапазон байт
+    """
+    path = export_file_path(job.file)
+    if not os.path.exists(path):
+        return Response({'message': 'Файл выгрузки удален'},
+                        status=status.HTTP_410_GONE)
+    content_type = export_content_type(job)
+    etag = f'"{job.sha256}"'
+    if settings.EXPORT_ACCEL_REDIRECT:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = (settings.EXPORT_ACCEL_REDIRECT
+                                        + job.file.replace(os.sep, '/'))
+    else:
+        size = os.path.getsize(path)
+        match = BYTE_RANGE_RE.match(request.headers.get('Range', ''))
+        if_range = request.headers.get('If-Range')
+        if match and any(match.groups()) and if_range in (None, etag):
+            start, end = match.groups()
+            if start:
+                start = int(start)
+                end = min(int(end), size - 1) if end else size - 1
+            else:
+                # bytes=-N - последние N байт
+                start = max(size - int(end), 0)
+                end = size - 1
+            if start >= size or start > end:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+            response = StreamingHttpResponse(
+                iter_file_range(path, start, end - start + 1),
+                status=206, content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = end - start + 1
+        else:
+            response = FileResponse(open(path, 'rb'),
+                                    content_type=content_type)
+    response['Content-Disposition'] = (
+        f'attachment; filename="{export_download_name(job)}"')
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    return response
+
+
+class PartnerExportFile(APIView):
+    """
+    Статус выгрузки и готовый файл
+    """
+
+    def get(self, request, export_id, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'message': 'Требуется войти'},
+                            status=status.HTTP_403_FORBIDDEN)
+        if request.user.type != 'shop':
+            return Response({'message': 'Только для магазинов'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        job = ExportJob.objects.filter(id=export_id,
+                                       shop__user_id=request.user.id).first()
+        if job is None:
+            return Response({'message': 'Выгрузка не найдена'},
+                            status=status.HTTP_404_NOT_FOUND)
+        if job.state != 'done':
+            serializer = ExportJobSerializer(job)
+            return Response(serializer.data)
+        return export_file_response(request, job)
+
+
+class PartnerExportManifest(APIView):
+    """
+    Манифест выгрузки: формат, сжатие, размер и SHA-256 файла
+    """
+
+    def get(self, request, export_id, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'message': 'Требуется войти'},
+                            status=status.HTTP_403_FORBIDDEN)
+        if request.user.type != 'shop':
+            return Response({'message': 'Только для магазинов'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        job = ExportJob.objects.filter(id=export_id,
+                                       shop__user_id=request.user.id).first()
+        if job is None:
+            return Response({'message': 'Выгрузка не найдена'},
+                            status=status.HTTP_404_NOT_FOUND)
+        serializer = ExportJobSerializer(job)
+        return Response(serializer.data)
+
@@ -47,6 +47,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'django_rest_passwordreset',
@@ -182,10 +183,74 @@ CELERY_CACHE_BACKEND = 'django-cache'
 
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
-        'LOCATION': 'redis://localhost:6379/1',
-    }
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.getenv('REDIS_CACHE_URL', 'redis://redis:6379/1'),
+        'OPTIONS': {
+            'SOCKET_CONNECT_TIMEOUT': 1,
+            'SOCKET_TIMEOUT': 1,
+            # при недоступном redis кэш ответов работает как пустой,
+            # а не роняет запросы
+            'IGNORE_EXCEPTIONS': True,
+        },
+    },
+    # поколения кэша имен backend.intern: ошибки не глотаются, иначе
+    # потерянная инвалидация оставит в воркерах id удаленных записей
+    'intern': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.getenv('REDIS_CACHE_URL', 'redis://redis:6379/1'),
+        'KEY_PREFIX': 'intern',
+        'OPTIONS': {
+            'SOCKET_CONNECT_TIMEOUT': 1,
+            'SOCKET_TIMEOUT': 1,
+        },
+    },
 }
 
 
 # CELERY_TASK_ALWAYS_EAGER  = True
+
+# Размер пачки для bulk_create/bulk_update при импорте прайс-листов
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+
+# Ограничения на скачивание прайс-листа воркером: размер в байтах и время
+# в секундах
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', 200 * 1024 * 1024))
+IMPORT_TIMEOUT = int(os.getenv('IMPORT_TIMEOUT', 300))
+
+# Прайс-листы больше одного шарда загружаются параллельно группой задач,
+# упавший шард перезапускается до IMPORT_SHARD_RETRIES раз
+IMPORT_SHARD_SIZE = int(os.getenv('IMPORT_SHARD_SIZE', 5000))
+IMPORT_SHARD_RETRIES = int(os.getenv('IMPORT_SHARD_RETRIES', 3))
+
+# Загрузка занимает магазин до публикации или отмены, брошенную загрузку
+# новая может сменить через IMPORT_LEASE_TIMEOUT секунд
+IMPORT_LEASE_TIMEOUT = int(os.getenv('IMPORT_LEASE_TIMEOUT', 2 * 60 * 60))
+
+# Размер кэша имя -> id для категорий, параметров и продуктов в процессе
+# воркера
+INTERN_CACHE_SIZE = int(os.getenv('INTERN_CACHE_SIZE', 50000))
+
+# Каталог для файлов выгрузки каталога, у каждой выгрузки свой файл
+# EXPORT_ROOT/<id магазина>/<id выгрузки>.<формат>
+EXPORT_ROOT = os.getenv('EXPORT_ROOT', os.path.join(BASE_DIR, 'exports'))
+# Сколько товаров читается из базы и пишется в файл за один шаг
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 2000))
+# Общий размер готовых выгрузок, сверх него удаляются самые старые
+EXPORT_CACHE_MAX_BYTES = int(os.getenv('EXPORT_CACHE_MAX_BYTES',
+                                       2 * 1024 * 1024 * 1024))
+# Префикс внутренней location nginx с файлами выгрузок. Если задан, Django
+# только проверяет доступ, а файл и докачку по Range отдает nginx
+EXPORT_ACCEL_REDIRECT = os.getenv('EXPORT_ACCEL_REDIRECT', '')
+
+# Размер страницы каталога /products по умолчанию и наибольший по запросу
+PRODUCTS_PAGE_SIZE = int(os.getenv('PRODUCTS_PAGE_SIZE', 40))
+PRODUCTS_MAX_PAGE_SIZE = int(os.getenv('PRODUCTS_MAX_PAGE_SIZE', 500))
+
+# Фасеты /products по поиску, диапазонам и параметрам считаются только
+# по запросу facets=true и не больше чем по FACETS_MAX_ITEMS строкам выдачи
+FACETS_MAX_ITEMS = int(os.getenv('FACETS_MAX_ITEMS', 10000))
+
+# Сколько секунд хранится ответ /products, /shops и /categories в кэше.
+# Устаревший ответ перестает читаться сразу при изменении каталога,
+# время жизни только освобождает память
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 24 * 60 * 60))